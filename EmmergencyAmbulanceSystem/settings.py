@@ -157,6 +157,7 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_THROTTLE_RATES': {
         'anon': '20/minute',
+        'geocode': '120/minute',
     },
 }
 
@@ -209,6 +210,117 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Emergency call listings (the call list API, completed/all calls) are served in
+# keyset pages newest first (?cursor=, ?page_size= up to the maximum)
+EMERGENCY_LIST_PAGE_SIZE = 50
+EMERGENCY_LIST_MAX_PAGE_SIZE = 200
+
+# Dispatch: grid cell size (degrees) of the in-memory fleet spatial index
+FLEET_INDEX_CELL_SIZE_DEG = 0.02
+# ...reloaded from the database every N seconds, so units made available by
+# other worker processes are found (0 keeps the first load for the process)
+FLEET_INDEX_MAX_AGE = 30
+
+# Upper bound on GPS fixes accepted by one batch location request
+LOCATION_BATCH_MAX_POINTS = 1000
+
+# Ambulance positions are held in a write-behind store and flushed to the
+# database every N seconds (0 writes each ping through immediately)
+FLEET_POSITION_FLUSH_INTERVAL = 2
+
+# Location ping history: full resolution for N days, then thinned to one ping
+# per unit per rollup interval, deleted after the retention period
+# (`manage.py prune_location_history`, e.g. nightly from cron)
+LOCATION_HISTORY_RETENTION_DAYS = 90
+LOCATION_HISTORY_FULL_RESOLUTION_DAYS = 7
+LOCATION_HISTORY_ROLLUP_SECONDS = 60
+LOCATION_TRACK_MAX_POINTS = 200000
+
+# Position broadcasts are coalesced per unit and sent to dispatchers as one
+# LOCATION_BATCH frame per tick (seconds); 0 sends each one immediately.
+# Status changes are never delayed.
+LOCATION_BROADCAST_INTERVAL = 0.5
+
+# Emergency/ambulance updates go to dispatchers as deltas (only the changed
+# fields, versioned by updated_at) after the first full frame per entity;
+# REALTIME_DELTA_MAX_ENTITIES bounds the per-process cache of last-sent state.
+REALTIME_DELTA_FRAMES = True
+REALTIME_DELTA_MAX_ENTITIES = 5000
+
+# WebSocket clients may negotiate MessagePack and/or zlib-compressed frames
+# (core.frames); frames smaller than this are sent uncompressed.
+REALTIME_COMPRESS_MIN_BYTES = 256
+REALTIME_COMPRESS_LEVEL = 6
+
+# Dispatcher frames carry a stream seq/epoch; each process keeps this many recent
+# events so a reconnecting dashboard (?resume=<epoch>:<seq>) only gets what it
+# missed instead of a full initial_data snapshot.
+REALTIME_REPLAY_BUFFER_SIZE = 5000
+
+# initial_data is served from an in-memory snapshot kept current by the
+# dispatcher feed (core.snapshot) and re-read from the database at least
+# every REALTIME_SNAPSHOT_MAX_AGE seconds.
+REALTIME_SNAPSHOT_CACHE = True
+REALTIME_SNAPSHOT_MAX_AGE = 300
+
+# Dashboards connecting with ?initial=chunked get initial_data as a stream of
+# chunks (most urgent calls first) of at most this many items / bytes.
+REALTIME_INITIAL_CHUNK_ITEMS = 200
+REALTIME_INITIAL_CHUNK_BYTES = 64 * 1024
+
+# Each WebSocket connection sends through a queue of at most this many frames
+# (core.sendqueue): superseded LOCATION_BATCH rows are dropped for slow
+# clients, and a client backed up with frames that can't be dropped is
+# disconnected to resume. 0 sends directly.
+REALTIME_SEND_QUEUE_SIZE = 256
+
+# Dispatcher sockets may follow an area (?sectors=<geohash prefixes> or
+# ?bbox=s,w,n,e, or a `subscribe` message) instead of the whole city; located
+# events also go to the group of their geohash sector at this precision
+# (5 characters = ~4.9 x 4.9 km).
+DISPATCH_SECTORS_ENABLED = True
+DISPATCH_SECTOR_PRECISION = 5
+DISPATCH_MAX_SECTORS_PER_SOCKET = 1024
+
+# Emergency/dispatch/hospital notifications are written to the outbox table in
+# the request's transaction and relayed to the channel layer after commit by a
+# thread woken on commit (polling every OUTBOX_RELAY_INTERVAL seconds for
+# retries; 0 relays inline on commit). Set OUTBOX_RELAY_IN_PROCESS = False when
+# running `manage.py relay_outbox` as a separate worker. Events being sent are
+# leased for OUTBOX_LEASE_SECONDS, after which a crashed relay's events are retried.
+OUTBOX_RELAY_IN_PROCESS = True
+OUTBOX_RELAY_INTERVAL = 1.0
+OUTBOX_BATCH_SIZE = 200
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_LEASE_SECONDS = 30
+
+# How often (seconds) a paramedic socket streaming GPS re-checks its unit assignment
+PARAMEDIC_WS_ASSIGNMENT_CHECK_INTERVAL = 10
+
+# Paramedic devices count as online while heard from (ping or GPS frame) within
+# PRESENCE_TTL seconds (core.presence). Presence is kept in process memory;
+# set PRESENCE_REDIS_URL (e.g. 'redis://127.0.0.1:6379/1') to share it between
+# ASGI processes.
+PRESENCE_TTL = 60
+PRESENCE_REDIS_URL = None
+
+# Offline routing: road graph built with `manage.py import_road_graph <extract.osm>`.
+# Without the file, ETAs fall back to straight-line distance at the fallback speed.
+ROAD_GRAPH_PATH = BASE_DIR / 'dispatch' / 'data' / 'road_graph.npz'
+ROUTING_ACCESS_SPEED_KMH = 15  # off-network leg between a point and the nearest road node
+ROUTING_FALLBACK_SPEED_KMH = 40
+
+# Road ETA cache: entries keyed by ~500 m origin/destination cells, dropped
+# when local time enters a new band (band start hours below)
+ETA_CACHE_MAX_ENTRIES = 10000
+ETA_CACHE_TTL_SECONDS = 900
+ETA_CACHE_CELL_SIZE_DEG = 0.005
+ETA_CACHE_TIME_BANDS = [0, 6, 10, 16, 20]
+
+# Offline geocoding for the public form: gazetteer built with
+# `manage.py import_gazetteer <extract.osm>`
+GAZETTEER_PATH = BASE_DIR / 'emergencies' / 'data' / 'gazetteer.csv'
+
 # Logging configuration for debugging WebSocket connections
 LOGGING = {
     'version': 1,
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User
+from .models import OutboxEvent, User
 
 
 @admin.register(User)
@@ -17,3 +17,11 @@ class UserAdmin(BaseUserAdmin):
     add_fieldsets = BaseUserAdmin.add_fieldsets + (
         ('Additional Info', {'fields': ('role', 'phone_number')}),
     )
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ('id', 'message_type', 'event', 'ordering_key', 'attempts', 'available_at', 'created_at')
+    list_filter = ('message_type', 'event')
+    search_fields = ('ordering_key', 'last_error')
+    readonly_fields = ('created_at',)
@@ -0,0 +1,246 @@
+"""
+Negotiated WebSocket frame encodings.
+
+Clients pick an encoding by offering ``ambulance.<encoding>`` subprotocols
+(first supported one wins) or with ``?encoding=<encoding>``:
+
+- ``json``: text frames, as before (the default)
+- ``json+deflate``: JSON, zlib-compressed when the frame is large enough
+- ``msgpack`` / ``msgpack+deflate``: MessagePack, optionally compressed
+
+Non-JSON encodings use binary frames with a one-byte header: bit 0 set
+means the body is zlib-compressed, bit 1 set means it is MessagePack
+(otherwise UTF-8 JSON). Frames below ``REALTIME_COMPRESS_MIN_BYTES`` are
+not compressed. The browser side is ``decodeFrame`` in ``static/js/scripts.js``.
+
+Broadcasts are encoded once: the sender stores the client-visible JSON in
+the channel message (``frame``, see :func:`pre_encode`) and each process
+renders it at most once per encoding (:class:`FrameCache`), so fan-out to
+many sockets costs a cache hit per socket rather than an encode.
+"""
+import json
+import logging
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack ships with channels-redis
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+SUBPROTOCOL_PREFIX = 'ambulance.'
+
+FLAG_DEFLATE = 0x01
+FLAG_MSGPACK = 0x02
+
+
+def supported_encodings() -> Tuple[str, ...]:
+    if msgpack is None:
+        return ('json', 'json+deflate')
+    return ('json', 'json+deflate', 'msgpack', 'msgpack+deflate')
+
+
+def negotiate_encoding(scope) -> Tuple[str, Optional[str]]:
+    """``(encoding, subprotocol to accept)`` for a connection scope."""
+    supported = supported_encodings()
+    for offered in scope.get('subprotocols') or []:
+        encoding = offered[len(SUBPROTOCOL_PREFIX):] if offered.startswith(SUBPROTOCOL_PREFIX) else None
+        if encoding in supported:
+            return encoding, offered
+    params = parse_qs(scope.get('query_string', b'').decode())
+    # A literal '+' in the query string arrives as a space
+    encoding = (params.get('encoding') or ['json'])[0].replace(' ', '+')
+    return (encoding if encoding in supported else 'json'), None
+
+
+def dumps_json(obj: Any) -> str:
+    """Compact JSON text, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str).decode()
+    return json.dumps(obj, separators=(',', ':'), default=str)
+
+
+def loads_json(text) -> Any:
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
+
+def encode_frame(message: Any, encoding: str) -> Tuple[Optional[str], Optional[bytes]]:
+    """``(text_data, bytes_data)`` for one outgoing message."""
+    if encoding.startswith('msgpack'):
+        return None, _binary_frame(msgpack.packb(message, default=str), FLAG_MSGPACK, encoding)
+    return encode_json_frame(dumps_json(message), encoding)
+
+
+def encode_json_frame(text: str, encoding: str) -> Tuple[Optional[str], Optional[bytes]]:
+    """:func:`encode_frame` for a message that is already JSON text."""
+    if encoding == 'json':
+        return text, None
+    if encoding.startswith('msgpack'):
+        return encode_frame(loads_json(text), encoding)
+    return None, _binary_frame(text.encode(), 0, encoding)
+
+
+def _binary_frame(body: bytes, flags: int, encoding: str) -> bytes:
+    if encoding.endswith('+deflate') and len(body) >= getattr(settings, 'REALTIME_COMPRESS_MIN_BYTES', 256):
+        body = zlib.compress(body, getattr(settings, 'REALTIME_COMPRESS_LEVEL', 6))
+        flags |= FLAG_DEFLATE
+    return bytes([flags]) + body
+
+
+def decode_frame(text_data: Optional[str] = None, bytes_data: Optional[bytes] = None) -> Any:
+    """
+    Decode an incoming frame in any of the encodings.
+
+    Raises:
+        ValueError: for malformed frames
+    """
+    if text_data is not None:
+        return json.loads(text_data)
+    if not bytes_data:
+        raise ValueError("Empty frame")
+    flags, body = bytes_data[0], bytes_data[1:]
+    try:
+        if flags & FLAG_DEFLATE:
+            body = zlib.decompress(body)
+        if flags & FLAG_MSGPACK:
+            if msgpack is None:
+                raise ValueError("MessagePack is not available")
+            return msgpack.unpackb(body)
+        return loads_json(body)
+    except (zlib.error, ValueError, TypeError) as e:
+        raise ValueError(f"Malformed frame: {e}")
+
+
+# Channel message keys that make up the client-visible frame
+FRAME_KEYS = ('type', 'event', 'data', 'delta')
+
+
+def pre_encode(message: Dict[str, Any], fid: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Replace a channel message's client-visible part with its JSON text in
+    ``frame`` (in place); ``fid`` identifies this exact frame for caching.
+    """
+    if 'frame' not in message:
+        message['frame'] = dumps_json({k: message[k] for k in FRAME_KEYS if k in message})
+        message.pop('data', None)
+        message.pop('delta', None)
+        if fid:
+            message['fid'] = fid
+    return message
+
+
+def message_body(message: Dict[str, Any]) -> Dict[str, Any]:
+    """The client-visible part of a channel message, decoding ``frame`` if pre-encoded."""
+    if 'frame' in message:
+        return loads_json(message['frame'])
+    return {k: message[k] for k in FRAME_KEYS if k in message}
+
+
+def with_fields(text: str, extra: Dict[str, Any]) -> str:
+    """Append fields to the JSON object ``text`` without re-encoding it."""
+    return f'{text[:-1]},{dumps_json(extra)[1:]}' if extra else text
+
+
+class FrameCache:
+    """Recently rendered frames per ``(fid, encoding, extra)``, shared by every socket in the process."""
+
+    def __init__(self, size: int = 512):
+        self.size = size
+        self._frames: 'OrderedDict[tuple, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def render(self, message: Dict[str, Any], encoding: str,
+               extra: Optional[Dict[str, Any]] = None) -> Tuple[Optional[str], Optional[bytes]]:
+        """``(text_data, bytes_data)`` for a channel message plus ``extra`` fields."""
+        if 'frame' not in message:
+            return encode_frame({**message_body(message), **(extra or {})}, encoding)
+        key = (message.get('fid'), encoding, tuple(sorted((extra or {}).items())))
+        if key[0] is not None:
+            with self._lock:
+                cached = self._frames.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+        self.misses += 1
+        rendered = encode_json_frame(with_fields(message['frame'], extra), encoding)
+        if key[0] is not None:
+            with self._lock:
+                self._frames[key] = rendered
+                while len(self._frames) > self.size:
+                    self._frames.popitem(last=False)
+        return rendered
+
+    def stats(self) -> Dict[str, Any]:
+        return {'size': len(self._frames), 'hits': self.hits, 'misses': self.misses}
+
+
+_frame_cache = FrameCache()
+
+
+def get_frame_cache() -> FrameCache:
+    return _frame_cache
+
+
+class EncodedFramesMixin:
+    """
+    For ``AsyncWebsocketConsumer`` subclasses: negotiates the encoding on
+    ``accept()`` and sends messages with ``send_frame()`` (or forwards
+    broadcast channel messages with ``forward_frame()``). Frames go out
+    through the connection's bounded send queue (:mod:`core.sendqueue`)
+    unless ``REALTIME_SEND_QUEUE_SIZE`` is 0.
+    """
+    encoding = 'json'
+    send_queue = None
+
+    async def accept(self, subprotocol=None, headers=None):
+        from .sendqueue import SendQueue
+
+        self.encoding, negotiated = negotiate_encoding(self.scope)
+        await super().accept(subprotocol=subprotocol or negotiated, headers=headers)
+        size = getattr(settings, 'REALTIME_SEND_QUEUE_SIZE', 256)
+        if size > 0:
+            self.send_queue = SendQueue(self.send, lambda message: encode_frame(message, self.encoding), size)
+            self.send_queue.start()
+
+    async def websocket_disconnect(self, message):
+        if self.send_queue is not None:
+            self.send_queue.close()
+        await super().websocket_disconnect(message)
+
+    async def send_frame(self, message: Any) -> None:
+        await self.send_encoded(*encode_frame(message, self.encoding))
+
+    async def forward_frame(self, message: Dict[str, Any], extra: Optional[Dict[str, Any]] = None) -> None:
+        """Send a (pre-encoded) channel message as-is, plus ``extra`` fields."""
+        from .sendqueue import is_droppable
+
+        frame = get_frame_cache().render(message, self.encoding, extra)
+        if self.send_queue is not None and is_droppable(message):
+            self.send_queue.put_positions(message, extra, frame)
+            return
+        await self.send_encoded(*frame)
+
+    async def send_encoded(self, text_data: Optional[str], bytes_data: Optional[bytes]) -> None:
+        """Send a frame that is already encoded; it is never dropped."""
+        if self.send_queue is None:
+            await self.send(text_data=text_data, bytes_data=bytes_data)
+        elif not self.send_queue.put((text_data, bytes_data)):
+            # Too far behind to catch up frame by frame; the client resumes from its last seq
+            from .sendqueue import CLOSE_CODE_BACKLOG
+
+            logger.warning(f"Closing WebSocket with {len(self.send_queue)} frames queued")
+            self.send_queue.close()
+            await self.close(code=CLOSE_CODE_BACKLOG)
@@ -0,0 +1,84 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.frames import FrameCache, encode_frame, pre_encode, supported_encodings
+
+INTERNAL_KEYS = ('eid', 'sectors', 'partial')
+
+
+def ambulance_message(n):
+    return {
+        'type': 'ambulance_update', 'event': 'LOCATION_UPDATE', 'eid': f'bench:{n}',
+        'sectors': ['ezs42'],
+        'data': {
+            'id': 7, 'vehicle_number': 'AMB-007', 'status': 'EN_ROUTE', 'vehicle_type': 'ALS',
+            'current_latitude': '8.484100', 'current_longitude': '-13.234400',
+            'station': {'id': 2, 'name': 'Central Station', 'latitude': '8.480000', 'longitude': '-13.230000'},
+            'crew': [{'id': 11, 'username': 'medic1'}, {'id': 12, 'username': 'medic2'}],
+            'updated_at': '2024-01-01T00:00:00Z', 'v': 1704067200000 + n,
+        },
+    }
+
+
+def location_batch_message(n, rows=200):
+    return {
+        'type': 'ambulance_update', 'event': 'LOCATION_BATCH', 'eid': f'bench:{n}',
+        'data': {'locations': [
+            [i, round(8.40 + i * 0.0005, 6), round(-13.30 + i * 0.0005, 6), 1704067200000 + n]
+            for i in range(rows)
+        ]},
+    }
+
+
+def legacy_fanout(message, encoding, subscribers):
+    """The previous consumer path: every socket builds and encodes its own frame."""
+    for seq in range(subscribers):
+        frame = {k: v for k, v in message.items() if k not in INTERNAL_KEYS}
+        frame['seq'] = seq
+        frame['epoch'] = 'bench'
+        if encoding == 'json':
+            json.dumps(frame)
+        else:
+            encode_frame(frame, encoding)
+
+
+def shared_fanout(message, encoding, subscribers, cache):
+    """Encode once at the sender, then one cache lookup per socket."""
+    message = pre_encode(dict(message), message['eid'])
+    extra = {'seq': 1, 'epoch': 'bench'}
+    for _ in range(subscribers):
+        cache.render(message, encoding, extra)
+
+
+class Command(BaseCommand):
+    help = 'CPU time per broadcast event: per-socket encoding vs. encoding once and sharing the frame'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=50)
+        parser.add_argument('--subscribers', type=int, nargs='+', default=[10, 100, 1000])
+
+    def handle(self, *args, **options):
+        encodings = [e for e in ('json', 'msgpack+deflate') if e in supported_encodings()]
+        payloads = (('ambulance', ambulance_message), ('200-row batch', location_batch_message))
+        for label, make in payloads:
+            for encoding in encodings:
+                for subscribers in options['subscribers']:
+                    legacy = self._time(options['events'], make,
+                                        lambda m: legacy_fanout(m, encoding, subscribers))
+                    cache = FrameCache()
+                    shared = self._time(options['events'], make,
+                                        lambda m: shared_fanout(m, encoding, subscribers, cache))
+                    self.stdout.write(
+                        f'{label:>13} {encoding:>15} x{subscribers:<5}: per-socket {legacy:8.3f} ms | '
+                        f'shared {shared:7.3f} ms | {legacy / shared:6.1f}x'
+                    )
+
+    def _time(self, events, make, fanout):
+        """Mean CPU milliseconds per event."""
+        messages = [make(n) for n in range(events)]
+        start = time.process_time()
+        for message in messages:
+            fanout(message)
+        return (time.process_time() - start) * 1000 / events
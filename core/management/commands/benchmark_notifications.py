@@ -0,0 +1,94 @@
+import asyncio
+import statistics
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from core.utils import asend_channel_notification, send_channel_notification
+
+GROUP = 'benchmark_dispatchers'
+# No user has id 0, so the personal group only reaches the benchmark's own channels
+PARAMEDIC_ID = 0
+
+
+def legacy_send(channel_layer, group_name, message_type, event, data, paramedic_id):
+    """The previous implementation: one async_to_sync bridge per target group."""
+    async_to_sync(channel_layer.group_send)(group_name, {'type': message_type, 'event': event, 'data': data})
+    async_to_sync(channel_layer.group_send)(
+        f'paramedic_{paramedic_id}', {'type': message_type, 'event': event, 'data': data}
+    )
+
+
+class Command(BaseCommand):
+    help = 'Per-event notification latency: legacy sync sends vs. the sync shim vs. awaiting the async API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=2000)
+        parser.add_argument('--receivers', type=int, default=20,
+                            help='Channels subscribed to the dispatcher group')
+
+    def handle(self, *args, **options):
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            self.stderr.write('No channel layer configured')
+            return
+        events = options['events']
+        data = {
+            'id': 1, 'call_id': 'EMG-BENCH', 'status': 'DISPATCHED', 'priority': 'HIGH',
+            'caller_name': 'Benchmark', 'latitude': 8.48, 'longitude': -13.23,
+            'updated_at': '2024-01-01T00:00:00Z',
+        }
+        args = (GROUP, 'emergency_update', 'STATUS_UPDATE', data, PARAMEDIC_ID)
+        channels = self._subscribe(channel_layer, options['receivers'])
+        self.stdout.write(f'{type(channel_layer).__name__}, {events} events, '
+                          f'{len(channels) - 1} dispatcher channels + 1 paramedic channel')
+        try:
+            self._report('legacy sync', self._time_sync(lambda: legacy_send(channel_layer, *args), events))
+            self._report('sync shim', self._time_sync(lambda: send_channel_notification(*args), events))
+            self._report('async await', async_to_sync(self._time_async)(args, events))
+        finally:
+            self._unsubscribe(channel_layer, channels)
+
+    def _subscribe(self, channel_layer, receivers):
+        async def subscribe():
+            names = [await channel_layer.new_channel() for _ in range(receivers + 1)]
+            for name in names[:-1]:
+                await channel_layer.group_add(GROUP, name)
+            await channel_layer.group_add(f'paramedic_{PARAMEDIC_ID}', names[-1])
+            return names
+        return async_to_sync(subscribe)()
+
+    def _unsubscribe(self, channel_layer, channels):
+        async def unsubscribe():
+            for name in channels[:-1]:
+                await channel_layer.group_discard(GROUP, name)
+            await channel_layer.group_discard(f'paramedic_{PARAMEDIC_ID}', channels[-1])
+        async_to_sync(unsubscribe)()
+
+    def _time_sync(self, send, events):
+        samples = []
+        for _ in range(events):
+            start = time.perf_counter()
+            send()
+            samples.append(time.perf_counter() - start)
+        return samples
+
+    async def _time_async(self, args, events):
+        samples = []
+        for _ in range(events):
+            start = time.perf_counter()
+            await asend_channel_notification(*args)
+            samples.append(time.perf_counter() - start)
+        # Let the in-memory layer's fan-out tasks settle before the loop closes
+        await asyncio.sleep(0)
+        return samples
+
+    def _report(self, name, samples):
+        ms = sorted(s * 1000 for s in samples)
+        p99 = ms[min(len(ms) - 1, int(len(ms) * 0.99))]
+        self.stdout.write(
+            f'{name:>12}: mean {statistics.fmean(ms):6.3f} ms | median {statistics.median(ms):6.3f} ms | '
+            f'p99 {p99:6.3f} ms | {len(ms) / (sum(ms) / 1000):8.0f} events/s'
+        )
@@ -0,0 +1,37 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core.outbox import relay_pending
+
+
+class Command(BaseCommand):
+    help = 'Relay committed real-time notifications from the outbox to the channel layer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Relay what is due and exit')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'OUTBOX_BATCH_SIZE', 200))
+        parser.add_argument('--interval', type=float, default=0.2,
+                            help='Seconds to sleep when the outbox is empty')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            sent = relay_pending(options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'Relayed {sent} events'))
+            return
+
+        self.stdout.write(f"Relaying outbox every {options['interval']}s (Ctrl+C to stop)")
+        try:
+            while True:
+                close_old_connections()
+                try:
+                    sent = relay_pending(options['batch_size'])
+                except Exception as e:
+                    self.stderr.write(f'Relay failed: {e}')
+                    sent = 0
+                if not sent:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
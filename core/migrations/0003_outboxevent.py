@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:26
+
+import django.core.serializers.json
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_user_is_available_for_dispatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('group_name', models.CharField(max_length=100)),
+                ('message_type', models.CharField(max_length=50)),
+                ('event', models.CharField(max_length=50)),
+                ('payload', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('paramedic_id', models.IntegerField(blank=True, null=True)),
+                ('entity_kind', models.CharField(blank=True, max_length=20)),
+                ('ordering_key', models.CharField(blank=True, max_length=50)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -1,5 +1,7 @@
 from django.contrib.auth.models import AbstractUser
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
 
 
 class User(AbstractUser):
@@ -37,4 +39,31 @@ class User(AbstractUser):
         # Ensure superusers default to admin role for app-level permissions
         if getattr(self, 'is_superuser', False) and self.role != 'admin':
             self.role = 'admin'
-        super().save(*args, **kwargs)
\ No newline at end of file
+        super().save(*args, **kwargs)
+
+
+class OutboxEvent(models.Model):
+    """
+    Real-time notification written in the same transaction as the state
+    change it announces; ``core.outbox`` relays it to the channel layer
+    after commit and deletes it once delivered.
+    """
+    id = models.BigAutoField(primary_key=True)
+    group_name = models.CharField(max_length=100)
+    message_type = models.CharField(max_length=50)
+    event = models.CharField(max_length=50)
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    paramedic_id = models.IntegerField(null=True, blank=True)
+    entity_kind = models.CharField(max_length=20, blank=True)
+    # Events sharing a key (e.g. 'emergency:12') are delivered in id order
+    ordering_key = models.CharField(max_length=50, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['id']
+    
+    def __str__(self):
+        return f"{self.message_type}/{self.event} #{self.id} ({self.ordering_key or self.group_name})"
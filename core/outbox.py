@@ -0,0 +1,283 @@
+"""
+Transactional outbox for real-time notifications.
+
+Views record notifications with :func:`enqueue_notification` (or the
+``enqueue_*`` wrappers) inside the transaction that changes state, so an
+event exists exactly when its change was committed. Sending happens off
+the request path: on commit the in-process relay thread is woken, and it
+drains the ``OutboxEvent`` table in batches to the channel layer, retrying
+failures with backoff. Events sharing an ``ordering_key`` (one per call,
+unit or hospital) are delivered in the order they were written; a failed
+event holds back the later ones for the same key until it goes through or
+is given up on.
+
+Run ``manage.py relay_outbox`` as a separate worker to take relaying out
+of the web processes entirely (``OUTBOX_RELAY_IN_PROCESS = False``). With
+``OUTBOX_RELAY_INTERVAL = 0`` events are relayed synchronously on commit,
+which is what the tests and single-request scripts expect.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from .utils import PeriodicTask, build_group_messages
+
+logger = logging.getLogger(__name__)
+
+# Longest wait between retries of one event (seconds)
+MAX_RETRY_DELAY = 60
+
+
+def enqueue_notification(
+    group_name: str,
+    message_type: str,
+    event: str,
+    data: Dict[str, Any],
+    paramedic_id: Optional[int] = None,
+    entity_kind: Optional[str] = None,
+    ordering_key: str = ''
+) -> None:
+    """
+    Record a notification in the current transaction (arguments as for
+    :func:`core.utils.send_channel_notification`).
+
+    Nothing is sent if the transaction rolls back.
+    """
+    from .models import OutboxEvent
+
+    OutboxEvent.objects.create(
+        group_name=group_name,
+        message_type=message_type,
+        event=event,
+        payload=data,
+        paramedic_id=paramedic_id,
+        entity_kind=entity_kind or '',
+        ordering_key=ordering_key,
+    )
+    transaction.on_commit(kick_relay)
+
+
+def enqueue_emergency_notification(
+    event: str,
+    emergency_data: Dict[str, Any],
+    paramedic_id: Optional[int] = None
+) -> None:
+    """Outbox counterpart of :func:`core.utils.send_emergency_notification`."""
+    enqueue_notification(
+        group_name='dispatchers',
+        message_type='emergency_update',
+        event=event,
+        data=emergency_data,
+        paramedic_id=paramedic_id,
+        entity_kind='emergency',
+        ordering_key=f"emergency:{emergency_data['id']}"
+    )
+
+
+def enqueue_ambulance_notification(event: str, ambulance_data: Dict[str, Any]) -> None:
+    """Outbox counterpart of :func:`core.utils.send_ambulance_notification`."""
+    enqueue_notification(
+        group_name='dispatchers',
+        message_type='ambulance_update',
+        event=event,
+        data=ambulance_data,
+        entity_kind='ambulance',
+        ordering_key=f"ambulance:{ambulance_data['id']}"
+    )
+
+
+def enqueue_hospital_notification(event: str, hospital_data: Dict[str, Any]) -> None:
+    """Outbox counterpart of :func:`core.utils.send_hospital_notification`."""
+    enqueue_notification(
+        group_name='dispatchers',
+        message_type='hospital_update',
+        event=event,
+        data=hospital_data,
+        ordering_key=f"hospital:{hospital_data['id']}"
+    )
+
+
+async def _deliver(channel_layer, events: List[Any]) -> Dict[int, Optional[Exception]]:
+    """
+    Send events; each key's events go out one after another, different keys
+    concurrently. Returns the error (or None) per event id; after a failure
+    the rest of that key's events are not attempted.
+    """
+    chains: 'OrderedDict[str, list]' = OrderedDict()
+    for outbox_event in events:
+        chains.setdefault(outbox_event.ordering_key or f'#{outbox_event.id}', []).append(outbox_event)
+
+    results: Dict[int, Optional[Exception]] = {}
+
+    async def send_chain(chain):
+        for outbox_event in chain:
+            messages = build_group_messages(
+                outbox_event.group_name, outbox_event.message_type, outbox_event.event,
+                outbox_event.payload, outbox_event.paramedic_id, outbox_event.entity_kind or None
+            )
+            try:
+                await asyncio.gather(*(channel_layer.group_send(g, m) for g, m in messages))
+            except Exception as e:
+                results[outbox_event.id] = e
+                return
+            results[outbox_event.id] = None
+
+    await asyncio.gather(*(send_chain(chain) for chain in chains.values()))
+    return results
+
+
+def relay_batch(batch_size: int = 200) -> int:
+    """
+    Deliver up to ``batch_size`` due events; returns how many were sent.
+
+    Events are claimed in one short transaction, sent with no transaction
+    open, and settled in a second one, so no row locks are held while the
+    channel layer is awaited.
+    """
+    return _relay_batch(batch_size)[0]
+
+
+def _claim(batch_size: int, after_id: int):
+    """
+    Lease the next due events after ``after_id`` that aren't held back behind
+    an earlier event of their key. Returns ``(claimed, last id read)``; the
+    last id is None when the batch was short.
+
+    A lease pushes ``available_at`` out by ``OUTBOX_LEASE_SECONDS``, so other
+    relays skip the events (and later events of their keys) while they are
+    sent, and a relay that dies mid-send only delays them. Rows are locked
+    with ``SKIP LOCKED`` where the database supports it.
+    """
+    from .models import OutboxEvent
+
+    now = timezone.now()
+    with transaction.atomic():
+        rows = OutboxEvent.objects.filter(id__gt=after_id, available_at__lte=now).order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            rows = rows.select_for_update(skip_locked=True)
+        batch = list(rows[:batch_size])
+        if not batch:
+            return [], None
+
+        # Any earlier event of a key that isn't in the batch is backing off, leased
+        # or locked by another relay, and holds the rest of its key back
+        batch_ids = {e.id for e in batch}
+        blocked_before = {}
+        earlier = (
+            OutboxEvent.objects.filter(
+                ordering_key__in={e.ordering_key for e in batch if e.ordering_key},
+                id__lt=batch[-1].id,
+            )
+            .exclude(id__in=batch_ids)
+            .values_list('ordering_key', 'id')
+        )
+        for key, pk in earlier:
+            blocked_before[key] = min(pk, blocked_before.get(key, pk))
+        claimed = [
+            e for e in batch
+            if not e.ordering_key or blocked_before.get(e.ordering_key, e.id) >= e.id
+        ]
+        if claimed:
+            lease = timedelta(seconds=getattr(settings, 'OUTBOX_LEASE_SECONDS', 30))
+            OutboxEvent.objects.filter(id__in=[e.id for e in claimed]).update(available_at=now + lease)
+    return claimed, batch[-1].id if len(batch) == batch_size else None
+
+
+def _relay_batch(batch_size: int, after_id: int = 0):
+    """Claim, send and settle one batch; returns ``(sent, last id read or None)``."""
+    from asgiref.sync import async_to_sync
+    from channels.layers import get_channel_layer
+    from .models import OutboxEvent
+
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return 0, None
+    max_attempts = getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 8)
+
+    claimed, last_id = _claim(batch_size, after_id)
+    if not claimed:
+        return 0, last_id
+    results = async_to_sync(_deliver)(channel_layer, claimed)
+
+    now = timezone.now()
+    sent, failed, held = [], [], []
+    for outbox_event in claimed:
+        if outbox_event.id not in results:
+            held.append(outbox_event.id)  # behind a failure earlier in its key
+            continue
+        error = results[outbox_event.id]
+        if error is None:
+            sent.append(outbox_event.id)
+            continue
+        outbox_event.attempts += 1
+        if outbox_event.attempts >= max_attempts:
+            logger.error(f"Dropping outbox event {outbox_event} after {outbox_event.attempts} attempts: {error}")
+            sent.append(outbox_event.id)
+            continue
+        outbox_event.last_error = str(error)
+        outbox_event.available_at = now + timedelta(seconds=min(2 ** outbox_event.attempts, MAX_RETRY_DELAY))
+        failed.append(outbox_event)
+
+    with transaction.atomic():
+        if sent:
+            OutboxEvent.objects.filter(id__in=sent).delete()
+        if failed:
+            OutboxEvent.objects.bulk_update(failed, ['attempts', 'available_at', 'last_error'])
+        if held:
+            # Release the lease; the failed event ahead of them keeps them waiting
+            OutboxEvent.objects.filter(id__in=held).update(available_at=now)
+    if failed:
+        logger.warning(f"Outbox delivery failed for {len(failed)} events; will retry")
+    return len(sent), last_id
+
+
+def relay_pending(batch_size: int = 200) -> int:
+    """Relay batches until every due event has been tried once; returns the number sent."""
+    total, last_id = 0, 0
+    while True:
+        sent, last_id = _relay_batch(batch_size, last_id)
+        total += sent
+        if last_id is None:
+            return total
+
+
+def _relay_in_background() -> None:
+    try:
+        relay_pending(getattr(settings, 'OUTBOX_BATCH_SIZE', 200))
+    finally:
+        # The relay thread owns its connections; don't leave them open between ticks
+        connections.close_all()
+
+
+_relay: Optional[PeriodicTask] = None
+_relay_lock = threading.Lock()
+
+
+def kick_relay() -> None:
+    """Get committed events moving: wake the relay thread, or relay inline in synchronous mode."""
+    if not getattr(settings, 'OUTBOX_RELAY_IN_PROCESS', True):
+        return
+    interval = getattr(settings, 'OUTBOX_RELAY_INTERVAL', 1.0)
+    if interval <= 0:
+        try:
+            relay_pending(getattr(settings, 'OUTBOX_BATCH_SIZE', 200))
+        except Exception as e:
+            logger.warning(f"Outbox relay failed: {e}", exc_info=True)
+        return
+
+    global _relay
+    if _relay is None:
+        with _relay_lock:
+            if _relay is None:
+                _relay = PeriodicTask(_relay_in_background, interval, name='outbox-relay')
+                atexit.register(_relay.stop)
+    _relay.start()
+    _relay.wake()
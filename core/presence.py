@@ -0,0 +1,277 @@
+"""
+Paramedic presence: which field devices are connected, and when each
+paramedic was last heard from.
+
+``ParamedicConsumer`` reports connects, disconnects and every frame it
+receives (pings and GPS fixes). A paramedic is online while at least one
+of their connections has been heard from within ``PRESENCE_TTL`` seconds,
+so a device that vanishes without closing its socket goes offline by
+itself: a sweeper task drops expired connections and tells dispatchers
+(``presence_update``), as connects and disconnects do. Nothing is written
+to the database.
+
+The registry lives in process memory, which suits a single ASGI process.
+Set ``PRESENCE_REDIS_URL`` to share it between processes: each connection
+is a member of a per-user sorted set scored by its expiry time, and a
+connection's heartbeats reach Redis at most once per ``PRESENCE_TTL / 3``
+seconds, so a heartbeat costs a dictionary update rather than a round trip.
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _as_datetime(timestamp: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(timestamp, tz=dt_timezone.utc) if timestamp else None
+
+
+async def announce(user_id: int, online: bool) -> None:
+    """Tell dispatchers a paramedic came online or went offline."""
+    from .utils import asend_presence_notification
+
+    try:
+        await asend_presence_notification({
+            'id': user_id,
+            'online': online,
+            'last_seen': datetime.now(dt_timezone.utc).isoformat(),
+        })
+    except Exception as e:
+        logger.warning(f"Presence notification failed: {e}")
+
+
+class PresenceRegistry:
+    """In-process presence of paramedic connections."""
+
+    def __init__(self, ttl: float = 60):
+        self.ttl = ttl
+        self._connections: Dict[int, Dict[str, float]] = {}  # user -> {connection: expires at}
+        self._last_seen: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        self._sweeper: Optional[asyncio.Task] = None
+        self._sweeper_loop = None
+        self.heartbeats = 0
+
+    def _touch(self, user_id: int, connection: str, now: float) -> bool:
+        """Record activity on a connection; True if the user was offline."""
+        with self._lock:
+            connections = self._connections.setdefault(user_id, {})
+            was_online = self._alive(connections, now)
+            connections[connection] = now + self.ttl
+            self._last_seen[user_id] = now
+            self.heartbeats += 1
+        return not was_online
+
+    def _drop(self, user_id: int, connection: str, now: float) -> bool:
+        """Forget a connection; True if it was the user's last live one."""
+        with self._lock:
+            connections = self._connections.get(user_id, {})
+            self._last_seen[user_id] = now
+            # An expired connection was already reported offline by the sweep
+            was_live = connections.pop(connection, 0) > now
+            if self._alive(connections, now):
+                return False
+            self._connections.pop(user_id, None)
+            return was_live
+
+    @staticmethod
+    def _alive(connections: Dict[str, float], now: float) -> bool:
+        for connection, expires_at in list(connections.items()):
+            if expires_at <= now:
+                del connections[connection]
+        return bool(connections)
+
+    async def connect(self, user_id: int, connection: str) -> bool:
+        """A device connected; True if the paramedic just came online."""
+        return self._touch(user_id, connection, time.time())
+
+    async def heartbeat(self, user_id: int, connection: str) -> bool:
+        """Activity on an open connection; True if the sweeper had already reported the paramedic offline."""
+        return self._touch(user_id, connection, time.time())
+
+    async def disconnect(self, user_id: int, connection: str) -> bool:
+        """A device disconnected; True if the paramedic is now offline."""
+        return self._drop(user_id, connection, time.time())
+
+    async def sweep(self) -> List[int]:
+        """Drop expired connections; the users who went offline because of it."""
+        now = time.time()
+        with self._lock:
+            gone = [user_id for user_id, connections in self._connections.items() if not self._alive(connections, now)]
+            for user_id in gone:
+                del self._connections[user_id]
+        return gone
+
+    async def ensure_sweeper(self) -> None:
+        """Run the expiry sweep on the current event loop (once per loop)."""
+        loop = asyncio.get_running_loop()
+        if self._sweeper is not None and not self._sweeper.done() and self._sweeper_loop is loop:
+            return
+        self._sweeper_loop = loop
+        self._sweeper = loop.create_task(self._sweep_forever())
+
+    async def _sweep_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                for user_id in await self.sweep():
+                    await announce(user_id, False)
+            except Exception as e:
+                logger.warning(f"Presence sweep failed: {e}", exc_info=True)
+
+    def lookup(self, user_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        """``{user_id: {'online': bool, 'last_seen': datetime or None}}``"""
+        now = time.time()
+        with self._lock:
+            return {
+                user_id: {
+                    'online': self._alive(self._connections.get(user_id, {}), now),
+                    'last_seen': _as_datetime(self._last_seen.get(user_id)),
+                }
+                for user_id in user_ids
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            online = sum(1 for connections in self._connections.values() if self._alive(connections, now))
+        return {'backend': 'memory', 'ttl': self.ttl, 'online': online, 'heartbeats': self.heartbeats}
+
+
+class RedisPresenceRegistry(PresenceRegistry):
+    """Presence shared through Redis; the in-process state only throttles writes."""
+
+    KEY_PREFIX = 'presence:'
+
+    def __init__(self, url: str, ttl: float = 60):
+        import redis
+        import redis.asyncio
+
+        super().__init__(ttl)
+        self._redis = redis.Redis.from_url(url)
+        self._aredis = redis.asyncio.Redis.from_url(url)
+        self._written: Dict[str, float] = {}  # connection -> last heartbeat sent to Redis
+        self.writes = 0
+
+    def _user_key(self, user_id: int) -> str:
+        return f'{self.KEY_PREFIX}user:{user_id}'
+
+    def _last_seen_key(self) -> str:
+        return f'{self.KEY_PREFIX}last_seen'
+
+    def _queue_touch(self, pipe, user_id: int, connection: str, now: float) -> None:
+        key = self._user_key(user_id)
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zcard(key)
+        pipe.zadd(key, {connection: now + self.ttl})
+        pipe.expire(key, int(self.ttl) + 1)
+        pipe.hset(self._last_seen_key(), user_id, now)
+
+    async def connect(self, user_id: int, connection: str) -> bool:
+        now = time.time()
+        self._touch(user_id, connection, now)
+        self._written[connection] = now
+        try:
+            async with self._aredis.pipeline(transaction=True) as pipe:
+                self._queue_touch(pipe, user_id, connection, now)
+                results = await pipe.execute()
+            self.writes += 1
+            return results[1] == 0
+        except Exception as e:
+            logger.warning(f"Presence update failed: {e}")
+            return False
+
+    async def heartbeat(self, user_id: int, connection: str) -> bool:
+        now = time.time()
+        # Expiry takes a ttl without writes, so an expired connection is never throttled here
+        if not self._touch(user_id, connection, now) and now - self._written.get(connection, 0) < self.ttl / 3:
+            return False
+        self._written[connection] = now
+        try:
+            async with self._aredis.pipeline(transaction=False) as pipe:
+                self._queue_touch(pipe, user_id, connection, now)
+                results = await pipe.execute()
+            self.writes += 1
+            # Other processes' connections count too
+            return results[1] == 0
+        except Exception as e:
+            logger.warning(f"Presence heartbeat failed: {e}")
+            return False
+
+    async def disconnect(self, user_id: int, connection: str) -> bool:
+        now = time.time()
+        self._drop(user_id, connection, now)
+        self._written.pop(connection, None)
+        key = self._user_key(user_id)
+        try:
+            async with self._aredis.pipeline(transaction=True) as pipe:
+                pipe.zremrangebyscore(key, '-inf', now)
+                pipe.zrem(key, connection)
+                pipe.zcard(key)
+                pipe.hset(self._last_seen_key(), user_id, now)
+                results = await pipe.execute()
+            self.writes += 1
+            return results[1] == 1 and results[2] == 0
+        except Exception as e:
+            logger.warning(f"Presence update failed: {e}")
+            return False
+
+    async def sweep(self) -> List[int]:
+        gone = await super().sweep()
+        now = time.time()
+        self._written = {c: t for c, t in self._written.items() if now - t < self.ttl}
+        if not gone:
+            return []
+        try:
+            # Another process may still hold a live connection for the user
+            async with self._aredis.pipeline(transaction=False) as pipe:
+                for user_id in gone:
+                    pipe.zcount(self._user_key(user_id), f'({now}', '+inf')
+                counts = await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Presence sweep failed: {e}")
+            return []
+        return [user_id for user_id, count in zip(gone, counts) if count == 0]
+
+    def lookup(self, user_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        now = time.time()
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            for user_id in user_ids:
+                pipe.zcount(self._user_key(user_id), f'({now}', '+inf')
+            pipe.hmget(self._last_seen_key(), user_ids)
+            *counts, last_seen = pipe.execute()
+        except Exception as e:
+            logger.warning(f"Presence lookup failed, using this process only: {e}")
+            return super().lookup(user_ids)
+        return {
+            user_id: {'online': count > 0, 'last_seen': _as_datetime(float(seen) if seen else None)}
+            for user_id, count, seen in zip(user_ids, counts, last_seen)
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), 'backend': 'redis', 'writes': self.writes}
+
+
+_registry: Optional[PresenceRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_presence_registry() -> PresenceRegistry:
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                ttl = getattr(settings, 'PRESENCE_TTL', 60)
+                url = getattr(settings, 'PRESENCE_REDIS_URL', None)
+                _registry = RedisPresenceRegistry(url, ttl) if url else PresenceRegistry(ttl)
+    return _registry
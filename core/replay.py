@@ -0,0 +1,145 @@
+"""
+Sequenced dispatcher stream with a replay buffer.
+
+Every dispatcher-bound message gets an event id (``eid``) from its sender.
+In each process a recorder channel follows the full ``dispatchers`` feed and
+numbers the events it sees with a process-local ``seq``, keeping the last
+``REALTIME_REPLAY_BUFFER_SIZE`` of them. Frames sent to dispatcher sockets
+carry that ``seq`` and the process ``epoch``; a client reconnecting with its
+last ``(epoch, seq)`` is sent only the events it missed, and gets a full
+snapshot only when the gap has left the buffer or it lands on another
+process (a different epoch). The recorder also keeps the process's
+materialized ``initial_data`` (:mod:`core.snapshot`) up to date.
+"""
+import asyncio
+import itertools
+import logging
+import threading
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+_sender_id = uuid.uuid4().hex[:8]
+_event_ids = itertools.count(1)
+
+
+def next_event_id() -> str:
+    """Id of a dispatcher event, unique across processes; all copies of the event share it."""
+    return f'{_sender_id}:{next(_event_ids)}'
+
+
+class ReplayHub:
+    """Process-local event numbering and ring buffer of recent dispatcher events."""
+
+    def __init__(self, size: int = 5000):
+        self.size = size
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self._events: deque = deque(maxlen=size)  # [seq, message]
+        self._by_eid: 'OrderedDict[str, list]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._recorder: Optional[asyncio.Task] = None
+        self._recorder_loop = None
+
+    def record(self, message: Dict[str, Any]) -> int:
+        """Sequence number of a dispatcher message, numbering it if it is new."""
+        eid = message.get('eid')
+        with self._lock:
+            entry = self._by_eid.get(eid) if eid else None
+            if entry is not None:
+                # Keep the full-feed copy rather than a per-sector part of it
+                if entry[1].get('partial') and not message.get('partial'):
+                    entry[1] = message
+                return entry[0]
+            self.seq += 1
+            entry = [self.seq, message]
+            self._events.append(entry)
+            if eid:
+                self._by_eid[eid] = entry
+                while len(self._by_eid) > self.size:
+                    self._by_eid.popitem(last=False)
+            return self.seq
+
+    def since(self, epoch: str, seq: int) -> Optional[List[tuple]]:
+        """
+        ``(seq, message)`` pairs after ``seq``, or None when they can't all be
+        replayed (another epoch, or older than the buffer).
+        """
+        with self._lock:
+            if epoch != self.epoch or seq > self.seq:
+                return None
+            oldest = self._events[0][0] if self._events else self.seq + 1
+            if seq + 1 < oldest:
+                return None
+            return [(s, m) for s, m in self._events if s > seq]
+
+    async def ensure_recorder(self, channel_layer) -> None:
+        """
+        Follow the full dispatcher feed from this process, so events are
+        numbered even while no socket here is connected to receive them.
+        """
+        loop = asyncio.get_running_loop()
+        if self._recorder is not None and not self._recorder.done() and self._recorder_loop is loop:
+            return
+        from .snapshot import get_dispatcher_snapshot
+
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add('dispatchers', channel)
+        # Events may have gone by unseen since the last recorder stopped
+        get_dispatcher_snapshot().invalidate()
+        self._recorder_loop = loop
+        self._recorder = loop.create_task(self._record_forever(channel_layer, channel))
+
+    async def _record_forever(self, channel_layer, channel) -> None:
+        from .snapshot import get_dispatcher_snapshot
+
+        snapshot = get_dispatcher_snapshot()
+        try:
+            while True:
+                try:
+                    message = await channel_layer.receive(channel)
+                    snapshot.apply(self.record(message), message)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Replay recorder failed to receive: {e}", exc_info=True)
+                    await asyncio.sleep(1)
+        finally:
+            try:
+                await channel_layer.group_discard('dispatchers', channel)
+            except Exception:
+                pass
+
+
+def frame_in_area(message: Dict[str, Any], sectors) -> Optional[Dict[str, Any]]:
+    """The part of a recorded full-feed message that concerns ``sectors`` (None = whole city)."""
+    from .frames import message_body
+    from .sectors import sector_of
+
+    if sectors is None:
+        return message
+    if message.get('event') == 'LOCATION_BATCH':
+        locations = message_body(message)['data']['locations']
+        rows = [row for row in locations if sector_of(row[1], row[2]) in sectors]
+        if len(rows) == len(locations):
+            return message
+        return {'type': message['type'], 'event': message['event'], 'data': {'locations': rows}} if rows else None
+    return message if set(message.get('sectors') or ()) & sectors else None
+
+
+_hub: Optional[ReplayHub] = None
+_hub_lock = threading.Lock()
+
+
+def get_replay_hub() -> ReplayHub:
+    global _hub
+    if _hub is None:
+        with _hub_lock:
+            if _hub is None:
+                _hub = ReplayHub(getattr(settings, 'REALTIME_REPLAY_BUFFER_SIZE', 5000))
+    return _hub
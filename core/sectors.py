@@ -0,0 +1,167 @@
+"""
+Geographic sectors for dispatcher subscriptions.
+
+Sectors are geohash cells at ``DISPATCH_SECTOR_PRECISION`` characters
+(5 = roughly 4.9 x 4.9 km). A dispatcher socket may subscribe to a set of
+sectors, given as geohash prefixes or a bounding box, and then joins one
+channel group per sector instead of the city-wide ``dispatchers`` group.
+``core.utils`` sends every located event to ``dispatchers`` (the full
+feed) and to the group of the sector the entity is in. When a unit crosses
+into another sector the event also goes to the sector it left, so that
+dispatcher sees it go.
+"""
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+BASE32_INDEX = {c: i for i, c in enumerate(BASE32)}
+
+SECTOR_GROUP_PREFIX = 'dispatchers_'
+
+
+class SectorError(ValueError):
+    pass
+
+
+def sector_precision() -> int:
+    return getattr(settings, 'DISPATCH_SECTOR_PRECISION', 5)
+
+
+def geohash_encode(lat: float, lng: float, precision: int) -> str:
+    lat_lo, lat_hi, lng_lo, lng_hi = -90.0, 90.0, -180.0, 180.0
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            if lng >= mid:
+                value, lng_lo = (value << 1) | 1, mid
+            else:
+                value, lng_hi = value << 1, mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                value, lat_lo = (value << 1) | 1, mid
+            else:
+                value, lat_hi = value << 1, mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = value = 0
+    return ''.join(chars)
+
+
+def cell_size(precision: int) -> Tuple[float, float]:
+    """Height and width in degrees of a geohash cell."""
+    total = 5 * precision
+    lng_bits = (total + 1) // 2
+    return 180.0 / 2 ** (total - lng_bits), 360.0 / 2 ** lng_bits
+
+
+def sector_of(lat, lng, precision: Optional[int] = None) -> str:
+    return geohash_encode(float(lat), float(lng), precision or sector_precision())
+
+
+def sector_group(sector: str) -> str:
+    return f'{SECTOR_GROUP_PREFIX}{sector}'
+
+
+def sectors_for_prefixes(prefixes: Iterable[str], precision: Optional[int] = None,
+                         limit: Optional[int] = None) -> List[str]:
+    """
+    Sector cells covered by geohash prefixes; shorter prefixes expand to all
+    their cells, longer ones are cut to the sector precision.
+
+    Raises:
+        SectorError: for invalid prefixes or more than ``limit`` cells
+    """
+    precision = precision or sector_precision()
+    limit = limit or getattr(settings, 'DISPATCH_MAX_SECTORS_PER_SOCKET', 1024)
+    cells = set()
+    for prefix in prefixes:
+        prefix = str(prefix).strip().lower()[:precision]
+        if not prefix or any(c not in BASE32_INDEX for c in prefix):
+            raise SectorError(f"Invalid geohash prefix: {prefix!r}")
+        count = 32 ** (precision - len(prefix))
+        if len(cells) + count > limit:
+            raise SectorError(f"Area too large: more than {limit} sectors")
+        level = [prefix]
+        while len(level[0]) < precision:
+            level = [p + c for p in level for c in BASE32]
+        cells.update(level)
+    return sorted(cells)
+
+
+def sectors_for_bbox(south: float, west: float, north: float, east: float,
+                     precision: Optional[int] = None, limit: Optional[int] = None) -> List[str]:
+    """
+    Sector cells intersecting a bounding box (no antimeridian wrap).
+
+    Raises:
+        SectorError: for an invalid box or more than ``limit`` cells
+    """
+    precision = precision or sector_precision()
+    limit = limit or getattr(settings, 'DISPATCH_MAX_SECTORS_PER_SOCKET', 1024)
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        raise SectorError("bbox must be south,west,north,east with south <= north and west <= east")
+    height, width = cell_size(precision)
+    rows = range(math.floor((south + 90) / height), math.floor((min(north, 89.999999) + 90) / height) + 1)
+    cols = range(math.floor((west + 180) / width), math.floor((min(east, 179.999999) + 180) / width) + 1)
+    if len(rows) * len(cols) > limit:
+        raise SectorError(f"Area too large: more than {limit} sectors")
+    return sorted({
+        geohash_encode(-90 + (r + 0.5) * height, -180 + (c + 0.5) * width, precision)
+        for r in rows for c in cols
+    })
+
+
+def entity_position(data: Dict) -> Optional[Tuple[float, float]]:
+    """Position of a serialized ambulance, emergency call or hospital, if it has one."""
+    for lat_key, lng_key in (('current_latitude', 'current_longitude'), ('latitude', 'longitude')):
+        lat, lng = data.get(lat_key), data.get(lng_key)
+        if lat not in (None, '') and lng not in (None, ''):
+            try:
+                return float(lat), float(lng)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+class SectorTracker:
+    """
+    Last sector each entity was announced in (per process, bounded), so an
+    event can also be routed to the sector a unit just left.
+    """
+
+    def __init__(self, max_entities: int = 20000):
+        self.max_entities = max_entities
+        self._last: 'OrderedDict[tuple, str]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def move(self, key: tuple, lat: float, lng: float) -> Tuple[str, Optional[str]]:
+        """Record the entity's sector; returns ``(sector, previous sector if it changed)``."""
+        sector = sector_of(lat, lng)
+        with self._lock:
+            previous = self._last.get(key)
+            self._last[key] = sector
+            self._last.move_to_end(key)
+            while len(self._last) > self.max_entities:
+                self._last.popitem(last=False)
+        return sector, (previous if previous not in (None, sector) else None)
+
+
+_tracker: Optional[SectorTracker] = None
+_tracker_lock = threading.Lock()
+
+
+def get_sector_tracker() -> SectorTracker:
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = SectorTracker()
+    return _tracker
@@ -0,0 +1,218 @@
+"""
+Bounded per-connection send queues.
+
+Consumers hand outgoing frames to their connection's :class:`SendQueue`
+and return at once, so the channel layer is drained at full speed however
+slow the client's link is; one writer task per connection does the socket
+sends. When a client falls behind, position-only frames (``LOCATION_BATCH``)
+are coalesced: rows superseded by a newer frame for the same unit are cut
+from the frames still queued, and frames left empty are discarded.
+Everything else (status changes, new calls, replies) is never dropped; a
+client whose backlog reaches ``REALTIME_SEND_QUEUE_SIZE`` frames with
+nothing left to drop is disconnected (close code 4008) and catches up by
+resuming (:mod:`core.replay`).
+"""
+import asyncio
+import logging
+import threading
+import weakref
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from .frames import message_body
+
+logger = logging.getLogger(__name__)
+
+# Close code for a client too far behind to keep up
+CLOSE_CODE_BACKLOG = 4008
+
+Frame = Tuple[Optional[str], Optional[bytes]]
+
+
+def is_droppable(message: Dict[str, Any]) -> bool:
+    """Whether a channel message only carries positions that a newer one supersedes."""
+    return message.get('type') == 'ambulance_update' and message.get('event') == 'LOCATION_BATCH'
+
+
+class SendQueueMetrics:
+    """Process-wide counters over every connection's send queue."""
+
+    def __init__(self):
+        self._queues: 'weakref.WeakSet[SendQueue]' = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.dropped_rows = 0
+        self.dropped_frames = 0
+        self.backlog_closes = 0
+        self.high_water = 0
+
+    def register(self, queue: 'SendQueue') -> None:
+        with self._lock:
+            self._queues.add(queue)
+
+    def count(self, **increments: int) -> None:
+        with self._lock:
+            for name, value in increments.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def observe_depth(self, depth: int) -> None:
+        if depth > self.high_water:
+            self.high_water = depth
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            depths = [len(q) for q in self._queues if not q.closed]
+        return {
+            'connections': len(depths),
+            'queued': sum(depths),
+            'max_depth': max(depths, default=0),
+            'high_water': self.high_water,
+            'sent': self.sent,
+            'dropped_rows': self.dropped_rows,
+            'dropped_frames': self.dropped_frames,
+            'backlog_closes': self.backlog_closes,
+        }
+
+
+_metrics = SendQueueMetrics()
+
+
+def get_send_queue_metrics() -> SendQueueMetrics:
+    return _metrics
+
+
+class _Entry:
+    __slots__ = ('frame', 'message', 'extra', 'rows')
+
+    def __init__(self, frame: Optional[Frame], message: Optional[Dict[str, Any]] = None,
+                 extra: Optional[Dict[str, Any]] = None):
+        self.frame = frame
+        self.message = message  # set for droppable position frames only
+        self.extra = extra
+        self.rows: Optional['OrderedDict[Any, list]'] = None
+
+    def location_rows(self) -> 'OrderedDict[Any, list]':
+        if self.rows is None:
+            self.rows = OrderedDict((row[0], row) for row in message_body(self.message)['data']['locations'])
+        return self.rows
+
+
+class SendQueue:
+    """
+    Outbound frames of one connection, sent in order by a writer task.
+
+    ``send`` is the consumer's raw ``send(text_data=..., bytes_data=...)``;
+    ``encode`` turns a message into a frame in the connection's encoding
+    (used to re-render a position frame after rows were cut from it).
+    """
+
+    def __init__(self, send: Callable[..., Awaitable[None]], encode: Callable[[Any], Frame], max_size: int = 256):
+        self._send = send
+        self._encode = encode
+        self.max_size = max_size
+        self._entries: deque = deque()
+        self._positions = 0  # queued droppable entries
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.closed = False
+        _metrics.register(self)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._write_forever())
+
+    def close(self) -> None:
+        self.closed = True
+        self._entries.clear()
+        self._positions = 0
+        if self._task is not None:
+            self._task.cancel()
+
+    def put(self, frame: Frame) -> bool:
+        """Queue a frame that must not be dropped; False if the backlog is full."""
+        if self.closed:
+            return True
+        if len(self._entries) >= self.max_size and not self._drop_oldest_position():
+            _metrics.count(backlog_closes=1)
+            return False
+        self._append(_Entry(frame))
+        return True
+
+    def put_positions(self, message: Dict[str, Any], extra: Optional[Dict[str, Any]], frame: Frame) -> None:
+        """Queue a position frame, cutting the rows it supersedes from queued ones."""
+        if self.closed:
+            return
+        entry = _Entry(frame, message, extra)
+        if self._positions:
+            self._supersede(entry.location_rows())
+        if len(self._entries) >= self.max_size and not self._drop_oldest_position():
+            _metrics.count(dropped_frames=1, dropped_rows=len(entry.location_rows()))
+            return
+        self._positions += 1
+        self._append(entry)
+
+    def _append(self, entry: _Entry) -> None:
+        self._entries.append(entry)
+        _metrics.observe_depth(len(self._entries))
+        self._ready.set()
+
+    def _supersede(self, newer: 'OrderedDict[Any, list]') -> None:
+        dropped_rows = dropped_frames = 0
+        for entry in self._entries:
+            if entry.message is None:
+                continue
+            rows = entry.location_rows()
+            superseded = [unit for unit in rows if unit in newer]
+            if superseded:
+                for unit in superseded:
+                    del rows[unit]
+                entry.frame = None
+                dropped_rows += len(superseded)
+                dropped_frames += not rows
+        if dropped_frames:
+            self._entries = deque(e for e in self._entries if e.message is None or e.rows)
+            self._positions -= dropped_frames
+        if dropped_rows:
+            _metrics.count(dropped_rows=dropped_rows, dropped_frames=dropped_frames)
+
+    def _drop_oldest_position(self) -> bool:
+        for entry in self._entries:
+            if entry.message is not None:
+                self._entries.remove(entry)
+                self._positions -= 1
+                _metrics.count(dropped_frames=1, dropped_rows=len(entry.location_rows()))
+                return True
+        return False
+
+    def _render(self, entry: _Entry) -> Frame:
+        if entry.frame is None:
+            message = entry.message
+            entry.frame = self._encode({
+                'type': message['type'],
+                'event': message['event'],
+                'data': {'locations': list(entry.rows.values())},
+                **(entry.extra or {}),
+            })
+        return entry.frame
+
+    async def _write_forever(self) -> None:
+        try:
+            while True:
+                if not self._entries:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                entry = self._entries.popleft()
+                if entry.message is not None:
+                    self._positions -= 1
+                text_data, bytes_data = self._render(entry)
+                await self._send(text_data=text_data, bytes_data=bytes_data)
+                _metrics.count(sent=1)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # The socket is gone; the consumer's disconnect handles the rest
+            logger.debug(f"Send queue writer stopped: {e}")
+            self.close()
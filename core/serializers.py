@@ -44,3 +44,20 @@ class UserSerializer(serializers.ModelSerializer):
         return instance
 
 
+class ParamedicSerializer(UserSerializer):
+    """A paramedic with device presence (``context['presence']``, see core.presence)"""
+    online = serializers.SerializerMethodField()
+    last_seen = serializers.SerializerMethodField()
+
+    class Meta(UserSerializer.Meta):
+        fields = UserSerializer.Meta.fields + ['online', 'last_seen']
+
+    def _presence(self, obj):
+        return self.context.get('presence', {}).get(obj.id) or {}
+
+    def get_online(self, obj):
+        return bool(self._presence(obj).get('online'))
+
+    def get_last_seen(self, obj):
+        last_seen = self._presence(obj).get('last_seen')
+        return last_seen.isoformat() if last_seen else None
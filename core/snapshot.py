@@ -0,0 +1,259 @@
+"""
+Materialized dispatcher snapshot for ``initial_data``.
+
+Each process keeps the active calls, fleet and hospitals in memory and
+applies every event of the full dispatcher feed to them as the replay
+recorder numbers it (:mod:`core.replay`), so the snapshot is always at a
+known stream ``seq``. The whole-city ``initial_data`` frame is rendered at
+most once per change and encoding and then reused, so a dashboard
+connecting costs a copy of cached bytes rather than three queries.
+
+Large boards can also be streamed (:func:`initial_data_chunks`): an
+``initial_data_start`` frame with the counts, then ``initial_data_chunk``
+frames of at most ``REALTIME_INITIAL_CHUNK_ITEMS`` items /
+``REALTIME_INITIAL_CHUNK_BYTES`` bytes each, most urgent first (pending
+CRITICAL/HIGH calls, other active calls, the fleet, hospitals), then
+``initial_data_end``.
+
+The snapshot is rebuilt from the database when it is first needed, when an
+event can't be applied to it (e.g. a delta whose base it doesn't have),
+when the recorder restarts, and every ``REALTIME_SNAPSHOT_MAX_AGE``
+seconds to pick up changes made without an event (e.g. in the admin).
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from .frames import dumps_json, encode_json_frame, message_body, with_fields
+from .utils import entity_version
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_EMERGENCY_STATUSES = ('RECEIVED', 'DISPATCHED', 'EN_ROUTE', 'ON_SCENE', 'TRANSPORTING')
+
+KINDS = ('emergencies', 'ambulances', 'hospitals')
+
+URGENT_PRIORITIES = ('CRITICAL', 'HIGH')
+
+
+class StaleSnapshot(Exception):
+    """An event could not be applied; the snapshot has to be rebuilt."""
+
+
+class DispatcherSnapshot:
+    """Active calls, fleet and hospitals as last seen on the dispatcher feed."""
+
+    def __init__(self, max_age: float = 300):
+        self.max_age = max_age
+        self.seq = 0
+        self.version = 0
+        self._state: Optional[Dict[str, Dict[Any, Dict]]] = None
+        self._closed: set = set()  # calls dropped from the snapshot because they ended
+        self._built_at = 0.0
+        # Events seen while a rebuild is reading the database
+        self._pending: Optional[List[Dict[str, Any]]] = None
+        self._text: Optional[Tuple[int, str]] = None
+        self._frames: Dict[tuple, tuple] = {}
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def is_current(self) -> bool:
+        with self._lock:
+            return self._state is not None and time.monotonic() - self._built_at < self.max_age
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._state = None
+
+    def refresh(self, loader: Callable[[], Dict[str, List[Dict]]]) -> bool:
+        """
+        Rebuild from ``loader`` (which queries the database) unless the
+        snapshot is current. Returns False if it is still not usable.
+        """
+        with self._build_lock:
+            if self.is_current():
+                return True
+            with self._lock:
+                self._pending = []
+            try:
+                loaded = loader()
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                self._state = {kind: {item['id']: item for item in loaded.get(kind, [])} for kind in KINDS}
+                self._closed = set()
+                self._built_at = time.monotonic()
+                pending, self._pending = self._pending, None
+                try:
+                    for message in pending:
+                        self._apply(message)
+                except StaleSnapshot:
+                    self._state = None
+                self.version += 1
+                return self._state is not None
+
+    def apply(self, seq: int, message: Dict[str, Any]) -> None:
+        """Fold one full-feed dispatcher event (numbered ``seq``) into the snapshot."""
+        with self._lock:
+            self.seq = max(self.seq, seq)
+            if self._pending is not None:
+                self._pending.append(message)
+            if self._state is None:
+                return
+            try:
+                self._apply(message)
+            except StaleSnapshot as e:
+                logger.debug(f"Dispatcher snapshot invalidated: {e}")
+                self._state = None
+            self.version += 1
+
+    def _apply(self, message: Dict[str, Any]) -> None:
+        kind = {
+            'emergency_update': 'emergencies',
+            'ambulance_update': 'ambulances',
+            'hospital_update': 'hospitals',
+        }.get(message.get('type'))
+        if kind is None:
+            return
+        body = message_body(message)
+        items = self._state[kind]
+        if message.get('event') == 'UNIT_REMOVED':
+            items.pop((body.get('data') or body['delta'])['id'], None)
+            return
+        if message.get('event') == 'LOCATION_BATCH':
+            for ambulance_id, lat, lng, recorded_at in body['data']['locations']:
+                ambulance = items.get(ambulance_id)
+                if ambulance is None:
+                    raise StaleSnapshot(f"unknown ambulance {ambulance_id}")
+                items[ambulance_id] = {
+                    **ambulance, 'current_latitude': lat, 'current_longitude': lng,
+                    'last_location_update': recorded_at,
+                }
+            return
+        if 'data' in body:
+            data = body['data']
+            current = items.get(data['id'])
+            if kind != 'hospitals' and current is not None and current.get('v', 0) > data.get('v', 0):
+                return
+            self._store(kind, data)
+            return
+        delta = body.get('delta')
+        if not delta:
+            return
+        current = items.get(delta['id'])
+        if current is None:
+            status = delta['changes'].get('status')
+            if kind == 'emergencies' and (
+                (status is not None and status not in ACTIVE_EMERGENCY_STATUSES)
+                or (status is None and delta['id'] in self._closed)
+            ):
+                return
+            raise StaleSnapshot(f"no base for {kind} {delta['id']}")
+        if current.get('v', 0) >= delta['v']:
+            return
+        if current.get('v') != delta['base']:
+            raise StaleSnapshot(f"{kind} {delta['id']} is at {current.get('v')}, delta base {delta['base']}")
+        self._store(kind, {**current, **delta['changes'], 'v': delta['v']})
+
+    def _store(self, kind: str, data: Dict[str, Any]) -> None:
+        if kind == 'emergencies' and data.get('status') not in ACTIVE_EMERGENCY_STATUSES:
+            self._state[kind].pop(data['id'], None)
+            self._closed.add(data['id'])
+            return
+        if kind != 'hospitals' and 'v' not in data:
+            data = {**data, 'v': entity_version(data)}
+        self._state[kind][data['id']] = data
+
+    def contents(self) -> Optional[Tuple[Dict[str, List[Dict]], int, int]]:
+        """``(lists by kind, seq, version)``, or None while the snapshot needs a rebuild."""
+        with self._lock:
+            if self._state is None:
+                return None
+            return self._lists(), self.seq, self.version
+
+    def _lists(self) -> Dict[str, List[Dict]]:
+        lists = {kind: list(self._state[kind].values()) for kind in KINDS}
+        lists['emergencies'].sort(key=lambda e: e.get('received_at') or '', reverse=True)
+        return lists
+
+    def render(self, encoding: str, epoch: str,
+               chunked: bool = False) -> Optional[List[Tuple[Optional[str], Optional[bytes]]]]:
+        """
+        The whole-city ``initial_data`` frames, each ``(text_data, bytes_data)``:
+        one frame, or the streamed sequence when ``chunked``. None while the
+        snapshot needs a rebuild.
+        """
+        with self._lock:
+            if self._state is None:
+                return None
+            key = (encoding, epoch, chunked)
+            cached = self._frames.get(key)
+            if cached is not None and cached[0] == self.version:
+                return cached[1]
+            fields = {'epoch': epoch, 'seq': self.seq, 'version': self.version}
+            if chunked:
+                texts = list(initial_data_chunks(self._lists(), fields))
+            else:
+                if self._text is None or self._text[0] != self.version:
+                    self._text = (self.version, dumps_json({'type': 'initial_data', 'data': self._lists()}))
+                texts = [with_fields(self._text[1], fields)]
+            frames = [encode_json_frame(text, encoding) for text in texts]
+            self._frames[key] = (self.version, frames)
+            return frames
+
+
+def initial_data_chunks(lists: Dict[str, List[Dict]], fields: Dict[str, Any],
+                        max_items: Optional[int] = None, max_bytes: Optional[int] = None) -> Iterator[str]:
+    """
+    JSON texts of a streamed ``initial_data``, most urgent items first;
+    ``fields`` (``epoch``, ``seq``, ...) go on the start and end frames.
+    """
+    max_items = max_items or getattr(settings, 'REALTIME_INITIAL_CHUNK_ITEMS', 200)
+    max_bytes = max_bytes or getattr(settings, 'REALTIME_INITIAL_CHUNK_BYTES', 64 * 1024)
+    urgent, active = [], []
+    for emergency in lists['emergencies']:
+        pending_urgent = emergency.get('status') == 'RECEIVED' and emergency.get('priority') in URGENT_PRIORITIES
+        (urgent if pending_urgent else active).append(emergency)
+    urgent.sort(key=lambda e: URGENT_PRIORITIES.index(e['priority']))
+    groups = (('emergencies', urgent), ('emergencies', active),
+              ('ambulances', lists['ambulances']), ('hospitals', lists['hospitals']))
+
+    yield dumps_json({'type': 'initial_data_start', **fields, 'counts': {kind: len(lists[kind]) for kind in KINDS}})
+    index = 0
+    for kind, items in groups:
+        batch, size = [], 0
+        for item in items:
+            text = dumps_json(item)
+            if batch and (len(batch) >= max_items or size + len(text) > max_bytes):
+                yield _chunk_text(index, kind, batch)
+                index += 1
+                batch, size = [], 0
+            batch.append(text)
+            size += len(text) + 1
+        if batch:
+            yield _chunk_text(index, kind, batch)
+            index += 1
+    yield dumps_json({'type': 'initial_data_end', **fields, 'chunks': index})
+
+
+def _chunk_text(index: int, kind: str, items: List[str]) -> str:
+    # Items are already JSON; splice them in rather than encoding them again
+    return f'{{"type":"initial_data_chunk","index":{index},"kind":"{kind}","items":[{",".join(items)}]}}'
+
+
+_snapshot: Optional[DispatcherSnapshot] = None
+_snapshot_lock = threading.Lock()
+
+
+def get_dispatcher_snapshot() -> DispatcherSnapshot:
+    global _snapshot
+    if _snapshot is None:
+        with _snapshot_lock:
+            if _snapshot is None:
+                _snapshot = DispatcherSnapshot(getattr(settings, 'REALTIME_SNAPSHOT_MAX_AGE', 300))
+    return _snapshot
@@ -1,3 +1,815 @@
-from django.test import TestCase
+import asyncio
+import threading
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync as real_async_to_sync
+from channels.layers import get_channel_layer
+
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import outbox
+from .frames import (
+    FLAG_DEFLATE,
+    FLAG_MSGPACK,
+    EncodedFramesMixin,
+    FrameCache,
+    decode_frame,
+    dumps_json,
+    encode_frame,
+    encode_json_frame,
+    loads_json,
+    message_body,
+    negotiate_encoding,
+    pre_encode,
+    supported_encodings,
+    with_fields,
+)
+from .models import OutboxEvent, User
+from .outbox import enqueue_ambulance_notification
+from .presence import PresenceRegistry, RedisPresenceRegistry
+from .replay import ReplayHub, frame_in_area, next_event_id
+from .sectors import (
+    SectorError,
+    SectorTracker,
+    cell_size,
+    geohash_encode,
+    sector_of,
+    sectors_for_bbox,
+    sectors_for_prefixes,
+)
+from .sendqueue import CLOSE_CODE_BACKLOG, SendQueue, get_send_queue_metrics
+from .snapshot import DispatcherSnapshot, initial_data_chunks
+from .utils import (
+    DeltaTracker,
+    LocationCoalescer,
+    asend_channel_notification,
+    asend_emergency_notification,
+    asend_location_notification,
+    build_group_messages,
+    entity_version,
+    send_channel_notification,
+    send_location_notification,
+    with_version,
+)
+
+
+class LocationCoalescerTests(SimpleTestCase):
+    """Per-unit coalescing of location rows into one frame per tick"""
+
+    @mock.patch.object(LocationCoalescer, '_ensure_ticker')
+    def test_one_row_per_unit_per_frame(self, _):
+        coalescer = LocationCoalescer(interval=60)
+        for second in range(10):
+            coalescer.add([[unit, 8.4 + second / 100, -13.2, f'2026-10-18T10:00:{second:02d}+00:00']
+                           for unit in (1, 2, 3)])
+        with mock.patch('core.utils._send_location_batch') as send:
+            self.assertEqual(coalescer.flush(), 3)
+            self.assertEqual(coalescer.flush(), 0)
+        send.assert_called_once()
+        self.assertEqual([row[1] for row in send.call_args.args[0]], [8.49] * 3)
+        self.assertEqual(coalescer.stats(), {'interval': 60, 'pending': 0, 'received': 30, 'frames': 1, 'rows_sent': 3})
+
+    @mock.patch.object(LocationCoalescer, '_ensure_ticker')
+    def test_newest_fix_across_offsets(self, _):
+        coalescer = LocationCoalescer(interval=60)
+        newer = [1, 8.5, -13.25, '2026-10-18T10:00:00+00:00']
+        # 10:30 in UTC+01:00 is 09:30 UTC, but sorts after newer as a string
+        older = [1, 8.4, -13.2, '2026-10-18T10:30:00+01:00']
+        coalescer.add([newer])
+        coalescer.add([older])
+        with mock.patch('core.utils._send_location_batch') as send:
+            coalescer.flush()
+        send.assert_called_once_with([newer])
+
+    def test_ticker_sends_pending_rows(self):
+        coalescer = LocationCoalescer(interval=0.01)
+        sent = threading.Event()
+        with mock.patch('core.utils._send_location_batch', side_effect=lambda rows: sent.set()) as send:
+            coalescer.add([[1, 8.4, -13.2, '2026-10-18T10:00:00+00:00']])
+            self.assertTrue(sent.wait(5))
+            coalescer._ticker.stop()
+        send.assert_called_once_with([[1, 8.4, -13.2, '2026-10-18T10:00:00+00:00']])
+
+    def test_zero_interval_sends_immediately(self):
+        row = [1, 8.4, -13.2, '2026-10-18T10:00:00+00:00']
+        coalescer = LocationCoalescer(interval=0)
+        with mock.patch('core.utils.get_location_coalescer', return_value=coalescer), \
+                mock.patch('core.utils._send_location_batch') as send:
+            send_location_notification([row])
+        send.assert_called_once_with([row])
+        self.assertIsNone(coalescer._ticker)
+
+    @mock.patch.object(LocationCoalescer, '_ensure_ticker')
+    async def test_async_path_only_buffers(self, _):
+        coalescer = LocationCoalescer(interval=60)
+        with mock.patch('core.utils.get_location_coalescer', return_value=coalescer), \
+                mock.patch('core.utils.asend_channel_notification') as send:
+            await asend_location_notification([[1, 8.4, -13.2, '2026-10-18T10:00:00+00:00']])
+        send.assert_not_called()
+        self.assertEqual(coalescer.stats()['pending'], 1)
+
+
+class DeltaTrackerTests(SimpleTestCase):
+    """Updates go out as the fields that changed since the last frame"""
+
+    def ambulance(self, status='AVAILABLE', minute=0, **fields):
+        return {'id': 7, 'unit_number': 'AMB-007', 'status': status,
+                'updated_at': f'2026-10-18T10:{minute:02d}:00+00:00', **fields}
+
+    def test_full_then_delta(self):
+        tracker = DeltaTracker()
+        first = tracker.frame('ambulance', self.ambulance())
+        version = entity_version(self.ambulance())
+        self.assertEqual(first, {'data': {**self.ambulance(), 'v': version}})
+        second = tracker.frame('ambulance', self.ambulance('DISPATCHED', minute=1))
+        self.assertEqual(second, {'delta': {
+            'id': 7, 'v': version + 60000, 'base': version,
+            'changes': {'status': 'DISPATCHED', 'updated_at': '2026-10-18T10:01:00+00:00'},
+        }})
+
+    def test_kinds_are_tracked_apart(self):
+        tracker = DeltaTracker()
+        tracker.frame('ambulance', self.ambulance())
+        self.assertIn('data', tracker.frame('emergency', self.ambulance()))
+
+    def test_evicted_or_forgotten_entity_goes_out_in_full(self):
+        tracker = DeltaTracker(max_entities=1)
+        tracker.frame('ambulance', self.ambulance())
+        tracker.frame('ambulance', {**self.ambulance(), 'id': 8})
+        self.assertIn('data', tracker.frame('ambulance', self.ambulance(minute=1)))
+        tracker.forget('ambulance', 7)
+        self.assertIn('data', tracker.frame('ambulance', self.ambulance(minute=2)))
+
+    def test_setting_turns_deltas_off(self):
+        tracker = DeltaTracker()
+        tracker.frame('ambulance', self.ambulance())
+        with mock.patch('core.utils.get_delta_tracker', return_value=tracker), \
+                override_settings(REALTIME_DELTA_FRAMES=False, DISPATCH_SECTORS_ENABLED=False):
+            (_, message), = build_group_messages('dispatchers', 'ambulance_update', 'UPDATED',
+                                                 self.ambulance(minute=1), entity_kind='ambulance')
+        self.assertEqual(message_body(message)['data'], self.ambulance(minute=1))
+
+
+@override_settings(REALTIME_COMPRESS_MIN_BYTES=256)
+class FrameEncodingTests(SimpleTestCase):
+    """Negotiated encodings round-trip through decode_frame"""
+
+    message = {'type': 'ambulance_update', 'event': 'LOCATION_BATCH',
+               'data': {'locations': [[i, 8.48, -13.23, '2026-10-18T10:00:00+00:00'] for i in range(20)]}}
+
+    def test_negotiation(self):
+        for scope, expected in (
+            ({'subprotocols': ['ambulance.brotli', 'ambulance.msgpack', 'ambulance.json']},
+             ('msgpack', 'ambulance.msgpack')),
+            ({'subprotocols': ['graphql-ws'], 'query_string': b'encoding=json+deflate'}, ('json+deflate', None)),
+            ({'query_string': b'encoding=msgpack%2Bdeflate'}, ('msgpack+deflate', None)),
+            ({'query_string': b'encoding=xml'}, ('json', None)),
+            ({}, ('json', None)),
+        ):
+            self.assertEqual(negotiate_encoding(scope), expected)
+
+    def test_round_trip(self):
+        small = {'type': 'pong'}
+        for encoding in supported_encodings():
+            for message in (small, self.message):
+                text_data, bytes_data = encode_frame(message, encoding)
+                self.assertEqual(decode_frame(text_data, bytes_data), message)
+                if encoding == 'json':
+                    self.assertIsNone(bytes_data)
+                else:
+                    self.assertIsNone(text_data)
+                    compressed = encoding.endswith('+deflate') and message is self.message
+                    self.assertEqual(bytes_data[0] & FLAG_DEFLATE, FLAG_DEFLATE if compressed else 0)
+                    self.assertEqual(bool(bytes_data[0] & FLAG_MSGPACK), encoding.startswith('msgpack'))
+
+    def test_pre_encoded_text_in_any_encoding(self):
+        text = dumps_json(self.message)
+        for encoding in supported_encodings():
+            self.assertEqual(decode_frame(*encode_json_frame(text, encoding)), self.message)
+
+    def test_malformed_frames(self):
+        for bytes_data in (b'', bytes([FLAG_DEFLATE]) + b'not zlib', bytes([0]) + b'{"a":'):
+            with self.assertRaises(ValueError):
+                decode_frame(None, bytes_data)
+
+
+class SharedFrameTests(SimpleTestCase):
+    """Broadcast frames are encoded once by the sender and rendered once per encoding"""
+
+    unit = {'id': 1, 'status': 'EN_ROUTE', 'current_latitude': '8.480000', 'current_longitude': '-13.230000',
+            'updated_at': '2026-10-18T10:00:00+00:00'}
+
+    def test_messages_carry_their_frame(self):
+        with mock.patch('core.sectors._tracker', SectorTracker()):
+            messages = build_group_messages('dispatchers', 'ambulance_update', 'UPDATED', self.unit, paramedic_id=5)
+        (_, dispatchers), (_, sector), (_, paramedic) = messages
+        # The sector group shares the full-feed message; the paramedic gets its own
+        self.assertIs(sector, dispatchers)
+        self.assertEqual(dispatchers['fid'], f"{dispatchers['eid']}.0")
+        self.assertNotIn('fid', paramedic)
+        for message in (dispatchers, paramedic):
+            self.assertNotIn('data', message)
+            self.assertEqual(loads_json(message['frame']),
+                             {'type': 'ambulance_update', 'event': 'UPDATED', 'data': self.unit})
+
+    def test_sector_copies_get_their_own_frame_ids(self):
+        rows = [[1, 8.48, -13.23, '2026-10-18T10:00:00+00:00'], [2, 8.60, -13.23, '2026-10-18T10:00:00+00:00']]
+        with mock.patch('core.sectors._tracker', SectorTracker()):
+            messages = build_group_messages('dispatchers', 'ambulance_update', 'LOCATION_BATCH',
+                                            {'locations': rows})
+        fids = [message['fid'] for _, message in messages]
+        self.assertEqual(len(set(fids)), 3)
+        self.assertTrue(all(message['partial'] for _, message in messages[1:]))
+
+    def test_pre_encode_is_idempotent(self):
+        message = pre_encode({'type': 'hospital_update', 'event': 'CAPACITY_UPDATE', 'data': {'id': 2}}, 'x:1.0')
+        self.assertEqual(pre_encode(dict(message), 'x:2.0'), message)
+        self.assertEqual(message_body(message), {'type': 'hospital_update', 'event': 'CAPACITY_UPDATE',
+                                                 'data': {'id': 2}})
+
+    def test_frame_cache(self):
+        cache = FrameCache(size=2)
+        message = pre_encode({'type': 'ambulance_update', 'event': 'UPDATED', 'data': self.unit}, 'x:1.0')
+        extra = {'seq': 4, 'epoch': 'e'}
+        first = cache.render(message, 'json', extra)
+        self.assertEqual(loads_json(first[0]), {**message_body(message), **extra})
+        self.assertIs(cache.render(message, 'json', extra), first)
+        cache.render(message, 'json+deflate', extra)
+        cache.render(message, 'json', {'seq': 5, 'epoch': 'e'})
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 1, 'misses': 3})
+        # Evicted, rendered again
+        self.assertIsNot(cache.render(message, 'json', extra), first)
+        # Messages without a frame id are rendered every time and not kept
+        cache.render(pre_encode({'type': 'pong'}), 'json')
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 1, 'misses': 5})
+
+    def test_with_fields(self):
+        self.assertEqual(with_fields('{"a":1}', {'seq': 2}), '{"a":1,"seq":2}')
+        self.assertEqual(with_fields('{"a":1}', {}), '{"a":1}')
+
+
+@override_settings(DISPATCH_SECTORS_ENABLED=False)
+class DispatcherSnapshotTests(SimpleTestCase):
+    """The materialized initial data follows the dispatcher feed"""
+
+    def setUp(self):
+        self.tracker = DeltaTracker()
+        self.call = {'id': 1, 'status': 'RECEIVED', 'priority': 'HIGH', 'received_at': '2026-10-18T09:00:00+00:00',
+                     'updated_at': '2026-10-18T10:00:00+00:00'}
+        self.unit = {'id': 7, 'status': 'AVAILABLE', 'current_latitude': '8.480000',
+                     'current_longitude': '-13.230000', 'updated_at': '2026-10-18T10:00:00+00:00'}
+        self.snapshot = DispatcherSnapshot()
+        self.seq = 0
+        # The tracker has sent both before, so updates go out as deltas
+        self.tracker.frame('emergency', self.call)
+        self.tracker.frame('ambulance', self.unit)
+        self.snapshot.refresh(lambda: {'emergencies': [with_version(self.call)],
+                                       'ambulances': [with_version(self.unit)], 'hospitals': []})
+
+    def send(self, message_type, event, data, kind=None):
+        with mock.patch('core.utils.get_delta_tracker', return_value=self.tracker):
+            (_, message), = build_group_messages('dispatchers', message_type, event, data, entity_kind=kind)
+        self.seq += 1
+        self.snapshot.apply(self.seq, message)
+
+    def lists(self):
+        contents = self.snapshot.contents()
+        return contents and contents[0]
+
+    def test_deltas_and_locations_are_applied(self):
+        self.send('ambulance_update', 'UNIT_DISPATCHED',
+                  {**self.unit, 'status': 'DISPATCHED', 'updated_at': '2026-10-18T10:01:00+00:00'}, 'ambulance')
+        self.send('ambulance_update', 'LOCATION_BATCH', {'locations': [[7, 8.5, -13.2, '2026-10-18T10:02:00Z']]})
+        unit, = self.lists()['ambulances']
+        self.assertEqual((unit['status'], unit['current_latitude'], unit['last_location_update']),
+                         ('DISPATCHED', 8.5, '2026-10-18T10:02:00Z'))
+        self.assertEqual(unit['v'], entity_version({'updated_at': '2026-10-18T10:01:00+00:00'}))
+        self.assertEqual(self.snapshot.contents()[1:], (2, 3))
+
+    def test_ended_call_leaves_and_stays_gone(self):
+        done = {**self.call, 'status': 'COMPLETED', 'updated_at': '2026-10-18T10:05:00+00:00'}
+        self.send('emergency_update', 'STATUS_UPDATE', done, 'emergency')
+        self.assertEqual(self.lists()['emergencies'], [])
+        self.send('emergency_update', 'UPDATED', {**done, 'updated_at': '2026-10-18T10:06:00+00:00'}, 'emergency')
+        self.assertEqual(self.lists()['emergencies'], [])
+
+    def test_older_full_frame_is_ignored(self):
+        self.send('ambulance_update', 'UPDATED', {**self.unit, 'status': 'DISPATCHED',
+                                                  'updated_at': '2026-10-18T10:01:00+00:00'}, 'ambulance')
+        self.tracker.forget('ambulance', 7)
+        self.send('ambulance_update', 'UPDATED', {**self.unit, 'status': 'OUT_OF_SERVICE'}, 'ambulance')
+        self.assertEqual(self.lists()['ambulances'][0]['status'], 'DISPATCHED')
+
+    def test_unusable_events_invalidate(self):
+        # A delta whose base the snapshot doesn't have
+        self.tracker.frame('ambulance', {**self.unit, 'updated_at': '2026-10-18T10:01:00+00:00'})
+        self.send('ambulance_update', 'UPDATED', {**self.unit, 'updated_at': '2026-10-18T10:02:00+00:00'},
+                  'ambulance')
+        self.assertIsNone(self.snapshot.contents())
+        self.assertIsNone(self.snapshot.render('json', 'e'))
+        self.snapshot.refresh(lambda: {'ambulances': [with_version(self.unit)]})
+        self.send('ambulance_update', 'LOCATION_BATCH', {'locations': [[8, 8.5, -13.2, '2026-10-18T10:02:00Z']]})
+        self.assertIsNone(self.snapshot.contents())
+
+    def test_events_during_a_rebuild_are_applied_after_it(self):
+        self.snapshot.invalidate()
+
+        def loader():
+            self.send('ambulance_update', 'UNIT_DISPATCHED',
+                      {**self.unit, 'status': 'DISPATCHED', 'updated_at': '2026-10-18T10:01:00+00:00'}, 'ambulance')
+            return {'ambulances': [with_version(self.unit)]}
+
+        self.assertTrue(self.snapshot.refresh(loader))
+        self.assertEqual(self.lists()['ambulances'][0]['status'], 'DISPATCHED')
+
+    def test_render_is_cached_per_version(self):
+        frames = self.snapshot.render('json', 'e')
+        self.assertIs(self.snapshot.render('json', 'e'), frames)
+        frame = loads_json(frames[0][0])
+        self.assertEqual((frame['type'], frame['epoch'], frame['seq'], frame['version']), ('initial_data', 'e', 0, 1))
+        self.assertEqual(frame['data'], self.lists())
+        self.send('hospital_update', 'CAPACITY_UPDATE', {'id': 3, 'available_beds': 4})
+        self.assertEqual(loads_json(self.snapshot.render('json', 'e')[0][0])['data']['hospitals'],
+                         [{'id': 3, 'available_beds': 4}])
+
+    def test_max_age(self):
+        self.assertTrue(self.snapshot.is_current())
+        self.assertFalse(DispatcherSnapshot(max_age=0).is_current())
+
+
+class InitialDataChunkTests(SimpleTestCase):
+    """Streamed initial data: most urgent first, in bounded chunks"""
+
+    def lists(self):
+        calls = [{'id': i, 'status': status, 'priority': priority}
+                 for i, (status, priority) in enumerate([('EN_ROUTE', 'CRITICAL'), ('RECEIVED', 'LOW'),
+                                                         ('RECEIVED', 'HIGH'), ('RECEIVED', 'CRITICAL')])]
+        return {'emergencies': calls, 'ambulances': [{'id': i} for i in range(5)], 'hospitals': [{'id': 1}]}
+
+    def frames(self, **limits):
+        return [loads_json(text) for text in initial_data_chunks(self.lists(), {'epoch': 'e', 'seq': 3}, **limits)]
+
+    def test_order_and_framing(self):
+        start, *chunks, end = self.frames(max_items=2)
+        self.assertEqual(start, {'type': 'initial_data_start', 'epoch': 'e', 'seq': 3,
+                                 'counts': {'emergencies': 4, 'ambulances': 5, 'hospitals': 1}})
+        self.assertEqual(end, {'type': 'initial_data_end', 'epoch': 'e', 'seq': 3, 'chunks': len(chunks)})
+        self.assertEqual([c['index'] for c in chunks], list(range(len(chunks))))
+        self.assertTrue(all(len(c['items']) <= 2 for c in chunks))
+        order = [(c['kind'], item['id']) for c in chunks for item in c['items']]
+        # Pending CRITICAL then HIGH calls, the other active calls, the fleet, hospitals
+        self.assertEqual(order[:4], [('emergencies', 3), ('emergencies', 2), ('emergencies', 0), ('emergencies', 1)])
+        self.assertEqual(order[4:], [('ambulances', i) for i in range(5)] + [('hospitals', 1)])
+        # Chunks hold one kind each
+        self.assertEqual([c['kind'] for c in chunks],
+                         ['emergencies', 'emergencies', 'ambulances', 'ambulances', 'ambulances', 'hospitals'])
+
+    def test_byte_limit(self):
+        _, *chunks, _ = self.frames(max_items=100, max_bytes=20)
+        # Two {"id":n} items fit in 20 bytes; a larger call still goes out, alone
+        self.assertEqual([len(c['items']) for c in chunks], [1, 1, 1, 1, 2, 2, 1, 1])
+        self.assertEqual(sum(len(c['items']) for c in chunks), 10)
+
+
+class SendQueueTests(SimpleTestCase):
+    """Slow clients: superseded positions are dropped, everything else is kept or the socket closed"""
+
+    def make_queue(self, max_size=8):
+        self.sent = []
+
+        async def send(text_data=None, bytes_data=None):
+            self.sent.append(loads_json(text_data))
+
+        return SendQueue(send, lambda message: encode_frame(message, 'json'), max_size)
+
+    def put_positions(self, queue, seq, *units):
+        message = pre_encode({'type': 'ambulance_update', 'event': 'LOCATION_BATCH',
+                              'data': {'locations': [[unit, seq, -13.2, 't'] for unit in units]}})
+        extra = {'seq': seq}
+        queue.put_positions(message, extra, encode_frame({**message_body(message), **extra}, 'json'))
+
+    def put(self, queue, message):
+        return queue.put(encode_frame(message, 'json'))
+
+    async def drain(self, queue):
+        queue.start()
+        while len(queue):
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        queue.close()
+        return [(f.get('event') or f['type'], [row[0] for row in f['data']['locations']] if 'data' in f else None,
+                 f.get('seq')) for f in self.sent]
+
+    def metrics(self, before):
+        after = get_send_queue_metrics().stats()
+        return {key: after[key] - before[key] for key in ('dropped_rows', 'dropped_frames', 'backlog_closes')}
+
+    async def test_superseded_rows_are_cut(self):
+        before = get_send_queue_metrics().stats()
+        queue = self.make_queue()
+        self.put_positions(queue, 1, 1, 2)
+        self.put(queue, {'type': 'pong'})
+        self.put_positions(queue, 2, 1)
+        # The first frame lost unit 1's row and is rendered again, keeping its own seq
+        self.assertEqual(await self.drain(queue), [('LOCATION_BATCH', [2], 1), ('pong', None, None),
+                                                   ('LOCATION_BATCH', [1], 2)])
+        self.assertEqual(self.sent[0]['data']['locations'], [[2, 1, -13.2, 't']])
+        self.assertEqual(self.metrics(before), {'dropped_rows': 1, 'dropped_frames': 0, 'backlog_closes': 0})
+
+    async def test_fully_superseded_frame_is_discarded(self):
+        before = get_send_queue_metrics().stats()
+        queue = self.make_queue()
+        self.put_positions(queue, 1, 1)
+        self.put_positions(queue, 2, 2)
+        self.put_positions(queue, 3, 1, 2)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(await self.drain(queue), [('LOCATION_BATCH', [1, 2], 3)])
+        self.assertEqual(self.metrics(before), {'dropped_rows': 2, 'dropped_frames': 2, 'backlog_closes': 0})
+
+    async def test_oldest_position_frame_makes_room(self):
+        queue = self.make_queue(max_size=2)
+        self.put_positions(queue, 1, 1)
+        self.assertTrue(self.put(queue, {'type': 'pong', 'n': 1}))
+        self.assertTrue(self.put(queue, {'type': 'pong', 'n': 2}))
+        # Full of frames that can't be dropped: a new position frame is the one lost
+        self.put_positions(queue, 2, 2)
+        self.assertEqual(await self.drain(queue), [('pong', None, None), ('pong', None, None)])
+
+    async def test_full_backlog(self):
+        before = get_send_queue_metrics().stats()
+        queue = self.make_queue(max_size=2)
+        self.assertTrue(self.put(queue, {'type': 'pong'}))
+        self.assertTrue(self.put(queue, {'type': 'pong'}))
+        self.assertFalse(self.put(queue, {'type': 'pong'}))
+        self.assertEqual(self.metrics(before)['backlog_closes'], 1)
+        queue.close()
+        # Frames for a closed connection are discarded quietly
+        self.assertTrue(self.put(queue, {'type': 'pong'}))
+        self.assertEqual(len(queue), 0)
+
+    async def test_full_backlog_closes_the_socket(self):
+        class Consumer(EncodedFramesMixin):
+            close_code = None
+
+            async def send(self, text_data=None, bytes_data=None):
+                pass
+
+            async def close(self, code=None):
+                self.close_code = code
+
+        consumer = Consumer()
+        # Never started, like a writer stuck on a slow link
+        consumer.send_queue = SendQueue(consumer.send, lambda message: encode_frame(message, 'json'), 1)
+        await consumer.send_frame({'type': 'pong'})
+        self.assertIsNone(consumer.close_code)
+        with self.assertLogs('core.frames', 'WARNING'):
+            await consumer.send_frame({'type': 'pong'})
+        self.assertEqual(consumer.close_code, CLOSE_CODE_BACKLOG)
+        self.assertTrue(consumer.send_queue.closed)
+
+
+class ReplayHubTests(SimpleTestCase):
+    """Event numbering and the replay window"""
+
+    def test_each_event_is_numbered_once(self):
+        hub = ReplayHub(size=10)
+        partial = {'eid': 'a:1', 'event': 'LOCATION_BATCH', 'partial': True}
+        full = {'eid': 'a:1', 'event': 'LOCATION_BATCH'}
+        self.assertEqual(hub.record(partial), 1)
+        # The full-feed copy of the same event keeps its number and replaces the part
+        self.assertEqual(hub.record(full), 1)
+        self.assertEqual(hub.record({'eid': 'a:2'}), 2)
+        self.assertEqual(hub.since(hub.epoch, 0), [(1, full), (2, {'eid': 'a:2'})])
+
+    def test_gaps_that_cannot_be_replayed(self):
+        hub = ReplayHub(size=3)
+        for i in range(5):
+            hub.record({'eid': f'a:{i}'})
+        self.assertEqual([seq for seq, _ in hub.since(hub.epoch, 2)], [3, 4, 5])
+        self.assertEqual(hub.since(hub.epoch, 5), [])
+        self.assertIsNone(hub.since(hub.epoch, 1))
+        self.assertIsNone(hub.since(hub.epoch, 6))
+        self.assertIsNone(hub.since('another-epoch', 4))
+
+    def test_event_ids_are_unique(self):
+        self.assertEqual(len({next_event_id() for _ in range(100)}), 100)
+
+
+@override_settings(DISPATCH_SECTOR_PRECISION=5, DISPATCH_MAX_SECTORS_PER_SOCKET=1024)
+class SectorTests(SimpleTestCase):
+    """Geohash sectors and routing of dispatcher events to them"""
+
+    def test_geohash(self):
+        self.assertEqual(geohash_encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(sector_of(8.48, -13.23), 'e9w84')
+        self.assertEqual(cell_size(5), (180 / 2 ** 12, 360 / 2 ** 13))
+
+    def test_prefixes(self):
+        self.assertEqual(sectors_for_prefixes(['E9W84ZZ']), ['e9w84'])
+        cells = sectors_for_prefixes(['e9w8'])
+        self.assertEqual(len(cells), 32)
+        self.assertTrue(all(c.startswith('e9w8') for c in cells))
+        for prefixes in (['e9wa'], [''], ['e9w'], ['e9w8', 'e9w9'] * 20):
+            with self.assertRaises(SectorError):
+                sectors_for_prefixes(prefixes, limit=63)
+
+    def test_bbox(self):
+        self.assertEqual(sectors_for_bbox(8.47, -13.24, 8.49, -13.22), ['e9w84', 'e9w85', 'e9w86', 'e9w87'])
+        # A point is a one-cell box
+        self.assertEqual(sectors_for_bbox(8.48, -13.23, 8.48, -13.23), ['e9w84'])
+        with self.assertRaises(SectorError):
+            sectors_for_bbox(8.49, -13.24, 8.47, -13.22)
+        with self.assertRaises(SectorError):
+            sectors_for_bbox(0, 0, 10, 10)
+
+    def test_tracker_reports_the_sector_left(self):
+        tracker = SectorTracker(max_entities=1)
+        self.assertEqual(tracker.move(('ambulance', 1), 8.48, -13.23), ('e9w84', None))
+        self.assertEqual(tracker.move(('ambulance', 1), 8.481, -13.231), ('e9w84', None))
+        self.assertEqual(tracker.move(('ambulance', 1), 8.60, -13.23), ('e9w8f', 'e9w84'))
+        tracker.move(('ambulance', 2), 8.48, -13.23)
+        # Evicted: nothing to leave
+        self.assertEqual(tracker.move(('ambulance', 1), 8.48, -13.23), ('e9w84', None))
+
+    def test_unit_crossing_sectors(self):
+        unit = {'id': 1, 'status': 'EN_ROUTE', 'current_latitude': '8.480000', 'current_longitude': '-13.230000',
+                'updated_at': '2026-10-18T10:00:00+00:00'}
+        moved = {**unit, 'current_latitude': '8.600000', 'updated_at': '2026-10-18T10:01:00+00:00'}
+        with mock.patch('core.sectors._tracker', SectorTracker()), \
+                mock.patch('core.utils.get_delta_tracker', return_value=DeltaTracker()):
+            build_group_messages('dispatchers', 'ambulance_update', 'UPDATED', unit, entity_kind='ambulance')
+            messages = build_group_messages('dispatchers', 'ambulance_update', 'UPDATED', moved,
+                                            entity_kind='ambulance')
+        groups = {group: message for group, message in messages}
+        self.assertEqual(list(groups), ['dispatchers', 'dispatchers_e9w8f', 'dispatchers_e9w84'])
+        self.assertEqual(groups['dispatchers']['sectors'], ['e9w8f', 'e9w84'])
+        # The sector entered may not know the unit yet, so it gets all of it
+        self.assertEqual(message_body(groups['dispatchers_e9w8f'])['data']['current_latitude'], '8.600000')
+        self.assertIn('delta', message_body(groups['dispatchers_e9w84']))
+
+    def test_location_batch_split_by_sector(self):
+        rows = [[1, 8.48, -13.23, '2026-10-18T10:00:00+00:00'], [2, 8.60, -13.23, '2026-10-18T10:00:00+00:00']]
+        with mock.patch('core.sectors._tracker', SectorTracker()):
+            messages = build_group_messages('dispatchers', 'ambulance_update', 'LOCATION_BATCH',
+                                            {'locations': rows})
+        self.assertEqual({group: message_body(m)['data']['locations'] for group, m in messages}, {
+            'dispatchers': rows, 'dispatchers_e9w84': rows[:1], 'dispatchers_e9w8f': rows[1:],
+        })
+        self.assertEqual(frame_in_area(messages[0][1], {'e9w8f'})['data']['locations'], rows[1:])
+        self.assertIsNone(frame_in_area(messages[0][1], {'e9w85'}))
+
+
+@override_settings(DISPATCH_SECTORS_ENABLED=False,
+                   CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class AsyncNotificationTests(SimpleTestCase):
+    """Notifications reach every target group with one send each"""
+
+    emergency = {'id': 3, 'call_id': 'EMG-3', 'status': 'DISPATCHED', 'updated_at': '2026-10-18T10:00:00+00:00'}
+
+    async def subscribe(self, *groups):
+        layer = get_channel_layer()
+        channels = []
+        for group in groups:
+            channels.append(await layer.new_channel())
+            await layer.group_add(group, channels[-1])
+        return layer, channels
+
+    async def test_dispatchers_and_paramedic(self):
+        layer, (dispatcher, paramedic) = await self.subscribe('dispatchers', 'paramedic_5')
+        with mock.patch('core.utils.get_delta_tracker', return_value=DeltaTracker()):
+            await asend_emergency_notification('STATUS_UPDATE', self.emergency, paramedic_id=5)
+        self.assertEqual(message_body(await layer.receive(dispatcher))['data'],
+                         {**self.emergency, 'v': entity_version(self.emergency)})
+        # The personal channel gets the payload as given
+        self.assertEqual(message_body(await layer.receive(paramedic)),
+                         {'type': 'emergency_update', 'event': 'STATUS_UPDATE', 'data': self.emergency})
+
+    async def test_failed_group_does_not_stop_the_others(self):
+        layer, (dispatcher,) = await self.subscribe('dispatchers')
+        group_send = layer.group_send
+
+        async def flaky_group_send(group, message):
+            if group == 'paramedic_5':
+                raise RuntimeError('layer down')
+            await group_send(group, message)
+
+        with mock.patch.object(layer, 'group_send', flaky_group_send), \
+                self.assertLogs('core.utils', 'WARNING') as logs:
+            await asend_channel_notification('dispatchers', 'emergency_update', 'STATUS_UPDATE',
+                                             self.emergency, paramedic_id=5)
+        self.assertEqual(message_body(await layer.receive(dispatcher))['event'], 'STATUS_UPDATE')
+        self.assertIn('paramedic_5', logs.output[0])
+
+    def test_sync_shim_bridges_once_per_event(self):
+        bridges = []
+
+        def async_to_sync(fn):
+            bridges.append(fn)
+            return real_async_to_sync(fn)
+
+        layer = get_channel_layer()
+        with mock.patch('asgiref.sync.async_to_sync', async_to_sync), \
+                mock.patch.object(layer, 'group_send', new=mock.AsyncMock()) as group_send:
+            send_channel_notification('dispatchers', 'emergency_update', 'STATUS_UPDATE',
+                                      self.emergency, paramedic_id=5)
+        self.assertEqual(len(bridges), 1)
+        self.assertEqual([c.args[0] for c in group_send.await_args_list], ['dispatchers', 'paramedic_5'])
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_notifications', events=5, receivers=2, stdout=out)
+        self.assertEqual([line.split(':')[0].strip() for line in out.getvalue().splitlines()[1:]],
+                         ['legacy sync', 'sync shim', 'async await'])
+
+
+@override_settings(OUTBOX_RELAY_IN_PROCESS=False,
+                   CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class OutboxRelayTests(TransactionTestCase):
+    """Events are leased, sent outside any transaction, then settled"""
+
+    def enqueue(self, key, **fields):
+        return OutboxEvent.objects.create(group_name='dispatchers', message_type='ambulance_update',
+                                          event='UPDATED', payload={'id': key}, ordering_key=key, **fields)
+
+    def test_sent_outside_transaction_under_lease(self):
+        event = self.enqueue('ambulance:1')
+        seen = {}
+
+        def async_to_sync(fn):
+            # Called on the relay's own thread, right before sending
+            seen['in_atomic_block'] = connection.in_atomic_block
+            return real_async_to_sync(fn)
+
+        async def deliver(channel_layer, events):
+            seen['due'] = await OutboxEvent.objects.filter(available_at__lte=timezone.now()).acount()
+            return {e.id: None for e in events}
+
+        with mock.patch('asgiref.sync.async_to_sync', async_to_sync), mock.patch.object(outbox, '_deliver', deliver):
+            self.assertEqual(outbox.relay_pending(), 1)
+        self.assertEqual(seen, {'in_atomic_block': False, 'due': 0})
+        self.assertFalse(OutboxEvent.objects.filter(pk=event.pk).exists())
+
+    def test_backing_off_event_does_not_starve_newer_ones(self):
+        backing_off = self.enqueue('ambulance:1', attempts=1, available_at=timezone.now() + timedelta(minutes=1))
+        self.enqueue('ambulance:2')
+        self.enqueue('ambulance:3')
+        self.assertEqual(outbox.relay_pending(batch_size=1), 2)
+        self.assertEqual(list(OutboxEvent.objects.values_list('id', flat=True)), [backing_off.pk])
+
+    def test_failure_holds_back_its_key(self):
+        first = self.enqueue('ambulance:1')
+        second = self.enqueue('ambulance:1')
+
+        async def deliver(channel_layer, events):
+            return {first.pk: RuntimeError('layer down')}
+
+        with mock.patch.object(outbox, '_deliver', deliver):
+            self.assertEqual(outbox.relay_pending(), 0)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.attempts, 1)
+        self.assertGreater(first.available_at, timezone.now())
+        # Released, but waits behind the failed event
+        self.assertLessEqual(second.available_at, timezone.now())
+        self.assertEqual(outbox.relay_pending(), 0)
+
+    def test_given_up_after_max_attempts(self):
+        self.enqueue('ambulance:1', attempts=1)
+
+        async def deliver(channel_layer, events):
+            return {e.id: RuntimeError('layer down') for e in events}
+
+        with mock.patch.object(outbox, '_deliver', deliver), override_settings(OUTBOX_MAX_ATTEMPTS=2), \
+                self.assertLogs('core.outbox', 'ERROR'):
+            self.assertEqual(outbox.relay_pending(), 1)
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_relay_command_once(self):
+        self.enqueue('ambulance:1')
+        self.enqueue('hospital:1')
+        out = StringIO()
+
+        async def deliver(channel_layer, events):
+            return {e.id: None for e in events}
+
+        with mock.patch.object(outbox, '_deliver', deliver):
+            call_command('relay_outbox', '--once', stdout=out)
+        self.assertIn('Relayed 2 events', out.getvalue())
+
+
+@override_settings(OUTBOX_RELAY_IN_PROCESS=True, OUTBOX_RELAY_INTERVAL=0,
+                   CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class OutboxEnqueueTests(TestCase):
+    """Notifications exist exactly when their transaction commits"""
+
+    ambulance = {'id': 4, 'unit_number': 'AMB-004', 'status': 'AVAILABLE'}
+
+    def test_rolled_back_change_sends_nothing(self):
+        with mock.patch.object(outbox, '_deliver') as deliver, self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    enqueue_ambulance_notification('UPDATED', self.ambulance)
+                    raise RuntimeError('rolled back')
+            except RuntimeError:
+                pass
+        deliver.assert_not_called()
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_relayed_on_commit(self):
+        delivered = []
+
+        async def deliver(channel_layer, events):
+            delivered.extend((e.ordering_key, e.entity_kind, e.payload) for e in events)
+            return {e.id: None for e in events}
+
+        with mock.patch.object(outbox, '_deliver', deliver):
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                enqueue_ambulance_notification('UPDATED', self.ambulance)
+            # Written, but not sent before the commit
+            self.assertEqual((OutboxEvent.objects.count(), delivered), (1, []))
+            for callback in callbacks:
+                callback()
+        self.assertEqual(delivered, [('ambulance:4', 'ambulance', self.ambulance)])
+        self.assertFalse(OutboxEvent.objects.exists())
+
+
+class PresenceRegistryTests(SimpleTestCase):
+    """Online while any connection was heard from within the TTL"""
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('core.presence.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_connections_and_disconnections(self):
+        registry = PresenceRegistry(ttl=60)
+        self.assertTrue(await registry.connect(5, 'phone'))
+        self.assertFalse(await registry.connect(5, 'tablet'))
+        self.assertFalse(await registry.disconnect(5, 'phone'))
+        self.now += 10
+        self.assertTrue(await registry.disconnect(5, 'tablet'))
+        self.assertEqual(registry.lookup([5, 6]), {
+            5: {'online': False, 'last_seen': datetime.fromtimestamp(1010, tz=dt_timezone.utc)},
+            6: {'online': False, 'last_seen': None},
+        })
+
+    async def test_silent_device_expires(self):
+        registry = PresenceRegistry(ttl=60)
+        await registry.connect(5, 'phone')
+        self.now += 30
+        self.assertFalse(await registry.heartbeat(5, 'phone'))
+        self.now += 59
+        self.assertEqual(await registry.sweep(), [])
+        self.assertTrue(registry.lookup([5])[5]['online'])
+        self.now += 1
+        self.assertEqual(await registry.sweep(), [5])
+        self.assertEqual(registry.stats(), {'backend': 'memory', 'ttl': 60, 'online': 0, 'heartbeats': 2})
+        # Already reported offline by the sweep
+        self.assertFalse(await registry.disconnect(5, 'phone'))
+
+    async def test_heartbeat_after_expiry_comes_back_online(self):
+        registry = PresenceRegistry(ttl=60)
+        await registry.connect(5, 'phone')
+        self.now += 61
+        self.assertTrue(await registry.heartbeat(5, 'phone'))
+        self.assertTrue(registry.lookup([5])[5]['online'])
+
+    async def test_redis_outage(self):
+        # Nothing listens on port 1
+        registry = RedisPresenceRegistry('redis://127.0.0.1:1/0', ttl=60)
+        with self.assertLogs('core.presence', 'WARNING'):
+            self.assertFalse(await registry.connect(5, 'phone'))
+            # Falls back to what this process knows
+            self.assertTrue(registry.lookup([5])[5]['online'])
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ParamedicPresenceViewTests(TestCase):
+    """The paramedic list carries device presence"""
+
+    def setUp(self):
+        self.online = User.objects.create_user('online', role='paramedic', first_name='A')
+        self.offline = User.objects.create_user('offline', role='paramedic', first_name='B')
+        self.registry = PresenceRegistry(ttl=60)
+        real_async_to_sync(self.registry.connect)(self.online.id, 'phone')
+        patcher = mock.patch('core.presence._registry', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('dispatcher', role='dispatcher'))
+
+    def test_presence_fields(self):
+        response = self.client.get('/api/paramedics/')
+        self.assertEqual([(p['username'], p['online'], p['last_seen'] is not None) for p in response.data],
+                         [('online', True, True), ('offline', False, False)])
+
+    def test_online_filter(self):
+        response = self.client.get('/api/paramedics/', {'online': 'true'})
+        self.assertEqual([p['username'] for p in response.data], ['online'])
@@ -2,24 +2,111 @@
 Utility functions for channel layer notifications and async operations.
 Optimized for ASGI applications.
 """
+import asyncio
 import logging
-from typing import Optional, Dict, Any
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Dict, Any, List, Tuple
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from .frames import pre_encode
+from .replay import next_event_id
 
 logger = logging.getLogger(__name__)
 
 
-def send_channel_notification(
+def build_group_messages(
     group_name: str,
     message_type: str,
     event: str,
     data: Dict[str, Any],
-    paramedic_id: Optional[int] = None
+    paramedic_id: Optional[int] = None,
+    entity_kind: Optional[str] = None
+) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    ``(group, message)`` pairs for one notification.
+    
+    Each distinct message is encoded to its client JSON once, here, rather
+    than by every consumer it reaches (see :mod:`core.frames`).
+    """
+    message = {'type': message_type, 'event': event}
+    if entity_kind and getattr(settings, 'REALTIME_DELTA_FRAMES', True):
+        message.update(get_delta_tracker().frame(entity_kind, data))
+    else:
+        message['data'] = data
+    messages = [(group_name, message)]
+    if group_name == 'dispatchers':
+        # Every copy shares one event id so each process numbers the event once (core.replay)
+        message['eid'] = next_event_id()
+        if getattr(settings, 'DISPATCH_SECTORS_ENABLED', True):
+            messages.extend(_sector_messages(message, entity_kind or message_type, data))
+    
+    # The paramedic's personal channel always gets the full payload
+    if paramedic_id is not None:
+        messages.append((
+            f'paramedic_{paramedic_id}',
+            {'type': message_type, 'event': event, 'data': data}
+        ))
+    
+    # Groups can share a message object; encode each one once, in place
+    seen = set()
+    for _, m in messages:
+        if id(m) not in seen:
+            pre_encode(m, f"{m['eid']}.{len(seen)}" if 'eid' in m else None)
+            seen.add(id(m))
+    return messages
+
+
+def _sector_messages(message: Dict[str, Any], kind: str, data: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Copies of a dispatcher message for the sector groups it concerns (see :mod:`core.sectors`)."""
+    from .sectors import entity_position, get_sector_tracker, sector_group
+    
+    tracker = get_sector_tracker()
+    if message['event'] == 'LOCATION_BATCH':
+        rows_by_sector: Dict[str, list] = {}
+        for row in data.get('locations', []):
+            sector, left = tracker.move(('ambulance', row[0]), row[1], row[2])
+            rows_by_sector.setdefault(sector, []).append(row)
+            if left:
+                rows_by_sector.setdefault(left, []).append(row)
+        return [
+            (sector_group(sector), {**message, 'data': {'locations': rows}, 'partial': True})
+            for sector, rows in rows_by_sector.items()
+        ]
+    
+    position = entity_position(data)
+    if position is None or data.get('id') is None:
+        return []
+    sector, left = tracker.move((kind, data['id']), *position)
+    message['sectors'] = [sector, left] if left else [sector]
+    if left:
+        # Subscribers of the new sector may never have seen this entity: send it in full
+        entered = {
+            **message,
+            'data': message.get('data') or with_version(data),
+            'partial': True,
+        }
+        entered.pop('delta', None)
+        return [(sector_group(sector), entered), (sector_group(left), message)]
+    return [(sector_group(sector), message)]
+
+
+async def asend_channel_notification(
+    group_name: str,
+    message_type: str,
+    event: str,
+    data: Dict[str, Any],
+    paramedic_id: Optional[int] = None,
+    entity_kind: Optional[str] = None
 ) -> None:
     """
-    Send a notification to a channel group (optimized for ASGI).
+    Send a notification to a channel group from async code.
     
-    This function handles channel layer notifications from sync views.
-    It uses async_to_sync to bridge sync/async boundaries.
+    Consumers and async views await this directly. All target groups are
+    sent to concurrently, so an event costs one channel layer round trip
+    instead of one per group.
     
     Args:
         group_name: The channel group name (e.g., 'dispatchers')
@@ -27,37 +114,53 @@ def send_channel_notification(
         event: The event type (e.g., 'NEW_EMERGENCY', 'STATUS_UPDATE')
         data: The data payload to send
         paramedic_id: Optional paramedic ID to also notify their personal channel
+        entity_kind: Set for serialized model payloads (e.g. 'ambulance'); the group
+            message then carries only the fields changed since the last frame
+            (see :class:`DeltaTracker`). The paramedic channel always gets full data.
     """
     try:
         from channels.layers import get_channel_layer
-        from asgiref.sync import async_to_sync
         
         channel_layer = get_channel_layer()
         if not channel_layer:
             logger.warning("Channel layer not configured. Notification not sent.")
             return
         
-        # Send notification to the main group
-        async_to_sync(channel_layer.group_send)(
-            group_name,
-            {
-                'type': message_type,
-                'event': event,
-                'data': data
-            }
+        messages = build_group_messages(group_name, message_type, event, data, paramedic_id, entity_kind)
+        results = await asyncio.gather(
+            *(channel_layer.group_send(group, message) for group, message in messages),
+            return_exceptions=True
         )
-        
-        # Also notify paramedic's personal channel if provided
-        if paramedic_id is not None:
-            async_to_sync(channel_layer.group_send)(
-                f'paramedic_{paramedic_id}',
-                {
-                    'type': message_type,
-                    'event': event,
-                    'data': data
-                }
-            )
+        for (group, _), result in zip(messages, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to send channel notification to {group}: {result}", exc_info=result)
             
+    except Exception as e:
+        # Log the error but don't fail the caller
+        logger.warning(f"Failed to send channel notification to {group_name}: {e}", exc_info=True)
+
+
+def send_channel_notification(
+    group_name: str,
+    message_type: str,
+    event: str,
+    data: Dict[str, Any],
+    paramedic_id: Optional[int] = None,
+    entity_kind: Optional[str] = None
+) -> None:
+    """
+    Send a notification to a channel group from sync views.
+    
+    Sync shim over :func:`asend_channel_notification`: one ``async_to_sync``
+    bridge per event, however many groups it goes to. Takes the same
+    arguments.
+    """
+    try:
+        from asgiref.sync import async_to_sync
+        
+        async_to_sync(asend_channel_notification)(
+            group_name, message_type, event, data, paramedic_id, entity_kind
+        )
     except Exception as e:
         # Log the error but don't fail the request
         logger.warning(f"Failed to send channel notification to {group_name}: {e}", exc_info=True)
@@ -81,7 +184,8 @@ def send_emergency_notification(
         message_type='emergency_update',
         event=event,
         data=emergency_data,
-        paramedic_id=paramedic_id
+        paramedic_id=paramedic_id,
+        entity_kind='emergency'
     )
 
 
@@ -100,7 +204,8 @@ def send_ambulance_notification(
         group_name='dispatchers',
         message_type='ambulance_update',
         event=event,
-        data=ambulance_data
+        data=ambulance_data,
+        entity_kind='ambulance'
     )
 
 
@@ -122,3 +227,291 @@ def send_hospital_notification(
         data=hospital_data
     )
 
+
+async def asend_presence_notification(presence_data: Dict[str, Any]) -> None:
+    """
+    Tell dispatchers a paramedic came online or went offline
+    (``{"id", "online", "last_seen"}``, see :mod:`core.presence`).
+    """
+    await asend_channel_notification(
+        group_name='dispatchers',
+        message_type='presence_update',
+        event='ONLINE' if presence_data['online'] else 'OFFLINE',
+        data=presence_data
+    )
+
+
+async def asend_emergency_notification(
+    event: str,
+    emergency_data: Dict[str, Any],
+    paramedic_id: Optional[int] = None
+) -> None:
+    """Async counterpart of :func:`send_emergency_notification`."""
+    await asend_channel_notification(
+        group_name='dispatchers',
+        message_type='emergency_update',
+        event=event,
+        data=emergency_data,
+        paramedic_id=paramedic_id,
+        entity_kind='emergency'
+    )
+
+
+async def asend_ambulance_notification(
+    event: str,
+    ambulance_data: Dict[str, Any]
+) -> None:
+    """Async counterpart of :func:`send_ambulance_notification`."""
+    await asend_channel_notification(
+        group_name='dispatchers',
+        message_type='ambulance_update',
+        event=event,
+        data=ambulance_data,
+        entity_kind='ambulance'
+    )
+
+
+async def asend_hospital_notification(
+    event: str,
+    hospital_data: Dict[str, Any]
+) -> None:
+    """Async counterpart of :func:`send_hospital_notification`."""
+    await asend_channel_notification(
+        group_name='dispatchers',
+        message_type='hospital_update',
+        event=event,
+        data=hospital_data
+    )
+
+
+def send_location_notification(locations: List[list]) -> None:
+    """
+    Announce ``[ambulance_id, lat, lng, recorded_at]`` position rows to dispatchers.
+    
+    Rows are coalesced per unit and sent as one LOCATION_BATCH frame per
+    ``LOCATION_BROADCAST_INTERVAL`` tick; with an interval of 0 they go out
+    immediately. Status changes must keep using :func:`send_ambulance_notification`
+    so they are never delayed.
+    """
+    coalescer = get_location_coalescer()
+    if coalescer.interval <= 0:
+        _send_location_batch(locations)
+    else:
+        coalescer.add(locations)
+
+
+async def asend_location_notification(locations: List[list]) -> None:
+    """Async counterpart of :func:`send_location_notification` for consumers."""
+    coalescer = get_location_coalescer()
+    if coalescer.interval <= 0:
+        await asend_channel_notification(
+            group_name='dispatchers',
+            message_type='ambulance_update',
+            event='LOCATION_BATCH',
+            data={'locations': locations}
+        )
+    else:
+        # Only touches an in-memory dict; the ticker thread sends the frame
+        coalescer.add(locations)
+
+
+def _send_location_batch(locations: List[list]) -> None:
+    send_channel_notification(
+        group_name='dispatchers',
+        message_type='ambulance_update',
+        event='LOCATION_BATCH',
+        data={'locations': locations}
+    )
+
+
+class LocationCoalescer:
+    """
+    Keeps the newest position per unit and flushes all of them to the
+    dispatchers group as a single frame on a fixed tick, so dispatcher
+    fan-out grows with ticks instead of pings.
+    """
+    
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        # ambulance id -> (recorded_at as a datetime, row)
+        self._pending: Dict[Any, Tuple[Any, list]] = {}
+        self._lock = threading.Lock()
+        self._ticker: Optional['PeriodicTask'] = None
+        self.received = self.frames = self.rows_sent = 0
+    
+    def add(self, locations: List[list]) -> None:
+        with self._lock:
+            for row in locations:
+                # Rows can carry different UTC offsets, so their strings don't order by time
+                recorded_at = parse_datetime(row[3])
+                current = self._pending.get(row[0])
+                if current is None or recorded_at >= current[0]:
+                    self._pending[row[0]] = (recorded_at, row)
+            self.received += len(locations)
+        self._ensure_ticker()
+    
+    def flush(self) -> int:
+        with self._lock:
+            rows = [row for _, row in self._pending.values()]
+            self._pending.clear()
+        if rows:
+            _send_location_batch(rows)
+            self.frames += 1
+            self.rows_sent += len(rows)
+        return len(rows)
+    
+    def _ensure_ticker(self) -> None:
+        if self._ticker is None:
+            with self._lock:
+                if self._ticker is None:
+                    self._ticker = PeriodicTask(self.flush, self.interval, name='location-broadcast')
+        self._ticker.start()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'interval': self.interval,
+            'pending': len(self._pending),
+            'received': self.received,
+            'frames': self.frames,
+            'rows_sent': self.rows_sent,
+        }
+
+
+_location_coalescer: Optional[LocationCoalescer] = None
+_location_coalescer_lock = threading.Lock()
+
+
+def get_location_coalescer() -> LocationCoalescer:
+    global _location_coalescer
+    if _location_coalescer is None:
+        with _location_coalescer_lock:
+            if _location_coalescer is None:
+                _location_coalescer = LocationCoalescer(getattr(settings, 'LOCATION_BROADCAST_INTERVAL', 0.5))
+    return _location_coalescer
+
+
+class PeriodicTask:
+    """
+    Run a callable every ``interval`` seconds on a daemon thread.
+    
+    Used for write-behind flushes; ``stop()`` runs the callable one last
+    time so buffered work isn't lost on shutdown, and ``wake()`` runs it
+    early without waiting for the next tick.
+    """
+    
+    def __init__(self, func: Callable[[], Any], interval: float, name: Optional[str] = None):
+        self.func = func
+        self.interval = interval
+        self.name = name or getattr(func, '__name__', 'periodic-task')
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+    
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self) -> None:
+        """Start the thread (no-op if already running)."""
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._wake.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+    
+    def stop(self, run_final: bool = True) -> None:
+        with self._lock:
+            thread, self._thread = self._thread, None
+        self._stop.set()
+        self._wake.set()
+        if thread is not None:
+            thread.join(timeout=self.interval + 5)
+        if run_final:
+            self._call()
+    
+    def wake(self) -> None:
+        """Run the callable as soon as possible on the task's thread."""
+        self._wake.set()
+    
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            self._call()
+    
+    def _call(self) -> None:
+        try:
+            self.func()
+        except Exception as e:
+            logger.warning(f"Periodic task {self.name} failed: {e}", exc_info=True)
+
+
+def entity_version(data: Dict[str, Any]) -> int:
+    """
+    Version of a serialized entity: its ``updated_at`` in epoch milliseconds.
+    
+    Derived from the database row so every worker process agrees on it.
+    """
+    updated_at = data.get('updated_at')
+    parsed = parse_datetime(updated_at) if isinstance(updated_at, str) else updated_at
+    return int(parsed.timestamp() * 1000) if parsed else 0
+
+
+def with_version(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Full representation with its ``v`` attached, as sent in snapshots."""
+    return {**data, 'v': entity_version(data)}
+
+
+class DeltaTracker:
+    """
+    Remembers the last representation sent per entity so updates can go out
+    as only the changed fields.
+    
+    A delta frame is ``{"delta": {"id", "v", "base", "changes"}}`` where
+    ``base`` is the version the changes apply on top of; clients holding
+    another version ask for a snapshot instead of merging (see the merge
+    protocol in ``dispatcher_dashboard.html``). Entities not seen before,
+    or evicted from the bounded cache, go out as full ``{"data": ...}``.
+    """
+    
+    def __init__(self, max_entities: int = 5000):
+        self.max_entities = max_entities
+        self._last: 'OrderedDict[tuple, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def frame(self, kind: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        key = (kind, data.get('id'))
+        version = entity_version(data)
+        with self._lock:
+            previous = self._last.get(key)
+            self._last[key] = (version, dict(data))
+            self._last.move_to_end(key)
+            while len(self._last) > self.max_entities:
+                self._last.popitem(last=False)
+        if previous is None:
+            return {'data': {**data, 'v': version}}
+        base, last = previous
+        changes = {k: v for k, v in data.items() if k not in last or last[k] != v}
+        return {'delta': {'id': data.get('id'), 'v': version, 'base': base, 'changes': changes}}
+    
+    def forget(self, kind: str, entity_id) -> None:
+        with self._lock:
+            self._last.pop((kind, entity_id), None)
+
+
+_delta_tracker: Optional[DeltaTracker] = None
+_delta_tracker_lock = threading.Lock()
+
+
+def get_delta_tracker() -> DeltaTracker:
+    global _delta_tracker
+    if _delta_tracker is None:
+        with _delta_tracker_lock:
+            if _delta_tracker is None:
+                _delta_tracker = DeltaTracker(getattr(settings, 'REALTIME_DELTA_MAX_ENTITIES', 5000))
+    return _delta_tracker
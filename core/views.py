@@ -6,7 +6,8 @@ from django.views.decorators.csrf import csrf_protect
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from django.contrib.auth import get_user_model
-from .serializers import UserSerializer
+from .presence import get_presence_registry
+from .serializers import ParamedicSerializer, UserSerializer
 from django.db.models import Q
 
 
@@ -110,10 +111,19 @@ class UserDetailView(generics.RetrieveUpdateDestroyAPIView):
 
 
 class ParamedicListView(generics.ListAPIView):
-    """List active paramedics for dispatcher assignment"""
-    serializer_class = UserSerializer
+    """List active paramedics for dispatcher assignment, with device presence"""
+    serializer_class = ParamedicSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def list(self, request, *args, **kwargs):
+        paramedics = list(self.get_queryset())
+        presence = get_presence_registry().lookup(p.id for p in paramedics)
+        # Optional filter: only paramedics with a connected device
+        if request.GET.get('online') in ('1', 'true', 'True'):
+            paramedics = [p for p in paramedics if presence[p.id]['online']]
+        context = {**self.get_serializer_context(), 'presence': presence}
+        return Response(self.get_serializer(paramedics, many=True, context=context).data)
+
     def get_queryset(self):
         qs = User.objects.filter(role='paramedic', is_active=True)
         # Optional filter: only available
@@ -138,3 +148,18 @@ class ToggleAvailabilityView(generics.UpdateAPIView):
         request.user.is_available_for_dispatch = bool(val) if isinstance(val, bool) else str(val).lower() in ('1','true','yes','on')
         request.user.save(update_fields=['is_available_for_dispatch'])
         return Response(UserSerializer(request.user).data)
+
+
+class RealtimeStatsView(generics.GenericAPIView):
+    """WebSocket send-queue, frame-cache and presence metrics of this process (staff/admin only)"""
+    permission_classes = [IsStaffOrAdmin]
+
+    def get(self, request, *args, **kwargs):
+        from .frames import get_frame_cache
+        from .sendqueue import get_send_queue_metrics
+
+        return Response({
+            'send_queues': get_send_queue_metrics().stats(),
+            'frame_cache': get_frame_cache().stats(),
+            'presence': get_presence_registry().stats(),
+        })
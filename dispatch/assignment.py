@@ -0,0 +1,190 @@
+"""
+Global batch assignment of available ambulances to pending emergency calls.
+
+During surges dispatching one call at a time greedily tends to strand later
+calls far from any unit. Here all RECEIVED calls and AVAILABLE units are
+matched at once by solving a min-cost bipartite assignment (Hungarian /
+Jonker-Volgenant via SciPy) over priority-weighted distances.
+"""
+from dataclasses import dataclass, field
+from typing import List
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from django.db import transaction
+
+from .distance_matrix import coordinate_array, haversine_matrix
+from .fleet_store import get_fleet_store
+
+# Triage order used when there are more calls than units
+PRIORITY_RANK = {'CRITICAL': 0, 'HIGH': 1, 'MEDIUM': 2, 'LOW': 3}
+
+# Multiplier applied to a call's distances; makes long response times for
+# urgent calls more expensive than for routine ones
+PRIORITY_WEIGHTS = {'CRITICAL': 4.0, 'HIGH': 2.0, 'MEDIUM': 1.0, 'LOW': 0.5}
+
+
+@dataclass
+class Proposal:
+    emergency_call_id: int
+    ambulance_id: int
+    distance_km: float
+    priority: str
+
+
+@dataclass
+class AssignmentPlan:
+    assignments: List[Proposal] = field(default_factory=list)
+    unassigned_call_ids: List[int] = field(default_factory=list)
+
+    @property
+    def total_distance_km(self) -> float:
+        return sum(p.distance_km for p in self.assignments)
+
+    def as_dict(self):
+        return {
+            'assignments': [
+                {
+                    'emergency_call_id': p.emergency_call_id,
+                    'ambulance_id': p.ambulance_id,
+                    'distance_km': round(p.distance_km, 3),
+                    'priority': p.priority,
+                }
+                for p in self.assignments
+            ],
+            'unassigned_call_ids': self.unassigned_call_ids,
+            'total_distance_km': round(self.total_distance_km, 3),
+        }
+
+
+def priority_rank(priority) -> int:
+    """Triage rank of a priority; unknown priorities come after all known ones."""
+    return PRIORITY_RANK.get(priority, len(PRIORITY_RANK))
+
+
+def triage_order(priorities, received_order=None) -> np.ndarray:
+    """Row indices sorted by priority, then by arrival (index order by default)."""
+    ranks = np.array([priority_rank(p) for p in priorities])
+    arrival = np.arange(len(ranks)) if received_order is None else np.asarray(received_order)
+    return np.lexsort((arrival, ranks))
+
+
+def solve_optimal(distances: np.ndarray, priorities) -> List[tuple]:
+    """
+    Min-cost matching of calls (rows) to units (columns).
+
+    When calls outnumber units the most urgent calls are kept first, then
+    the remaining rows and all columns are matched globally.
+
+    Returns:
+        List of ``(row, column)`` index pairs
+    """
+    n_calls, n_units = distances.shape
+    if n_calls == 0 or n_units == 0:
+        return []
+    rows = triage_order(priorities)[:n_units]
+    weights = np.array([PRIORITY_WEIGHTS.get(priorities[r], 1.0) for r in rows])
+    cost = distances[rows] * weights[:, np.newaxis]
+    row_ind, col_ind = linear_sum_assignment(cost)
+    return [(int(rows[r]), int(c)) for r, c in zip(row_ind, col_ind)]
+
+
+def solve_greedy(distances: np.ndarray, priorities) -> List[tuple]:
+    """Baseline: take calls in triage order and give each the nearest free unit."""
+    n_calls, n_units = distances.shape
+    taken = np.zeros(n_units, dtype=bool)
+    pairs = []
+    for r in triage_order(priorities):
+        if len(pairs) == n_units:
+            break
+        row = np.where(taken, np.inf, distances[r])
+        c = int(np.argmin(row))
+        taken[c] = True
+        pairs.append((int(r), c))
+    return pairs
+
+
+def plan_batch_assignment(calls=None, ambulances=None) -> AssignmentPlan:
+    """
+    Build a global assignment plan for pending calls.
+
+    Args:
+        calls: EmergencyCall queryset (defaults to RECEIVED calls)
+        ambulances: Ambulance queryset (defaults to AVAILABLE units)
+    """
+    from emergencies.models import EmergencyCall
+    from .models import Ambulance
+
+    if calls is None:
+        calls = EmergencyCall.objects.filter(status='RECEIVED')
+    if ambulances is None:
+        ambulances = Ambulance.objects.filter(status='AVAILABLE')
+
+    call_rows = list(
+        calls.filter(latitude__isnull=False, longitude__isnull=False)
+        .order_by('received_at', 'id')
+        .values_list('id', 'priority', 'latitude', 'longitude')
+    )
+    unit_rows = get_fleet_store().overlay_rows(
+        ambulances.filter(current_latitude__isnull=False, current_longitude__isnull=False)
+        .order_by('id')
+        .values_list('id', 'current_latitude', 'current_longitude')
+    )
+
+    priorities = [row[1] for row in call_rows]
+    distances = haversine_matrix(
+        coordinate_array(row[2:] for row in call_rows),
+        coordinate_array(row[1:] for row in unit_rows),
+    )
+
+    plan = AssignmentPlan()
+    assigned_rows = set()
+    for r, c in sorted(solve_optimal(distances, priorities), key=lambda rc: priority_rank(priorities[rc[0]])):
+        assigned_rows.add(r)
+        plan.assignments.append(Proposal(
+            emergency_call_id=call_rows[r][0],
+            ambulance_id=unit_rows[c][0],
+            distance_km=float(distances[r, c]),
+            priority=priorities[r],
+        ))
+    plan.unassigned_call_ids = [row[0] for i, row in enumerate(call_rows) if i not in assigned_rows]
+    return plan
+
+
+def apply_assignment_plan(pairs, dispatcher) -> tuple:
+    """
+    Dispatch every ``(emergency_call_id, ambulance_id)`` pair in a single transaction.
+
+    Rows are locked and re-validated; pairs whose call is no longer RECEIVED
+    or whose unit is no longer AVAILABLE are skipped rather than failing
+    the whole batch.
+
+    Returns:
+        ``(applied, skipped)`` where ``applied`` is a list of
+        ``(EmergencyCall, Ambulance)`` and ``skipped`` a list of id pairs
+    """
+    from emergencies.models import EmergencyCall
+    from .models import Ambulance
+
+    pairs = list(pairs)
+    applied, skipped = [], []
+    with transaction.atomic():
+        calls = EmergencyCall.objects.select_for_update().in_bulk([c for c, _ in pairs])
+        units = Ambulance.objects.select_for_update().in_bulk([a for _, a in pairs])
+        used_calls, used_units = set(), set()
+        for call_id, unit_id in pairs:
+            call, unit = calls.get(call_id), units.get(unit_id)
+            if (call is None or unit is None or call.status != 'RECEIVED' or not unit.is_available
+                    or call_id in used_calls or unit_id in used_units):
+                skipped.append((call_id, unit_id))
+                continue
+            used_calls.add(call_id)
+            used_units.add(unit_id)
+
+            unit.assign_to_emergency(call)
+            call.assigned_ambulance = unit
+            call.assigned_paramedic = unit.assigned_paramedic
+            call.dispatcher = dispatcher
+            call.update_status('DISPATCHED')
+            applied.append((call, unit))
+    return applied, skipped
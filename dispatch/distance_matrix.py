@@ -0,0 +1,110 @@
+"""
+Vectorized distance computations between emergency calls and the fleet.
+
+Coordinates are pulled from the database as compact float64 arrays and the
+full calls x ambulances haversine matrix is computed in a single NumPy pass,
+instead of one Python-level ``Decimal`` comparison per pair.
+"""
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+
+from .fleet_store import get_fleet_store
+from .spatial import EARTH_RADIUS_KM
+
+
+@dataclass
+class DistanceMatrix:
+    """Distances in km; rows follow ``call_ids``, columns follow ``ambulance_ids``."""
+    call_ids: List[int]
+    ambulance_ids: List[int]
+    distances_km: np.ndarray
+
+    def nearest(self, k: int = 3):
+        """Column indices and distances of the ``k`` closest units for every row."""
+        k = max(0, min(k, self.distances_km.shape[1]))
+        if k == 0 or not self.call_ids:
+            empty = np.empty((len(self.call_ids), 0))
+            return empty.astype(np.intp), empty
+        idx = np.argpartition(self.distances_km, k - 1, axis=1)[:, :k]
+        part = np.take_along_axis(self.distances_km, idx, axis=1)
+        order = np.argsort(part, axis=1)
+        return np.take_along_axis(idx, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+def coordinate_array(rows) -> np.ndarray:
+    """Convert ``(lat, lng)`` pairs (floats or Decimals) into an ``(n, 2)`` float64 array."""
+    arr = np.array([(float(lat), float(lng)) for lat, lng in rows], dtype=np.float64)
+    return arr.reshape(-1, 2)
+
+
+def unit_vectors(coords: np.ndarray) -> np.ndarray:
+    """Map ``(n, 2)`` latitude/longitude degrees onto ``(n, 3)`` points of the unit sphere."""
+    rad = np.radians(np.asarray(coords, dtype=np.float64).reshape(-1, 2))
+    cos_lat = np.cos(rad[:, 0])
+    return np.column_stack([cos_lat * np.cos(rad[:, 1]), cos_lat * np.sin(rad[:, 1]), np.sin(rad[:, 0])])
+
+
+def haversine_matrix(origins: np.ndarray, destinations: np.ndarray) -> np.ndarray:
+    """
+    Great-circle distances (km) between every origin and every destination.
+
+    Uses the chord form of the haversine formula: with both point sets on
+    the unit sphere, ``hav(theta) = (1 - p.q) / 2``, so the only ``(n, m)``
+    sized work is one BLAS matrix product followed by ``sqrt``/``arcsin``.
+    ``1 - p.q`` loses digits for nearby points, so results can be up to
+    about 0.25 m off the scalar haversine (worst for near-coincident
+    points); still far below GPS noise.
+
+    Args:
+        origins: ``(n, 2)`` array of latitude/longitude in degrees
+        destinations: ``(m, 2)`` array of latitude/longitude in degrees
+
+    Returns:
+        ``(n, m)`` float64 array
+    """
+    a = unit_vectors(origins) @ unit_vectors(destinations).T
+    np.subtract(1.0, a, out=a)
+    a *= 0.5
+    np.clip(a, 0.0, 1.0, out=a)
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2 * EARTH_RADIUS_KM
+    return a
+
+
+def build_distance_matrix(calls=None, ambulances=None) -> DistanceMatrix:
+    """
+    Distance matrix between emergency calls and ambulances that have coordinates.
+
+    Args:
+        calls: EmergencyCall queryset (defaults to all RECEIVED calls)
+        ambulances: Ambulance queryset (defaults to all AVAILABLE units)
+    """
+    from emergencies.models import EmergencyCall
+    from .models import Ambulance
+
+    if calls is None:
+        calls = EmergencyCall.objects.filter(status='RECEIVED')
+    if ambulances is None:
+        ambulances = Ambulance.objects.filter(status='AVAILABLE')
+
+    call_rows = list(
+        calls.filter(latitude__isnull=False, longitude__isnull=False)
+        .order_by('id').values_list('id', 'latitude', 'longitude')
+    )
+    unit_rows = get_fleet_store().overlay_rows(
+        ambulances.filter(current_latitude__isnull=False, current_longitude__isnull=False)
+        .order_by('id').values_list('id', 'current_latitude', 'current_longitude')
+    )
+
+    matrix = haversine_matrix(
+        coordinate_array(row[1:] for row in call_rows),
+        coordinate_array(row[1:] for row in unit_rows),
+    )
+    return DistanceMatrix(
+        call_ids=[row[0] for row in call_rows],
+        ambulance_ids=[row[0] for row in unit_rows],
+        distances_km=matrix,
+    )
@@ -0,0 +1,131 @@
+"""
+Bounded LRU/TTL cache of travel-time results.
+
+Dispatchers browsing calls ask for the same station-to-neighbourhood ETAs
+over and over. Results are keyed by quantized origin/destination grid cells
+so nearby points share an entry, and the whole cache is dropped whenever the
+local time moves into a new time-of-day band (traffic conditions differ
+between e.g. the morning peak and the night).
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+Point = Tuple[float, float]
+
+# Hours at which a new time-of-day band starts
+DEFAULT_TIME_BANDS = (0, 6, 10, 16, 20)
+
+
+class ETACache:
+    """Thread-safe LRU cache with per-entry TTL and hit/miss counters."""
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 900,
+                 cell_size_deg: float = 0.005, time_bands: Sequence[int] = DEFAULT_TIME_BANDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.cell_size = cell_size_deg
+        self.time_bands = sorted(time_bands)
+        self._clock = clock
+        self._entries: 'OrderedDict[tuple, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._band = None
+        self._band_checked_until = 0.0
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return (math.floor(lat / self.cell_size), math.floor(lng / self.cell_size))
+
+    def current_band(self) -> int:
+        hour = timezone.localtime().hour
+        band = 0
+        for i, start in enumerate(self.time_bands):
+            if hour >= start:
+                band = i
+        return band
+
+    def _check_band(self) -> None:
+        # Looking up local time is the most expensive part of a hit; bands
+        # are hours long, so re-check at most every few seconds
+        now = self._clock()
+        if now < self._band_checked_until:
+            return
+        self._band_checked_until = now + 5
+        band = self.current_band()
+        if band != self._band:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._band = band
+
+    def _key(self, origin: Point, destination: Point):
+        return self.cell(*origin) + self.cell(*destination)
+
+    def get(self, origin: Point, destination: Point):
+        """Cached value or None; counts a hit or a miss."""
+        key = self._key(origin, destination)
+        with self._lock:
+            self._check_band()
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > self._clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def set(self, origin: Point, destination: Point, value) -> None:
+        key = self._key(origin, destination)
+        with self._lock:
+            self._check_band()
+            self._entries[key] = (value, self._clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'band_invalidations': self.invalidations,
+            'time_band': self._band,
+        }
+
+
+_eta_cache: Optional[ETACache] = None
+_eta_cache_lock = threading.Lock()
+
+
+def get_eta_cache() -> ETACache:
+    global _eta_cache
+    if _eta_cache is None:
+        with _eta_cache_lock:
+            if _eta_cache is None:
+                _eta_cache = ETACache(
+                    max_entries=getattr(settings, 'ETA_CACHE_MAX_ENTRIES', 10000),
+                    ttl_seconds=getattr(settings, 'ETA_CACHE_TTL_SECONDS', 900),
+                    cell_size_deg=getattr(settings, 'ETA_CACHE_CELL_SIZE_DEG', 0.005),
+                    time_bands=getattr(settings, 'ETA_CACHE_TIME_BANDS', DEFAULT_TIME_BANDS),
+                )
+    return _eta_cache
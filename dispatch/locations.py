@@ -0,0 +1,115 @@
+"""
+Bulk ingestion of ambulance GPS fixes.
+
+Units buffering fixes while offline, or a telematics gateway relaying the
+whole fleet, post many points at once. Only the newest fix per unit moves
+the unit; fixes go to the write-behind fleet position store
+(``dispatch.fleet_store``) and are reported back as a compact
+``[id, lat, lng, recorded_at]`` list that the caller can broadcast in a
+single message.
+"""
+from dataclasses import dataclass, field
+from datetime import timezone as dt_timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .fleet_store import get_fleet_store, record_positions
+from .models import Ambulance
+
+
+@dataclass
+class LocationBatchResult:
+    updated: List[list] = field(default_factory=list)
+    stale: int = 0
+    missing: List[int] = field(default_factory=list)
+    forbidden: List[int] = field(default_factory=list)
+
+    def as_dict(self, received: int) -> dict:
+        return {
+            'received': received,
+            'updated': len(self.updated),
+            'stale': self.stale,
+            'missing': self.missing,
+            'forbidden': self.forbidden,
+        }
+
+
+def parse_location_point(raw: dict, default_ambulance_id: Optional[int] = None, now=None) -> tuple:
+    """
+    Validate one GPS fix into ``(ambulance_id, lat, lng, recorded_at)``.
+
+    Raises:
+        ValueError: with a user-facing message when the fix is unusable
+    """
+    now = now or timezone.now()
+    try:
+        ambulance_id = int(raw.get('ambulance_id', default_ambulance_id))
+        lat = round(float(raw['latitude']), 6)
+        lng = round(float(raw['longitude']), 6)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("ambulance_id, latitude and longitude are required numbers")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("Coordinates out of range")
+    recorded_at = now
+    if raw.get('recorded_at'):
+        recorded_at = parse_datetime(str(raw['recorded_at']))
+        if recorded_at is None:
+            raise ValueError("recorded_at must be an ISO 8601 timestamp")
+        if timezone.is_naive(recorded_at):
+            recorded_at = timezone.make_aware(recorded_at, dt_timezone.utc)
+        # Device clocks run ahead sometimes; never accept a fix from the future
+        recorded_at = min(recorded_at, now)
+    return ambulance_id, lat, lng, recorded_at
+
+
+def latest_fixes(points: Sequence[tuple]) -> Dict[int, Tuple[float, float, object]]:
+    """Newest ``(lat, lng, recorded_at)`` per ambulance id."""
+    latest = {}
+    for ambulance_id, lat, lng, recorded_at in points:
+        current = latest.get(ambulance_id)
+        if current is None or recorded_at >= current[2]:
+            latest[ambulance_id] = (lat, lng, recorded_at)
+    return latest
+
+
+def apply_location_batch(points: Sequence[tuple], user=None) -> LocationBatchResult:
+    """
+    Move every unit to its newest fix in ``points``.
+
+    Args:
+        points: validated ``(ambulance_id, lat, lng, recorded_at)`` tuples
+        user: paramedics may only move their assigned unit
+
+    Fixes older than a unit's ``last_location_update`` are counted as stale
+    and don't move it, so a late-arriving offline buffer never drags a unit
+    back; every authorised point is still added to the ping history.
+    """
+    result = LocationBatchResult()
+    latest = latest_fixes(points)
+    units = Ambulance.objects.only(
+        'id', 'assigned_paramedic', 'last_location_update'
+    ).in_bulk(list(latest))
+
+    store = get_fleet_store()
+    accepted, allowed = [], set()
+    for ambulance_id, (lat, lng, recorded_at) in latest.items():
+        unit = units.get(ambulance_id)
+        if unit is None:
+            result.missing.append(ambulance_id)
+            continue
+        if user is not None and user.is_paramedic and unit.assigned_paramedic_id != user.id:
+            result.forbidden.append(ambulance_id)
+            continue
+        allowed.add(ambulance_id)
+        store.overlay(unit)
+        if unit.last_location_update and recorded_at <= unit.last_location_update:
+            result.stale += 1
+            continue
+        accepted.append((ambulance_id, lat, lng, recorded_at))
+        result.updated.append([ambulance_id, lat, lng, recorded_at.isoformat()])
+
+    # Older points don't move the unit but still belong in its track history
+    record_positions(accepted, history=[p for p in points if p[0] in allowed])
+    return result
@@ -0,0 +1,41 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from dispatch.assignment import PRIORITY_WEIGHTS, solve_greedy, solve_optimal
+from dispatch.distance_matrix import haversine_matrix
+
+
+class Command(BaseCommand):
+    help = 'Compare global (Hungarian) batch dispatch against greedy one-at-a-time assignment'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=300)
+        parser.add_argument('--units', type=int, default=400)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        n, m = options['calls'], options['units']
+        rng = np.random.default_rng(options['seed'])
+        calls = np.column_stack([rng.uniform(8.30, 8.75, n), rng.uniform(-13.35, -12.90, n)])
+        units = np.column_stack([rng.uniform(8.30, 8.75, m), rng.uniform(-13.35, -12.90, m)])
+        priorities = list(rng.choice(['CRITICAL', 'HIGH', 'MEDIUM', 'LOW'], size=n, p=[0.1, 0.2, 0.4, 0.3]))
+
+        start = time.perf_counter()
+        distances = haversine_matrix(calls, units)
+        matrix_ms = (time.perf_counter() - start) * 1000
+
+        self.stdout.write(f'{n} pending calls, {m} available units (matrix {matrix_ms:.1f} ms)')
+        for name, solver in (('greedy', solve_greedy), ('optimal', solve_optimal)):
+            start = time.perf_counter()
+            pairs = solver(distances, priorities)
+            elapsed = (time.perf_counter() - start) * 1000
+            d = np.array([distances[r, c] for r, c in pairs])
+            weighted = sum(distances[r, c] * PRIORITY_WEIGHTS[priorities[r]] for r, c in pairs)
+            critical = [distances[r, c] for r, c in pairs if priorities[r] == 'CRITICAL']
+            self.stdout.write(
+                f'{name:>8}: {elapsed:7.1f} ms | assigned {len(pairs)} | total {d.sum():8.1f} km | '
+                f'weighted {weighted:8.1f} | mean {d.mean():5.2f} km | max {d.max():5.2f} km | '
+                f'critical mean {np.mean(critical) if critical else 0:5.2f} km'
+            )
@@ -0,0 +1,51 @@
+import random
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from dispatch.distance_matrix import haversine_matrix
+from dispatch.spatial import haversine_km
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the vectorized calls x ambulances haversine matrix against a pure-Python loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=500)
+        parser.add_argument('--units', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        n, m = options['calls'], options['units']
+        rng = np.random.default_rng(options['seed'])
+        # Synthetic points scattered over a ~50 km metropolitan area
+        calls = np.column_stack([rng.uniform(8.30, 8.75, n), rng.uniform(-13.35, -12.90, n)])
+        units = np.column_stack([rng.uniform(8.30, 8.75, m), rng.uniform(-13.35, -12.90, m)])
+
+        haversine_matrix(calls[:10], units[:10])  # warm-up
+        timings = []
+        for _ in range(options['repeat']):
+            start = time.perf_counter()
+            matrix = haversine_matrix(calls, units)
+            timings.append(time.perf_counter() - start)
+        best = min(timings) * 1000
+
+        # Time a sample of pairs in pure Python and extrapolate to the full matrix
+        sample = min(n * m, 200_000)
+        pairs = [(random.randrange(n), random.randrange(m)) for _ in range(sample)]
+        call_list, unit_list = calls.tolist(), units.tolist()
+        start = time.perf_counter()
+        for i, j in pairs:
+            haversine_km(*call_list[i], *unit_list[j])
+        python_ms = (time.perf_counter() - start) / sample * n * m * 1000
+
+        i, j = pairs[0]
+        assert abs(matrix[i, j] - haversine_km(*call_list[i], *unit_list[j])) < 1e-6
+
+        self.stdout.write(f'{n} calls x {m} units = {n * m:,} pairs')
+        self.stdout.write(self.style.SUCCESS(
+            f'NumPy matrix: best {best:.1f} ms, median {sorted(timings)[len(timings) // 2] * 1000:.1f} ms'
+        ))
+        self.stdout.write(f'Pure-Python loop (extrapolated): {python_ms:.0f} ms ({python_ms / best:.0f}x slower)')
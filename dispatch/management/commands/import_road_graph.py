@@ -0,0 +1,118 @@
+import re
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dispatch.routing import RoadGraph
+from dispatch.spatial import haversine_km
+
+# Default free-flow speeds (km/h) by OSM highway class
+HIGHWAY_SPEEDS = {
+    'motorway': 90, 'motorway_link': 50,
+    'trunk': 70, 'trunk_link': 40,
+    'primary': 50, 'primary_link': 35,
+    'secondary': 40, 'secondary_link': 30,
+    'tertiary': 35, 'tertiary_link': 25,
+    'unclassified': 30, 'residential': 25, 'living_street': 10,
+    'service': 15, 'road': 25, 'track': 10,
+}
+
+
+def parse_maxspeed(value):
+    """OSM maxspeed tag in km/h, or None if it cannot be interpreted."""
+    if not value:
+        return None
+    match = re.match(r'\s*(\d+(?:\.\d+)?)\s*(mph)?', value)
+    if not match:
+        return None
+    speed = float(match.group(1))
+    return speed * 1.609 if match.group(2) else speed
+
+
+class Command(BaseCommand):
+    help = 'Build the offline routing graph (ROAD_GRAPH_PATH) from an OpenStreetMap .osm XML extract'
+
+    def add_arguments(self, parser):
+        parser.add_argument('osm_file', help='Path to an .osm XML extract (e.g. exported for the service area)')
+        parser.add_argument('--output', help='Destination .npz (defaults to settings.ROAD_GRAPH_PATH)')
+        parser.add_argument('--landmarks', type=int, default=8, help='Number of ALT landmarks to precompute')
+
+    def handle(self, *args, **options):
+        source = Path(options['osm_file'])
+        if not source.is_file():
+            raise CommandError(f'{source} does not exist')
+        output = Path(options['output'] or settings.ROAD_GRAPH_PATH)
+
+        self.stdout.write(f'Parsing {source}...')
+        coords, ways = self._parse(source)
+
+        # Keep only nodes referenced by drivable ways and renumber them densely
+        used = sorted({ref for refs, _, _ in ways for ref in refs if ref in coords})
+        index = {osm_id: i for i, osm_id in enumerate(used)}
+        node_lat = np.array([coords[n][0] for n in used])
+        node_lng = np.array([coords[n][1] for n in used])
+
+        edges = {}
+        for refs, speed, oneway in ways:
+            refs = [r for r in refs if r in index]
+            for a, b in zip(refs, refs[1:]):
+                u, v = index[a], index[b]
+                if u == v:
+                    continue
+                seconds = haversine_km(node_lat[u], node_lng[u], node_lat[v], node_lng[v]) / speed * 3600
+                pairs = [(u, v)] if oneway == 'yes' else [(v, u)] if oneway == '-1' else [(u, v), (v, u)]
+                for edge in pairs:
+                    if seconds < edges.get(edge, float('inf')):
+                        edges[edge] = seconds
+        if not edges:
+            raise CommandError('No drivable roads found in the extract')
+
+        src, dst = (np.array(x, dtype=np.int64) for x in zip(*edges))
+        graph = RoadGraph(node_lat, node_lng, src, dst, np.array(list(edges.values())))
+        graph = self._largest_component(graph)
+
+        self.stdout.write(f'Precomputing {options["landmarks"]} landmarks...')
+        graph.compute_landmarks(options['landmarks'])
+        graph.save(output)
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {output}: {graph.num_nodes} nodes, {len(graph.forward[1])} directed edges'
+        ))
+
+    def _parse(self, source):
+        coords, ways = {}, []
+        for _, elem in ET.iterparse(source, events=('end',)):
+            if elem.tag == 'node':
+                coords[int(elem.get('id'))] = (float(elem.get('lat')), float(elem.get('lon')))
+                elem.clear()
+            elif elem.tag == 'way':
+                tags = {t.get('k'): t.get('v') for t in elem.findall('tag')}
+                highway = tags.get('highway')
+                if highway in HIGHWAY_SPEEDS and tags.get('access') not in ('no', 'private'):
+                    speed = parse_maxspeed(tags.get('maxspeed')) or HIGHWAY_SPEEDS[highway]
+                    oneway = tags.get('oneway', 'yes' if highway.startswith('motorway') else 'no')
+                    refs = [int(nd.get('ref')) for nd in elem.findall('nd')]
+                    ways.append((refs, speed, 'yes' if oneway in ('yes', 'true', '1') else oneway))
+                elem.clear()
+        return coords, ways
+
+    def _largest_component(self, graph):
+        """Drop nodes outside the largest strongly connected component so every query is routable."""
+        from scipy.sparse.csgraph import connected_components
+
+        _, labels = connected_components(graph.sparse_matrix(), directed=True, connection='strong')
+        keep = labels == np.bincount(labels).argmax()
+        if keep.all():
+            return graph
+        remap = np.full(graph.num_nodes, -1, dtype=np.int64)
+        remap[keep] = np.arange(keep.sum())
+        indptr, indices, weights = graph.forward
+        src = np.repeat(np.arange(graph.num_nodes), np.diff(indptr))
+        mask = keep[src] & keep[indices]
+        self.stdout.write(f'Dropped {int((~keep).sum())} nodes outside the main road network')
+        return RoadGraph(
+            graph.node_lat[keep], graph.node_lng[keep],
+            remap[src[mask]], remap[indices[mask]], weights[mask],
+        )
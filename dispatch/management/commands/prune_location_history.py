@@ -0,0 +1,94 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from dispatch.models import Ambulance, LocationPing
+
+DELETE_CHUNK = 5000
+
+
+class Command(BaseCommand):
+    help = (
+        'Bound the location ping history: delete pings past the retention period and thin '
+        'older pings to one per unit per rollup interval'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'LOCATION_HISTORY_RETENTION_DAYS', 90),
+                            help='Delete pings older than this many days')
+        parser.add_argument('--rollup-after', type=int,
+                            default=getattr(settings, 'LOCATION_HISTORY_FULL_RESOLUTION_DAYS', 7),
+                            help='Keep full resolution for this many days, then thin')
+        parser.add_argument('--rollup-seconds', type=int,
+                            default=getattr(settings, 'LOCATION_HISTORY_ROLLUP_SECONDS', 60),
+                            help='Keep the first ping of each unit in every interval of this length')
+        parser.add_argument('--dry-run', action='store_true', help='Count without deleting')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        expire_before = LocationPing.to_timestamp_ms(now - timedelta(days=options['days']))
+        rollup_before = LocationPing.to_timestamp_ms(now - timedelta(days=options['rollup_after']))
+        bucket = options['rollup_seconds']
+        dry_run = options['dry_run']
+
+        expired = thinned = 0
+        # Work unit by unit so every query is a range scan on the (ambulance, timestamp_ms) index
+        for ambulance_id in Ambulance.objects.order_by('id').values_list('id', flat=True):
+            pings = LocationPing.objects.filter(ambulance_id=ambulance_id)
+            expired += self._delete(
+                pings.filter(timestamp_ms__lt=expire_before).values_list('id', flat=True), dry_run
+            )
+            if bucket > 0 and rollup_before > expire_before:
+                thinned += self._delete(
+                    self._surplus_ids(pings.filter(timestamp_ms__gte=expire_before, timestamp_ms__lt=rollup_before), bucket),
+                    dry_run,
+                )
+
+        verb = 'Would delete' if dry_run else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {expired} expired pings and {thinned} pings thinned to {bucket}s resolution'
+        ))
+
+    def _surplus_ids(self, pings, bucket):
+        """
+        Ids of every ping after the first one in its rollup interval.
+
+        Pings are read in keyset pages on ``timestamp_ms`` (unique per unit),
+        each fetched in full, so no cursor is open on the table while the
+        caller deletes from it.
+        """
+        last_bucket = last_timestamp = None
+        bucket_ms = bucket * 1000
+        while True:
+            page = pings.order_by('timestamp_ms')
+            if last_timestamp is not None:
+                page = page.filter(timestamp_ms__gt=last_timestamp)
+            rows = list(page.values_list('id', 'timestamp_ms')[:DELETE_CHUNK])
+            for pk, timestamp_ms in rows:
+                current = timestamp_ms // bucket_ms
+                if current == last_bucket:
+                    yield pk
+                last_bucket = current
+            if len(rows) < DELETE_CHUNK:
+                return
+            last_timestamp = rows[-1][1]
+
+    def _delete(self, ids, dry_run):
+        total, chunk = 0, []
+        for pk in ids:
+            chunk.append(pk)
+            if len(chunk) >= DELETE_CHUNK:
+                total += self._delete_chunk(chunk, dry_run)
+                chunk = []
+        if chunk:
+            total += self._delete_chunk(chunk, dry_run)
+        return total
+
+    def _delete_chunk(self, ids, dry_run):
+        if dry_run:
+            return len(ids)
+        LocationPing.objects.filter(id__in=ids).delete()
+        return len(ids)
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispatch', '0003_alter_ambulance_current_latitude_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationPing',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('timestamp_ms', models.BigIntegerField(help_text='Fix time as Unix epoch milliseconds')),
+                ('lat_e6', models.IntegerField()),
+                ('lng_e6', models.IntegerField()),
+                ('ambulance', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='location_pings', to='dispatch.ambulance')),
+            ],
+            options={
+                'verbose_name': 'Location Ping',
+                'verbose_name_plural': 'Location Pings',
+                'constraints': [models.UniqueConstraint(fields=('ambulance', 'timestamp_ms'), name='dispatch_ping_unit_time_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dispatch', '0004_locationping'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ambulance',
+            index=models.Index(fields=['status', 'unit_number'], name='ambulance_status_unit_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ambulance',
+            index=models.Index(condition=models.Q(('status', 'AVAILABLE')), fields=['id'], name='ambulance_available_idx'),
+        ),
+    ]
@@ -3,6 +3,12 @@ from django.contrib.auth import get_user_model
 from core.models import User
 
 
+class AmbulanceQuerySet(models.QuerySet):
+    def with_related(self):
+        """Join the rows ``AmbulanceSerializer`` reads (paramedic, current call)"""
+        return self.select_related('assigned_paramedic', 'current_emergency')
+
+
 class Ambulance(models.Model):
     """Model representing an ambulance unit in the fleet"""
     
@@ -43,10 +49,17 @@ class Ambulance(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = AmbulanceQuerySet.as_manager()
+    
     class Meta:
         ordering = ['unit_number']
         verbose_name = 'Ambulance'
         verbose_name_plural = 'Ambulances'
+        indexes = [
+            models.Index(fields=['status', 'unit_number'], name='ambulance_status_unit_idx'),
+            # Units free for dispatch (assignment, distance matrix); partial where supported
+            models.Index(fields=['id'], name='ambulance_available_idx', condition=models.Q(status='AVAILABLE')),
+        ]
     
     def __str__(self):
         return f"Unit {self.unit_number} ({self.get_status_display()})"
@@ -72,7 +85,13 @@ class Ambulance(models.Model):
         self.current_longitude = round(float(longitude), 6)
         from django.utils import timezone
         self.last_location_update = timezone.now()
-        self.save()
+        # Pings go through the write-behind position store instead of a full save()
+        from .fleet_store import record_positions
+        record_positions([(self.pk, self.current_latitude, self.current_longitude, self.last_location_update)])
+    
+    # Saved by the assignment helpers; positions are left to the write-behind store,
+    # which may have flushed a newer fix than the one loaded with this instance
+    ASSIGNMENT_FIELDS = ['current_emergency', 'status', 'assigned_paramedic', 'updated_at']
     
     def assign_to_emergency(self, emergency_call, paramedic=None):
         """Assign this ambulance to an emergency call"""
@@ -80,13 +99,13 @@ class Ambulance(models.Model):
         self.status = 'EN_ROUTE'
         if paramedic:
             self.assigned_paramedic = paramedic
-        self.save()
+        self.save(update_fields=self.ASSIGNMENT_FIELDS)
     
     def complete_assignment(self):
         """Mark assignment as complete and return to available status"""
         self.current_emergency = None
         self.status = 'AVAILABLE'
-        self.save()
+        self.save(update_fields=self.ASSIGNMENT_FIELDS)
 
 
 class Hospital(models.Model):
@@ -125,3 +144,46 @@ class Hospital(models.Model):
     @property
     def location(self):
         return (float(self.latitude), float(self.longitude))
+
+
+class LocationPing(models.Model):
+    """
+    Append-only GPS history of an ambulance.
+    
+    Rows are kept compact for tables of tens of millions of pings:
+    coordinates are integer microdegrees (~0.1 m) and the fix time is Unix
+    epoch milliseconds, which also spares a datetime conversion per row
+    when a track is read back. The unique (ambulance, timestamp_ms) index
+    serves track queries and drops duplicate fixes re-sent from offline
+    buffers.
+    """
+    
+    id = models.BigAutoField(primary_key=True)
+    # The composite index below covers lookups by unit; skip the separate FK index
+    ambulance = models.ForeignKey(Ambulance, on_delete=models.CASCADE, related_name='location_pings', db_index=False)
+    timestamp_ms = models.BigIntegerField(help_text="Fix time as Unix epoch milliseconds")
+    lat_e6 = models.IntegerField()
+    lng_e6 = models.IntegerField()
+    
+    class Meta:
+        verbose_name = 'Location Ping'
+        verbose_name_plural = 'Location Pings'
+        constraints = [
+            models.UniqueConstraint(fields=['ambulance', 'timestamp_ms'], name='dispatch_ping_unit_time_uniq'),
+        ]
+    
+    def __str__(self):
+        return f"{self.ambulance_id} @ {self.recorded_at:%Y-%m-%d %H:%M:%S}"
+    
+    @staticmethod
+    def to_timestamp_ms(value):
+        return round(value.timestamp() * 1000)
+    
+    @property
+    def recorded_at(self):
+        from datetime import datetime, timezone as dt_timezone
+        return datetime.fromtimestamp(self.timestamp_ms / 1000, tz=dt_timezone.utc)
+    
+    @property
+    def location(self):
+        return (self.lat_e6 / 1e6, self.lng_e6 / 1e6)
@@ -0,0 +1,298 @@
+"""
+Offline road-network routing and ETA estimation.
+
+A road graph extract (built from OpenStreetMap data with the
+``import_road_graph`` management command) is loaded from ``ROAD_GRAPH_PATH``
+into compact CSR arrays. Point-to-point travel times are answered with A*
+guided by ALT landmark bounds (A*, Landmarks, Triangle inequality), whose
+distance tables are precomputed at import time. No network access is needed.
+
+Road estimates go through the ETA cache (``dispatch.eta_cache``). When no
+graph file is installed every estimate falls back to straight-line distance
+at ``ROUTING_FALLBACK_SPEED_KMH`` so callers never have to special case a
+missing extract.
+"""
+import heapq
+import logging
+import math
+import threading
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from .eta_cache import get_eta_cache
+from .spatial import EARTH_RADIUS_KM, haversine_km
+
+logger = logging.getLogger(__name__)
+
+Point = Tuple[float, float]
+
+# Road travel is longer than the straight line between two points
+FALLBACK_DETOUR_FACTOR = 1.3
+
+
+class RoadGraph:
+    """Directed road graph stored as forward and reverse CSR arrays."""
+
+    def __init__(self, node_lat, node_lng, edge_src, edge_dst, edge_seconds,
+                 landmarks=None, landmark_from=None, landmark_to=None):
+        self.node_lat = np.asarray(node_lat, dtype=np.float64)
+        self.node_lng = np.asarray(node_lng, dtype=np.float64)
+        self.num_nodes = len(self.node_lat)
+        src = np.asarray(edge_src, dtype=np.int64)
+        dst = np.asarray(edge_dst, dtype=np.int64)
+        secs = np.asarray(edge_seconds, dtype=np.float64)
+        self.forward = self._csr(src, dst, secs)
+        self.reverse = self._csr(dst, src, secs)
+        self.landmarks = None if landmarks is None else np.asarray(landmarks, dtype=np.int64)
+        self.landmark_from = None if landmark_from is None else np.asarray(landmark_from, dtype=np.float64)
+        self.landmark_to = None if landmark_to is None else np.asarray(landmark_to, dtype=np.float64)
+
+    def _csr(self, src, dst, secs):
+        order = np.argsort(src, kind='stable')
+        indptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.add.at(indptr, src + 1, 1)
+        np.cumsum(indptr, out=indptr)
+        return indptr, dst[order], secs[order]
+
+    def sparse_matrix(self, reverse=False):
+        from scipy.sparse import csr_matrix
+        indptr, indices, weights = self.reverse if reverse else self.forward
+        return csr_matrix((weights, indices, indptr), shape=(self.num_nodes, self.num_nodes))
+
+    def compute_landmarks(self, count: int = 8) -> None:
+        """Pick landmarks by farthest-point selection and tabulate travel times to/from them."""
+        from scipy.sparse.csgraph import dijkstra
+
+        count = min(count, self.num_nodes)
+        if count == 0:
+            return
+        fwd = self.sparse_matrix()
+        rev = self.sparse_matrix(reverse=True)
+        chosen = [int(np.argmin(self.node_lat + self.node_lng))]
+        best = dijkstra(fwd, indices=chosen[0])
+        while len(chosen) < count:
+            candidates = np.where(np.isfinite(best), best, -1.0)
+            candidates[chosen] = -1.0
+            chosen.append(int(np.argmax(candidates)))
+            best = np.minimum(best, dijkstra(fwd, indices=chosen[-1]))
+        self.landmarks = np.array(chosen, dtype=np.int64)
+        self.landmark_from = dijkstra(fwd, indices=self.landmarks)
+        self.landmark_to = dijkstra(rev, indices=self.landmarks)
+
+    def save(self, path) -> None:
+        indptr, indices, weights = self.forward
+        src = np.repeat(np.arange(self.num_nodes, dtype=np.int32), np.diff(indptr))
+        extra = {}
+        if self.landmarks is not None:
+            extra = {
+                'landmarks': self.landmarks.astype(np.int32),
+                'landmark_from': self.landmark_from.astype(np.float32),
+                'landmark_to': self.landmark_to.astype(np.float32),
+            }
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(
+            path,
+            node_lat=self.node_lat, node_lng=self.node_lng,
+            edge_src=src, edge_dst=indices.astype(np.int32), edge_seconds=weights.astype(np.float32),
+            **extra,
+        )
+
+    @classmethod
+    def load(cls, path) -> 'RoadGraph':
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in data.files}
+        return cls(**arrays)
+
+
+class RoutingEngine:
+    """Answers travel-time queries over a :class:`RoadGraph`."""
+
+    def __init__(self, graph: RoadGraph, access_speed_kmh: float = 15.0):
+        from scipy.spatial import cKDTree
+        from .distance_matrix import unit_vectors
+
+        if graph.landmarks is None:
+            graph.compute_landmarks()
+        self.graph = graph
+        self.access_speed_kmh = access_speed_kmh
+        self._tree = cKDTree(unit_vectors(np.column_stack([graph.node_lat, graph.node_lng])))
+
+        # Python lists are much faster than NumPy scalars inside the search loops
+        self._fwd = tuple(a.tolist() for a in graph.forward)
+        self._forward_matrix = graph.sparse_matrix()
+        self._reverse_matrix = graph.sparse_matrix(reverse=True)
+        lm_from = np.nan_to_num(graph.landmark_from, posinf=0.0)
+        lm_to = np.nan_to_num(graph.landmark_to, posinf=0.0)
+        # Per-node landmark vectors, (N, L), for the A* potential
+        self._lm_from = lm_from.T.tolist()
+        self._lm_to = lm_to.T.tolist()
+
+    def nearest_node(self, lat: float, lng: float) -> Tuple[int, float]:
+        """Closest graph node to a point and its distance in km."""
+        from .distance_matrix import unit_vectors
+
+        chord, node = self._tree.query(unit_vectors(np.array([[lat, lng]]))[0])
+        return int(node), 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+    def _access_seconds(self, km: float) -> float:
+        return km / self.access_speed_kmh * 3600
+
+    def _potential(self, v: int, target_from, target_to) -> float:
+        # Lower bound on travel time v -> t from the triangle inequality
+        best = 0.0
+        for f_t, f_v, t_v, t_t in zip(target_from, self._lm_from[v], self._lm_to[v], target_to):
+            bound = f_t - f_v
+            if bound > best:
+                best = bound
+            bound = t_v - t_t
+            if bound > best:
+                best = bound
+        return best
+
+    def node_travel_time(self, source: int, target: int) -> Optional[float]:
+        """Shortest travel time in seconds between two nodes (ALT A*), or None if unreachable."""
+        if source == target:
+            return 0.0
+        indptr, indices, weights = self._fwd
+        target_from = self._lm_from[target]
+        target_to = self._lm_to[target]
+        dist = {source: 0.0}
+        settled = set()
+        heap = [(self._potential(source, target_from, target_to), source)]
+        while heap:
+            _, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            if u == target:
+                return dist[u]
+            settled.add(u)
+            du = dist[u]
+            for e in range(indptr[u], indptr[u + 1]):
+                v = indices[e]
+                nd = du + weights[e]
+                if nd < dist.get(v, math.inf):
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd + self._potential(v, target_from, target_to), v))
+        return None
+
+    def travel_time(self, origin: Point, destination: Point) -> Optional[float]:
+        """Door-to-door travel time in seconds between two coordinates."""
+        s, s_km = self.nearest_node(*origin)
+        t, t_km = self.nearest_node(*destination)
+        seconds = self.node_travel_time(s, t)
+        if seconds is None:
+            return None
+        return seconds + self._access_seconds(s_km) + self._access_seconds(t_km)
+
+    def _one_to_many(self, matrix, point: Point, others: Sequence[Point]) -> List[Optional[float]]:
+        from scipy.sparse.csgraph import dijkstra
+
+        root, root_km = self.nearest_node(*point)
+        snapped = [self.nearest_node(*o) for o in others]
+        dist = dijkstra(matrix, indices=root)
+        access = self._access_seconds(root_km)
+        return [
+            float(dist[node]) + self._access_seconds(km) + access if math.isfinite(dist[node]) else None
+            for node, km in snapped
+        ]
+
+    def travel_times_to(self, destination: Point, origins: Sequence[Point]) -> List[Optional[float]]:
+        """
+        Travel times from many origins (e.g. candidate ambulances) to one destination.
+
+        Runs a single backward Dijkstra (SciPy, compiled) from the destination
+        instead of one A* search per origin.
+        """
+        return self._one_to_many(self._reverse_matrix, destination, origins)
+
+    def travel_times_from(self, origin: Point, destinations: Sequence[Point]) -> List[Optional[float]]:
+        """Travel times from one origin (e.g. a scene) to many destinations such as hospitals."""
+        return self._one_to_many(self._forward_matrix, origin, destinations)
+
+
+_engine: Optional[RoutingEngine] = None
+_engine_loaded = False
+_engine_lock = threading.Lock()
+
+
+def get_routing_engine() -> Optional[RoutingEngine]:
+    """Return the process-wide routing engine, or None when no road graph is installed."""
+    global _engine, _engine_loaded
+    if not _engine_loaded:
+        with _engine_lock:
+            if not _engine_loaded:
+                path = Path(getattr(settings, 'ROAD_GRAPH_PATH', ''))
+                if path.is_file():
+                    try:
+                        _engine = RoutingEngine(
+                            RoadGraph.load(path),
+                            access_speed_kmh=getattr(settings, 'ROUTING_ACCESS_SPEED_KMH', 15.0),
+                        )
+                        logger.info(f"Road graph loaded from {path} ({_engine.graph.num_nodes} nodes)")
+                    except Exception as e:
+                        logger.warning(f"Failed to load road graph {path}: {e}", exc_info=True)
+                else:
+                    logger.info("No road graph installed; ETAs use straight-line estimates")
+                _engine_loaded = True
+    return _engine
+
+
+def straight_line_seconds(origin: Point, destination: Point) -> float:
+    km = haversine_km(*origin, *destination) * FALLBACK_DETOUR_FACTOR
+    return km / getattr(settings, 'ROUTING_FALLBACK_SPEED_KMH', 40.0) * 3600
+
+
+def estimate_travel_time(origin: Point, destination: Point) -> Tuple[float, str]:
+    """
+    Best available travel-time estimate in seconds.
+
+    Road results are served from / stored in the ETA cache.
+
+    Returns:
+        ``(seconds, source)`` where source is ``'road'`` or ``'straight_line'``
+    """
+    engine = get_routing_engine()
+    if engine is not None:
+        cache = get_eta_cache()
+        seconds = cache.get(origin, destination)
+        if seconds is None:
+            seconds = engine.travel_time(origin, destination)
+            if seconds is not None:
+                cache.set(origin, destination, seconds)
+        if seconds is not None:
+            return seconds, 'road'
+    return straight_line_seconds(origin, destination), 'straight_line'
+
+
+def _estimate_many(method_name: str, point: Point, others: Sequence[Point], reverse: bool):
+    # Orient every pair as (from, to) so cache keys match single-pair lookups
+    pairs = [(other, point) if reverse else (point, other) for other in others]
+    road = [None] * len(pairs)
+    engine = get_routing_engine()
+    if engine is not None and pairs:
+        cache = get_eta_cache()
+        road = [cache.get(a, b) for a, b in pairs]
+        missing = [i for i, seconds in enumerate(road) if seconds is None]
+        if missing:
+            computed = getattr(engine, method_name)(point, [others[i] for i in missing])
+            for i, seconds in zip(missing, computed):
+                if seconds is not None:
+                    cache.set(*pairs[i], seconds)
+                    road[i] = seconds
+    return [
+        (seconds, 'road') if seconds is not None else (straight_line_seconds(a, b), 'straight_line')
+        for (a, b), seconds in zip(pairs, road)
+    ]
+
+
+def estimate_travel_times_to(destination: Point, origins: Sequence[Point]) -> List[Tuple[float, str]]:
+    """Many-to-one variant of :func:`estimate_travel_time`."""
+    return _estimate_many('travel_times_to', destination, origins, reverse=True)
+
+
+def estimate_travel_times_from(origin: Point, destinations: Sequence[Point]) -> List[Tuple[float, str]]:
+    """One-to-many variant of :func:`estimate_travel_time`."""
+    return _estimate_many('travel_times_from', origin, destinations, reverse=False)
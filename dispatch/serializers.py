@@ -1,5 +1,9 @@
+from django.conf import settings
+from django.utils import timezone
 from rest_framework import serializers
 from .models import Ambulance, Hospital
+from .fleet_store import get_fleet_store
+from .locations import parse_location_point
 from core.models import User
 
 
@@ -21,6 +25,29 @@ class AmbulanceSerializer(serializers.ModelSerializer):
             'created_at', 'updated_at'
         ]
         read_only_fields = ['created_at', 'updated_at', 'last_location_update']
+    
+    def to_representation(self, instance):
+        # Positions may not have been flushed to the row yet
+        get_fleet_store().overlay(instance)
+        return super().to_representation(instance)
+    
+    def update(self, instance, validated_data):
+        # Only the fields sent are written: a full save would put back the position
+        # loaded with the instance over a newer fix the write-behind store flushed.
+        # A position sent here is recorded as a fix like any other.
+        lat = validated_data.pop('current_latitude', None)
+        lng = validated_data.pop('current_longitude', None)
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        if lat is not None or lng is not None:
+            # A lone coordinate pairs with the unit's newest known fix
+            get_fleet_store().overlay(instance)
+            lat = instance.current_latitude if lat is None else lat
+            lng = instance.current_longitude if lng is None else lng
+            if lat is not None and lng is not None:
+                instance.update_location(lat, lng)
+        return instance
 
 
 class AmbulanceLocationUpdateSerializer(serializers.ModelSerializer):
@@ -44,6 +71,40 @@ class AmbulanceLocationUpdateSerializer(serializers.ModelSerializer):
         return data
 
 
+class LocationBatchSerializer(serializers.Serializer):
+    """
+    Many timestamped GPS points in one request.
+
+    Points are plain dicts ``{"latitude", "longitude", "recorded_at"?, "ambulance_id"?}``
+    checked in a single pass rather than through a nested serializer per
+    point. ``ambulance_id`` at the top level applies to points that omit it
+    (one unit flushing its offline buffer); a gateway sets it per point.
+    """
+    
+    ambulance_id = serializers.IntegerField(required=False)
+    points = serializers.ListField(child=serializers.DictField(), allow_empty=False)
+    
+    def validate_points(self, value):
+        max_points = getattr(settings, 'LOCATION_BATCH_MAX_POINTS', 1000)
+        if len(value) > max_points:
+            raise serializers.ValidationError(f"At most {max_points} points per batch")
+        return value
+    
+    def validate(self, data):
+        default_id = data.get('ambulance_id')
+        now = timezone.now()
+        points, errors = [], {}
+        for i, raw in enumerate(data['points']):
+            try:
+                points.append(parse_location_point(raw, default_id, now))
+            except ValueError as e:
+                errors[i] = str(e)
+        if errors:
+            raise serializers.ValidationError({'points': errors})
+        data['points'] = points
+        return data
+
+
 class HospitalSerializer(serializers.ModelSerializer):
     """Serializer for Hospital model"""
     
@@ -109,3 +170,23 @@ class DispatchSerializer(serializers.Serializer):
             except Hospital.DoesNotExist:
                 raise serializers.ValidationError("Hospital not found")
         return value
+
+
+class BatchAssignmentSerializer(serializers.Serializer):
+    """A single call/unit pair of a batch dispatch plan"""
+    
+    emergency_call_id = serializers.IntegerField()
+    ambulance_id = serializers.IntegerField()
+
+
+class BatchDispatchSerializer(serializers.Serializer):
+    """Serializer for batch dispatch; omitting assignments applies a freshly computed plan"""
+    
+    assignments = BatchAssignmentSerializer(many=True, required=False)
+    
+    def validate_assignments(self, value):
+        calls = [a['emergency_call_id'] for a in value]
+        units = [a['ambulance_id'] for a in value]
+        if len(set(calls)) != len(calls) or len(set(units)) != len(units):
+            raise serializers.ValidationError("Each call and each ambulance may appear only once")
+        return value
@@ -0,0 +1,21 @@
+"""
+Model signal handlers keeping in-memory dispatch state in sync with the database.
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .fleet_store import get_fleet_store
+from .models import Ambulance
+from .spatial import discard_ambulance, sync_ambulance
+
+
+@receiver(post_save, sender=Ambulance)
+def ambulance_saved(sender, instance, **kwargs):
+    """Move/add/remove the unit in the fleet spatial index"""
+    sync_ambulance(instance)
+
+
+@receiver(post_delete, sender=Ambulance)
+def ambulance_deleted(sender, instance, **kwargs):
+    discard_ambulance(instance.pk)
+    get_fleet_store().discard(instance.pk)
@@ -0,0 +1,243 @@
+"""
+In-memory spatial indexing for ambulance positions.
+
+Ambulances are bucketed on a fixed latitude/longitude grid so that
+k-nearest lookups only visit the cells surrounding the query point
+instead of scanning and sorting the whole fleet on every dispatch.
+"""
+import heapq
+import logging
+import math
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180.0
+
+Cell = Tuple[int, int]
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance between two points in kilometres."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+    """
+    Uniform grid over latitude/longitude supporting incremental updates
+    and k-nearest-neighbour queries.
+
+    Keys can be any hashable (ambulance ids, gazetteer rows, ...). All
+    methods are thread-safe.
+    """
+
+    def __init__(self, cell_size_deg: float = 0.02):
+        self.cell_size = float(cell_size_deg)
+        self._cells: Dict[Cell, Dict[Hashable, Tuple[float, float]]] = {}
+        self._points: Dict[Hashable, Tuple[float, float, Cell]] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def cell_for(self, lat: float, lng: float) -> Cell:
+        return (math.floor(lat / self.cell_size), math.floor(lng / self.cell_size))
+
+    def position(self, key) -> Optional[Tuple[float, float]]:
+        point = self._points.get(key)
+        return (point[0], point[1]) if point else None
+
+    def insert(self, key, lat: float, lng: float) -> None:
+        """Insert or move a point."""
+        lat, lng = float(lat), float(lng)
+        cell = self.cell_for(lat, lng)
+        with self._lock:
+            old = self._points.get(key)
+            if old is not None and old[2] != cell:
+                self._discard_from_cell(key, old[2])
+            self._cells.setdefault(cell, {})[key] = (lat, lng)
+            self._points[key] = (lat, lng, cell)
+
+    def remove(self, key) -> None:
+        with self._lock:
+            old = self._points.pop(key, None)
+            if old is not None:
+                self._discard_from_cell(key, old[2])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cells.clear()
+            self._points.clear()
+
+    def _discard_from_cell(self, key, cell: Cell) -> None:
+        bucket = self._cells.get(cell)
+        if bucket is None:
+            return
+        bucket.pop(key, None)
+        if not bucket:
+            del self._cells[cell]
+
+    def _ring_lower_bound_km(self, lat: float, ring: int) -> float:
+        """Smallest possible distance to any point in cells ``ring`` steps away."""
+        if ring <= 1:
+            return 0.0
+        span = (ring - 1) * self.cell_size
+        # Longitude degrees shrink towards the poles; use the worst case
+        # latitude the ring can reach so the bound stays conservative.
+        worst_lat = min(89.9, abs(lat) + ring * self.cell_size)
+        return span * KM_PER_DEGREE * math.cos(math.radians(worst_lat))
+
+    def nearest(self, lat: float, lng: float, k: int = 5,
+                max_distance_km: Optional[float] = None) -> List[Tuple[Hashable, float]]:
+        """
+        Return up to ``k`` ``(key, distance_km)`` pairs ordered by distance.
+
+        Cells are visited in expanding square rings around the query cell
+        and the search stops as soon as no unvisited ring can contain a
+        closer point than the current k-th best.
+        """
+        if k <= 0:
+            return []
+        lat, lng = float(lat), float(lng)
+        with self._lock:
+            if not self._points:
+                return []
+            qy, qx = self.cell_for(lat, lng)
+            max_ring = max(max(abs(cy - qy), abs(cx - qx)) for cy, cx in self._cells)
+            heap: List[Tuple[float, int, Hashable]] = []  # max-heap via negated distance
+            counter = 0
+
+            def consider(bucket):
+                nonlocal counter
+                for key, (plat, plng) in bucket.items():
+                    d = haversine_km(lat, lng, plat, plng)
+                    if max_distance_km is not None and d > max_distance_km:
+                        continue
+                    counter += 1
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-d, counter, key))
+                    elif d < -heap[0][0]:
+                        heapq.heapreplace(heap, (-d, counter, key))
+
+            for ring in range(max_ring + 1):
+                bound = self._ring_lower_bound_km(lat, ring)
+                if max_distance_km is not None and bound > max_distance_km:
+                    break
+                if len(heap) == k and bound > -heap[0][0]:
+                    break
+                if 8 * ring > len(self._cells):
+                    # The ring has more cells than the grid has occupied
+                    # cells; finish with a direct pass over what is left.
+                    for (cy, cx), bucket in self._cells.items():
+                        if max(abs(cy - qy), abs(cx - qx)) >= ring:
+                            consider(bucket)
+                    break
+                for cell in self._ring_cells(qy, qx, ring):
+                    bucket = self._cells.get(cell)
+                    if bucket:
+                        consider(bucket)
+
+        return [(key, -neg_d) for neg_d, _, key in sorted(heap, reverse=True)]
+
+    @staticmethod
+    def _ring_cells(qy: int, qx: int, ring: int):
+        if ring == 0:
+            yield (qy, qx)
+            return
+        for dx in range(-ring, ring + 1):
+            yield (qy - ring, qx + dx)
+            yield (qy + ring, qx + dx)
+        for dy in range(-ring + 1, ring):
+            yield (qy + dy, qx - ring)
+            yield (qy + dy, qx + ring)
+
+
+# Fleet index of AVAILABLE ambulances (one per process, built lazily)
+_fleet_index: Optional[GridIndex] = None
+_fleet_index_built_at = 0.0
+_fleet_index_lock = threading.Lock()
+
+
+def _fleet_index_is_current() -> bool:
+    if _fleet_index is None:
+        return False
+    # Signals only reach the index from saves made in this process; units
+    # freed by another worker are picked up when the index is reloaded
+    max_age = getattr(settings, 'FLEET_INDEX_MAX_AGE', 30)
+    return not max_age or time.monotonic() - _fleet_index_built_at < max_age
+
+
+def get_fleet_index() -> GridIndex:
+    """
+    Return the process-wide index of available ambulances, loading it on
+    first use and again every ``FLEET_INDEX_MAX_AGE`` seconds.
+    """
+    global _fleet_index, _fleet_index_built_at
+    if not _fleet_index_is_current():
+        with _fleet_index_lock:
+            if not _fleet_index_is_current():
+                built_at = time.monotonic()
+                _fleet_index = _build_fleet_index()
+                _fleet_index_built_at = built_at
+    return _fleet_index
+
+
+def _build_fleet_index() -> GridIndex:
+    from .fleet_store import get_fleet_store
+    from .models import Ambulance
+
+    index = GridIndex(getattr(settings, 'FLEET_INDEX_CELL_SIZE_DEG', 0.02))
+    rows = Ambulance.objects.filter(
+        status='AVAILABLE',
+        current_latitude__isnull=False,
+        current_longitude__isnull=False,
+    ).values_list('id', 'current_latitude', 'current_longitude')
+    for pk, lat, lng in get_fleet_store().overlay_rows(rows):
+        index.insert(pk, lat, lng)
+    logger.info(f"Fleet spatial index loaded with {len(index)} available units")
+    return index
+
+
+def sync_ambulance(ambulance) -> None:
+    """Reflect an ambulance's current status/position in the fleet index."""
+    if _fleet_index is None:
+        # Nothing loaded yet; the first query will read fresh rows.
+        return
+    from .fleet_store import get_fleet_store
+    get_fleet_store().overlay(ambulance)
+    if ambulance.is_available and ambulance.current_location:
+        _fleet_index.insert(ambulance.pk, *ambulance.current_location)
+    else:
+        _fleet_index.remove(ambulance.pk)
+
+
+def move_ambulance(ambulance_id, lat: float, lng: float) -> None:
+    """Update the position of a unit that is already indexed (i.e. available)."""
+    index = _fleet_index
+    if index is not None and ambulance_id in index:
+        index.insert(ambulance_id, lat, lng)
+
+
+def discard_ambulance(ambulance_id) -> None:
+    if _fleet_index is not None:
+        _fleet_index.remove(ambulance_id)
+
+
+def reset_fleet_index() -> None:
+    """Drop the cached index so the next query reloads it from the database."""
+    global _fleet_index
+    with _fleet_index_lock:
+        _fleet_index = None
@@ -1,3 +1,761 @@
-from django.test import TestCase
+import random
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from core.models import OutboxEvent, User
+from core.snapshot import DispatcherSnapshot
+from core.utils import build_group_messages
+from emergencies.tests import assert_index_scan, make_board
+from . import eta_cache, fleet_store, routing, spatial
+from .assignment import priority_rank, solve_greedy, solve_optimal, triage_order
+from .distance_matrix import DistanceMatrix, haversine_matrix
+from .eta_cache import ETACache
+from .fleet_store import FleetPositionStore, get_fleet_store
+from .models import Ambulance, LocationPing
+from .routing import RoadGraph, RoutingEngine
+from .serializers import AmbulanceSerializer
+from .tracks import decode_polyline, encode_polyline, simplify_track
+
+
+def use_fresh_fleet_store(test):
+    """Give ``test`` an empty write-through position store, so fixes from other tests don't overlay its rows."""
+    patcher = mock.patch.object(fleet_store, '_store', FleetPositionStore(flush_interval=0))
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0)
+class AmbulanceListQueryBudgetTests(TestCase):
+    """The fleet list runs a fixed number of queries however large the fleet is"""
+
+    @classmethod
+    def setUpTestData(cls):
+        make_board()
+
+    def test_ambulance_list(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.get(username='dispatcher0'))
+        with self.assertNumQueries(1):
+            response = client.get('/dispatch/api/ambulances/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 30)
+        self.assertTrue(all(a['assigned_paramedic_name'] and a['current_emergency_id'] for a in response.data))
+
+
+@skipUnless(connection.vendor in ('sqlite', 'postgresql'), 'EXPLAIN output is checked for SQLite and PostgreSQL')
+class AmbulanceIndexPlanTests(TestCase):
+    """Units free for dispatch are found through an index, not a fleet scan"""
+
+    @classmethod
+    def setUpTestData(cls):
+        statuses = ['EN_ROUTE', 'ON_SCENE', 'TRANSPORTING', 'MAINTENANCE']
+        Ambulance.objects.bulk_create([
+            Ambulance(unit_number=f'AMB-{i:04d}', status='AVAILABLE' if i % 10 == 0 else statuses[i % len(statuses)])
+            for i in range(2000)
+        ])
+
+    def test_available_units(self):
+        table = Ambulance._meta.db_table
+        # dispatch.assignment / dispatch.distance_matrix
+        assert_index_scan(self, Ambulance.objects.filter(status='AVAILABLE').order_by('id'), table)
+        assert_index_scan(self, Ambulance.objects.filter(status='AVAILABLE'), table, ordered=True)
+
+
+class GridIndexTests(SimpleTestCase):
+    """k-nearest lookups on the grid agree with a full scan"""
+
+    def setUp(self):
+        self.index = spatial.GridIndex(cell_size_deg=0.02)
+
+    def brute_force(self, points, lat, lng, k, max_distance_km=None):
+        ranked = sorted((spatial.haversine_km(lat, lng, plat, plng), key) for key, (plat, plng) in points.items())
+        if max_distance_km is not None:
+            ranked = [(d, key) for d, key in ranked if d <= max_distance_km]
+        return [key for _, key in ranked[:k]]
+
+    def test_ring_search_matches_full_scan(self):
+        rng = random.Random(7)
+        points = {i: (8.3 + rng.random() * 0.4, -13.3 + rng.random() * 0.4) for i in range(300)}
+        for key, (lat, lng) in points.items():
+            self.index.insert(key, lat, lng)
+        for _ in range(50):
+            lat, lng = 8.3 + rng.random() * 0.4, -13.3 + rng.random() * 0.4
+            found = self.index.nearest(lat, lng, k=5)
+            self.assertEqual([key for key, _ in found], self.brute_force(points, lat, lng, 5))
+            distances = [d for _, d in found]
+            self.assertEqual(distances, sorted(distances))
+
+    def test_points_across_a_cell_boundary(self):
+        # 0.02 degree cells: 8.48 is a boundary; the closer point sits in the next cell
+        self.index.insert('same-cell', 8.4999, -13.2399)
+        self.index.insert('next-cell', 8.4795, -13.2301)
+        self.assertEqual(self.index.cell_for(8.4801, -13.23)[0] - self.index.cell_for(8.4795, -13.23)[0], 1)
+        self.assertEqual(self.index.nearest(8.4801, -13.2301, k=1)[0][0], 'next-cell')
+
+    def test_limit_and_max_distance(self):
+        for i in range(10):
+            self.index.insert(i, 8.48 + i * 0.01, -13.23)
+        self.assertEqual([key for key, _ in self.index.nearest(8.48, -13.23, k=3)], [0, 1, 2])
+        self.assertEqual(self.index.nearest(8.48, -13.23, k=0), [])
+        # 0.01 degrees of latitude is about 1.1 km
+        self.assertEqual([key for key, _ in self.index.nearest(8.48, -13.23, k=10, max_distance_km=2.5)], [0, 1, 2])
+
+    def test_move_and_discard(self):
+        spatial.reset_fleet_index()
+        self.addCleanup(spatial.reset_fleet_index)
+        spatial._fleet_index = self.index
+        self.index.insert(1, 8.48, -13.23)
+        self.index.insert(2, 8.60, -13.10)
+        spatial.move_ambulance(2, 8.481, -13.231)
+        self.assertEqual(self.index.nearest(8.481, -13.231, k=1)[0][0], 2)
+        self.assertEqual(len(self.index._cells), 1)
+        # Units that aren't indexed (not available) aren't added by a move
+        spatial.move_ambulance(3, 8.48, -13.23)
+        self.assertNotIn(3, self.index)
+        spatial.discard_ambulance(2)
+        self.assertEqual([key for key, _ in self.index.nearest(8.481, -13.231, k=5)], [1])
+
+
+class HaversineMatrixTests(SimpleTestCase):
+    """The vectorized matrix agrees with the scalar haversine"""
+
+    def test_matches_scalar_haversine(self):
+        rng = random.Random(11)
+        origins, destinations = [], []
+        for _ in range(200):
+            lat, lng = rng.uniform(-60, 60), rng.uniform(-180, 180)
+            # From coincident points up to ~100 km apart, where the chord form is weakest
+            spread = 10 ** rng.uniform(-9, 0)
+            origins.append((lat, lng))
+            destinations.append((lat + rng.uniform(-spread, spread), lng + rng.uniform(-spread, spread)))
+        matrix = haversine_matrix(np.array(origins), np.array(destinations))
+        self.assertEqual(matrix.shape, (200, 200))
+        for i, (lat, lng) in enumerate(origins):
+            for j in (i, (i + 1) % 200):
+                self.assertAlmostEqual(matrix[i, j], spatial.haversine_km(lat, lng, *destinations[j]),
+                                       delta=2.5e-4)
+
+    def test_nearest_per_row(self):
+        matrix = DistanceMatrix(call_ids=[1, 2], ambulance_ids=[10, 11, 12],
+                                distances_km=np.array([[3.0, 1.0, 2.0], [0.5, 4.0, 0.1]]))
+        idx, dist = matrix.nearest(2)
+        self.assertEqual(idx.tolist(), [[1, 2], [2, 0]])
+        self.assertEqual(dist.tolist(), [[1.0, 2.0], [0.1, 0.5]])
+        self.assertEqual(matrix.nearest(5)[0].shape, (2, 3))
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0)
+class DistanceMatrixViewTests(TestCase):
+    """Pending calls x available units over the API"""
+
+    def setUp(self):
+        from emergencies.models import EmergencyCall
+
+        use_fresh_fleet_store(self)
+        self.call = EmergencyCall.objects.create(
+            caller_name='Caller', caller_phone='+23276123456', emergency_type='MEDICAL',
+            description='Matrix fixture', location_address='Freetown', latitude=8.48, longitude=-13.23,
+        )
+        self.near = Ambulance.objects.create(unit_number='AMB-910', current_latitude=8.481, current_longitude=-13.231)
+        self.far = Ambulance.objects.create(unit_number='AMB-911', current_latitude=8.6, current_longitude=-13.1)
+        Ambulance.objects.create(unit_number='AMB-912', status='EN_ROUTE', current_latitude=8.48, current_longitude=-13.23)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('dispatcher', role='dispatcher'))
+
+    def test_full_matrix(self):
+        response = self.client.get('/dispatch/api/distance-matrix/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['calls'], [self.call.pk])
+        self.assertEqual(response.data['ambulances'], [self.near.pk, self.far.pk])
+        near_km, far_km = response.data['distances_km'][0]
+        self.assertLess(near_km, 0.2)
+        self.assertGreater(far_km, 15)
+
+    def test_nearest(self):
+        response = self.client.get('/dispatch/api/distance-matrix/', {'nearest': 1})
+        self.assertEqual([item['ambulance_id'] for item in response.data['nearest'][self.call.pk]], [self.near.pk])
+        self.assertEqual(self.client.get('/dispatch/api/distance-matrix/', {'nearest': 'x'}).status_code, 400)
+
+    def test_dispatchers_only(self):
+        self.client.force_authenticate(User.objects.create_user('medic', role='paramedic'))
+        self.assertEqual(self.client.get('/dispatch/api/distance-matrix/').status_code, 403)
+
+
+class AssignmentSolverTests(SimpleTestCase):
+    """Triage order and the global matching"""
+
+    def test_triage_order(self):
+        priorities = ['LOW', 'CRITICAL', 'UNKNOWN', 'MEDIUM', 'CRITICAL']
+        self.assertEqual(triage_order(priorities).tolist(), [1, 4, 3, 0, 2])
+        self.assertGreater(priority_rank('UNKNOWN'), priority_rank('LOW'))
+
+    def test_optimal_beats_greedy(self):
+        # Greedy gives call 0 its nearest unit and strands call 1 10 km away
+        distances = np.array([[1.0, 2.0], [1.5, 10.0]])
+        priorities = ['MEDIUM', 'MEDIUM']
+        self.assertEqual(sorted(solve_greedy(distances, priorities)), [(0, 0), (1, 1)])
+        self.assertEqual(sorted(solve_optimal(distances, priorities)), [(0, 1), (1, 0)])
+
+    def test_more_calls_than_units_keeps_the_urgent_ones(self):
+        distances = np.array([[0.1], [5.0], [0.2]])
+        self.assertEqual(solve_optimal(distances, ['LOW', 'CRITICAL', 'MEDIUM']), [(1, 0)])
+        self.assertEqual(solve_optimal(np.empty((2, 0)), ['LOW', 'LOW']), [])
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0)
+class BatchDispatchTests(TestCase):
+    """Planning and applying a surge assignment over the API"""
+
+    def setUp(self):
+        from emergencies.models import EmergencyCall
+
+        use_fresh_fleet_store(self)
+        self.calls = [
+            EmergencyCall.objects.create(
+                caller_name='Caller', caller_phone='+23276123456', emergency_type='MEDICAL',
+                description='Surge fixture', location_address='Freetown', latitude=8.48 + i * 0.05,
+                longitude=-13.23, priority=priority,
+            )
+            for i, priority in enumerate(['LOW', 'CRITICAL', 'HIGH'])
+        ]
+        self.units = [
+            Ambulance.objects.create(unit_number=f'AMB-92{i}', current_latitude=8.48 + i * 0.05,
+                                     current_longitude=-13.231)
+            for i in range(2)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('dispatcher', role='dispatcher'))
+
+    def test_plan(self):
+        response = self.client.get('/dispatch/api/batch-dispatch/')
+        self.assertEqual(response.status_code, 200)
+        # Two units for three calls: the LOW call waits, the most urgent is listed first
+        self.assertEqual([a['emergency_call_id'] for a in response.data['assignments']],
+                         [self.calls[1].pk, self.calls[2].pk])
+        self.assertEqual(response.data['unassigned_call_ids'], [self.calls[0].pk])
+
+    def test_apply_skips_stale_pairs(self):
+        Ambulance.objects.filter(pk=self.units[0].pk).update(status='MAINTENANCE')
+        pairs = [
+            {'emergency_call_id': self.calls[1].pk, 'ambulance_id': self.units[1].pk},
+            {'emergency_call_id': self.calls[2].pk, 'ambulance_id': self.units[0].pk},
+        ]
+        response = self.client.post('/dispatch/api/batch-dispatch/', {'assignments': pairs}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['dispatched'], [pairs[0]])
+        self.assertEqual(response.data['skipped'], [pairs[1]])
+        self.calls[1].refresh_from_db()
+        self.assertEqual((self.calls[1].status, self.calls[1].assigned_ambulance_id), ('DISPATCHED', self.units[1].pk))
+        self.assertEqual(Ambulance.objects.get(pk=self.units[1].pk).status, 'EN_ROUTE')
+
+    def test_pairs_must_be_distinct(self):
+        pairs = [{'emergency_call_id': call.pk, 'ambulance_id': self.units[0].pk} for call in self.calls[:2]]
+        response = self.client.post('/dispatch/api/batch-dispatch/', {'assignments': pairs}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+def make_road_graph(size=6, seed=3):
+    """
+    ``size`` x ``size`` grid of junctions 0.01 degrees apart with random,
+    partly one-way travel times, plus one isolated junction (the last node).
+    """
+    rng = random.Random(seed)
+    lat, lng, src, dst, secs = [], [], [], [], []
+    for i in range(size):
+        for j in range(size):
+            lat.append(8.40 + i * 0.01)
+            lng.append(-13.30 + j * 0.01)
+    for i in range(size):
+        for j in range(size):
+            u = i * size + j
+            for v in ([u + 1] if j + 1 < size else []) + ([u + size] if i + 1 < size else []):
+                src.append(u), dst.append(v), secs.append(rng.uniform(30, 120))
+                if rng.random() < 0.8:
+                    src.append(v), dst.append(u), secs.append(rng.uniform(30, 120))
+    lat.append(8.60), lng.append(-13.00)
+    return RoadGraph(lat, lng, src, dst, secs)
+
+
+class RoadGraphRoutingTests(SimpleTestCase):
+    """ALT A* and the one-to-many Dijkstra agree with SciPy on a fixture graph"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.engine = RoutingEngine(make_road_graph(), access_speed_kmh=15.0)
+        cls.graph = cls.engine.graph
+        cls.exact = dijkstra(cls.graph.sparse_matrix())
+
+    def test_csr_holds_every_edge(self):
+        indptr, indices, weights = self.graph.forward
+        rev_indptr, rev_indices, _ = self.graph.reverse
+        self.assertEqual(indptr[-1], len(indices))
+        self.assertEqual(rev_indptr[-1], len(indices))
+        # Node 0 is a corner: edges to 1 and 6 at most
+        self.assertTrue(set(indices[indptr[0]:indptr[1]]) <= {1, 6})
+        self.assertEqual(indptr[self.graph.num_nodes - 1], indptr[self.graph.num_nodes])
+
+    def test_landmark_bounds_are_admissible(self):
+        for target in range(0, self.graph.num_nodes - 1, 5):
+            target_from, target_to = self.engine._lm_from[target], self.engine._lm_to[target]
+            for v in range(self.graph.num_nodes - 1):
+                if np.isfinite(self.exact[v, target]):
+                    self.assertLessEqual(self.engine._potential(v, target_from, target_to),
+                                         self.exact[v, target] + 1e-3)
+
+    def test_a_star_matches_dijkstra(self):
+        for source in range(self.graph.num_nodes):
+            for target in range(self.graph.num_nodes):
+                found = self.engine.node_travel_time(source, target)
+                if np.isfinite(self.exact[source, target]):
+                    self.assertAlmostEqual(found, self.exact[source, target], places=6)
+                else:
+                    self.assertIsNone(found)
+
+    def test_one_to_many_matches_dijkstra(self):
+        nodes = list(range(self.graph.num_nodes))
+        points = [(self.graph.node_lat[n], self.graph.node_lng[n]) for n in nodes]
+        # Points sit on their nodes, so no access time is added
+        from_first = self.engine.travel_times_from(points[0], points)
+        to_first = self.engine.travel_times_to(points[0], points)
+        for n in nodes[:-1]:
+            if np.isfinite(self.exact[0, n]):
+                self.assertAlmostEqual(from_first[n], self.exact[0, n], places=3)
+            if np.isfinite(self.exact[n, 0]):
+                self.assertAlmostEqual(to_first[n], self.exact[n, 0], places=3)
+        # The isolated junction can't be reached either way
+        self.assertIsNone(from_first[-1])
+        self.assertIsNone(to_first[-1])
+        self.assertIsNone(self.engine.travel_time(points[0], points[-1]))
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'graph.npz'
+            self.graph.save(path)
+            loaded = RoadGraph.load(path)
+        self.assertEqual(loaded.num_nodes, self.graph.num_nodes)
+        self.assertEqual(loaded.landmarks.tolist(), self.graph.landmarks.tolist())
+        self.assertAlmostEqual(RoutingEngine(loaded).node_travel_time(0, 35), self.exact[0, 35], places=1)
+
+
+class TravelTimeEstimateTests(SimpleTestCase):
+    """Road estimates go through the ETA cache and fall back to straight lines"""
+
+    def setUp(self):
+        self.graph = make_road_graph()
+        self.cache = ETACache()
+        for patcher in (mock.patch.object(eta_cache, '_eta_cache', self.cache),
+                        mock.patch.object(routing, '_engine_loaded', True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.origin = (self.graph.node_lat[0], self.graph.node_lng[0])
+        self.destination = (self.graph.node_lat[35], self.graph.node_lng[35])
+        self.isolated = (self.graph.node_lat[-1], self.graph.node_lng[-1])
+
+    def use_engine(self, engine):
+        patcher = mock.patch.object(routing, '_engine', engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_without_a_graph(self):
+        self.use_engine(None)
+        seconds, source = routing.estimate_travel_time(self.origin, self.destination)
+        self.assertEqual(source, 'straight_line')
+        self.assertAlmostEqual(seconds, routing.straight_line_seconds(self.origin, self.destination))
+        self.assertEqual([s for _, s in routing.estimate_travel_times_to(self.destination, [self.origin])],
+                         ['straight_line'])
+
+    def test_road_estimates_are_cached(self):
+        engine = RoutingEngine(self.graph)
+        self.use_engine(engine)
+        seconds, source = routing.estimate_travel_time(self.origin, self.destination)
+        self.assertEqual(source, 'road')
+        with mock.patch.object(engine, 'travel_time') as travel_time:
+            self.assertEqual(routing.estimate_travel_time(self.origin, self.destination), (seconds, 'road'))
+        travel_time.assert_not_called()
+        # The many-to-one variant shares the single-pair cache entry
+        with mock.patch.object(engine, 'travel_times_to') as travel_times_to:
+            self.assertEqual(routing.estimate_travel_times_to(self.destination, [self.origin]), [(seconds, 'road')])
+        travel_times_to.assert_not_called()
+
+    def test_unreachable_falls_back_to_straight_line(self):
+        self.use_engine(RoutingEngine(self.graph))
+        self.assertEqual(routing.estimate_travel_time(self.origin, self.isolated)[1], 'straight_line')
+        estimates = routing.estimate_travel_times_from(self.origin, [self.destination, self.isolated])
+        self.assertEqual([source for _, source in estimates], ['road', 'straight_line'])
+        self.assertEqual(self.cache.stats()['size'], 1)
+
+
+class ETACacheTests(SimpleTestCase):
+    """Cell-keyed LRU with TTL and time-of-day bands"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = ETACache(max_entries=2, ttl_seconds=60, cell_size_deg=0.005, clock=lambda: self.now)
+
+    def test_nearby_points_share_an_entry(self):
+        self.cache.set((8.4801, -13.2301), (8.5001, -13.2001), 300)
+        self.assertEqual(self.cache.get((8.4809, -13.2309), (8.5009, -13.2009)), 300)
+        # The reverse direction is a different route
+        self.assertIsNone(self.cache.get((8.5001, -13.2001), (8.4801, -13.2301)))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        a, b, c = (8.40, -13.20), (8.45, -13.20), (8.50, -13.20)
+        self.cache.set(a, b, 1)
+        self.cache.set(b, c, 2)
+        self.cache.get(a, b)
+        self.cache.set(c, a, 3)
+        self.assertIsNone(self.cache.get(b, c))
+        self.assertEqual(self.cache.get(a, b), 1)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_entries_expire(self):
+        self.cache.set((8.40, -13.20), (8.45, -13.20), 1)
+        self.now += 61
+        self.assertIsNone(self.cache.get((8.40, -13.20), (8.45, -13.20)))
+        self.assertEqual(self.cache.expirations, 1)
+
+    def test_new_time_band_drops_everything(self):
+        with mock.patch.object(ETACache, 'current_band', return_value=1):
+            self.cache.set((8.40, -13.20), (8.45, -13.20), 1)
+        with mock.patch.object(ETACache, 'current_band', return_value=2):
+            # The band is re-read at most every 5 seconds
+            self.assertEqual(self.cache.get((8.40, -13.20), (8.45, -13.20)), 1)
+            self.now += 6
+            self.assertIsNone(self.cache.get((8.40, -13.20), (8.45, -13.20)))
+        self.assertEqual(self.cache.stats()['band_invalidations'], 1)
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0)
+class LocationBatchTests(TestCase):
+    """Many GPS fixes in one request"""
+
+    url = '/dispatch/api/ambulances/locations/batch/'
+
+    def setUp(self):
+        use_fresh_fleet_store(self)
+        self.paramedic = User.objects.create_user('medic', role='paramedic')
+        self.unit = Ambulance.objects.create(unit_number='AMB-930', assigned_paramedic=self.paramedic)
+        self.other = Ambulance.objects.create(unit_number='AMB-931')
+        self.client = APIClient()
+        self.client.force_authenticate(self.paramedic)
+
+    def post(self, payload):
+        return self.client.post(self.url, payload, format='json')
+
+    def test_newest_fix_moves_the_unit_and_every_fix_is_kept(self):
+        points = [
+            {'latitude': 8.481, 'longitude': -13.231, 'recorded_at': '2026-01-01T10:00:02Z'},
+            {'latitude': 8.483, 'longitude': -13.233, 'recorded_at': '2026-01-01T10:00:03Z'},
+            {'latitude': 8.482, 'longitude': -13.232, 'recorded_at': '2026-01-01T10:00:01Z'},
+        ]
+        response = self.post({'ambulance_id': self.unit.pk, 'points': points})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'received': 3, 'updated': 1, 'stale': 0, 'missing': [], 'forbidden': []})
+        self.unit.refresh_from_db()
+        self.assertEqual((self.unit.current_latitude, self.unit.current_longitude),
+                         (Decimal('8.483'), Decimal('-13.233')))
+        self.assertEqual(LocationPing.objects.filter(ambulance=self.unit).count(), 3)
+        # A late offline buffer doesn't drag the unit back
+        response = self.post({'ambulance_id': self.unit.pk, 'points': [points[2]]})
+        self.assertEqual((response.data['updated'], response.data['stale']), (0, 1))
+
+    def test_other_units_are_forbidden_and_unknown_ones_reported(self):
+        fix = {'latitude': 8.48, 'longitude': -13.23}
+        response = self.post({'points': [{**fix, 'ambulance_id': self.other.pk}]})
+        self.assertEqual(response.status_code, 403)
+        response = self.post({'points': [{**fix, 'ambulance_id': self.unit.pk}, {**fix, 'ambulance_id': 999999},
+                                         {**fix, 'ambulance_id': self.other.pk}]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['missing'], response.data['forbidden']), ([999999], [self.other.pk]))
+
+    def test_invalid_points(self):
+        response = self.post({'ambulance_id': self.unit.pk, 'points': [
+            {'latitude': 8.48, 'longitude': -13.23}, {'latitude': 95, 'longitude': 0}, {'latitude': 'x'},
+        ]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual({str(i) for i in response.data['points']}, {'1', '2'})
+        with override_settings(LOCATION_BATCH_MAX_POINTS=2):
+            response = self.post({'ambulance_id': self.unit.pk, 'points': [{'latitude': 8.48, 'longitude': -13.23}] * 3})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0,
+                   FLEET_INDEX_MAX_AGE=30)
+class FleetIndexReloadTests(TestCase):
+    """Units freed outside this process reach the spatial index when it is reloaded"""
+
+    def setUp(self):
+        from emergencies.models import EmergencyCall
+
+        spatial.reset_fleet_index()
+        self.addCleanup(spatial.reset_fleet_index)
+        self.call = EmergencyCall.objects.create(
+            caller_name='Caller', caller_phone='+23276123456', emergency_type='MEDICAL',
+            description='Index fixture', location_address='Freetown', latitude=8.48, longitude=-13.23,
+        )
+        self.unit = Ambulance.objects.create(unit_number='AMB-900', status='EN_ROUTE',
+                                             current_latitude=8.481, current_longitude=-13.231)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('dispatcher', role='dispatcher'))
+
+    def recommended(self):
+        response = self.client.get('/dispatch/api/recommend/', {'emergency_call_id': self.call.pk})
+        self.assertEqual(response.status_code, 200)
+        return [item['ambulance']['id'] for item in response.data['results']]
+
+    def test_unit_freed_by_another_worker(self):
+        self.assertEqual(self.recommended(), [])
+        # Another process frees the unit: no post_save reaches this process's index
+        Ambulance.objects.filter(pk=self.unit.pk).update(status='AVAILABLE')
+        self.assertEqual(self.recommended(), [])
+        spatial._fleet_index_built_at -= 31
+        self.assertEqual(self.recommended(), [self.unit.pk])
+
+
+class FleetPositionStoreTests(TestCase):
+    """Fixes are held in memory and written in batches"""
+
+    def setUp(self):
+        self.unit = Ambulance.objects.create(unit_number='AMB-940')
+        self.store = FleetPositionStore(flush_interval=60)
+        patcher = mock.patch.object(FleetPositionStore, '_ensure_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.t0 = timezone.now() - timedelta(minutes=5)
+
+    def stored_position(self):
+        return Ambulance.objects.values_list('current_latitude', 'current_longitude', 'last_location_update').get(
+            pk=self.unit.pk)
+
+    def test_newest_fix_is_flushed_once(self):
+        self.assertTrue(self.store.record(self.unit.pk, 8.5, -13.25, self.t0 + timedelta(seconds=2)))
+        self.assertFalse(self.store.record(self.unit.pk, 8.4, -13.2, self.t0 + timedelta(seconds=1)))
+        self.store.add_history([(self.unit.pk, 8.5, -13.25, self.t0 + timedelta(seconds=2))])
+        # Nothing reaches the database before the flush
+        self.assertEqual(self.stored_position(), (None, None, None))
+        self.assertEqual(self.store.flush(), 1)
+        self.assertEqual(self.stored_position(), (Decimal('8.5'), Decimal('-13.25'), self.t0 + timedelta(seconds=2)))
+        self.assertEqual(LocationPing.objects.filter(ambulance=self.unit).count(), 1)
+        self.assertEqual(self.store.flush(), 0)
+
+    def test_a_newer_row_is_left_alone(self):
+        Ambulance.objects.filter(pk=self.unit.pk).update(
+            current_latitude=8.6, current_longitude=-13.1, last_location_update=self.t0 + timedelta(seconds=9))
+        self.store.record(self.unit.pk, 8.5, -13.25, self.t0)
+        self.store.flush()
+        self.assertEqual(self.stored_position()[0], Decimal('8.6'))
+
+    def test_failed_flush_is_retried(self):
+        self.store.record(self.unit.pk, 8.5, -13.25, self.t0)
+        self.store.add_history([(self.unit.pk, 8.5, -13.25, self.t0)])
+        with mock.patch('dispatch.fleet_store.write_positions', side_effect=OperationalError('database is locked')):
+            with self.assertRaises(OperationalError):
+                self.store.flush()
+        self.assertEqual(self.store.stats()['dirty'], 1)
+        self.assertEqual(self.store.flush(), 1)
+        self.assertEqual(self.stored_position()[0], Decimal('8.5'))
+        self.assertEqual(LocationPing.objects.filter(ambulance=self.unit).count(), 1)
+
+    def test_overlay_and_discard(self):
+        self.store.record(self.unit.pk, 8.5, -13.25, self.t0)
+        self.assertEqual(self.store.overlay(self.unit).current_latitude, 8.5)
+        self.assertEqual(self.store.overlay_rows([(self.unit.pk, 1.0, 1.0), (0, 2.0, 2.0)]),
+                         [(self.unit.pk, 8.5, -13.25), (0, 2.0, 2.0)])
+        self.store.discard(self.unit.pk)
+        self.assertEqual(self.store.flush(), 0)
+        self.assertIsNone(self.store.position(self.unit.pk))
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0)
+class AssignmentSaveTests(TestCase):
+    """Assignment and PATCH saves leave a position flushed since the unit was loaded alone"""
+
+    def setUp(self):
+        from emergencies.models import EmergencyCall
+
+        use_fresh_fleet_store(self)
+        self.call = EmergencyCall.objects.create(
+            caller_name='Caller', caller_phone='+23276123456', emergency_type='MEDICAL',
+            description='Assignment fixture', location_address='Freetown', latitude=8.48, longitude=-13.23,
+        )
+        self.unit = Ambulance.objects.create(unit_number='AMB-901', current_latitude=8.4, current_longitude=-13.2)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('dispatcher', role='dispatcher'))
+
+    def flush_newer_fix(self):
+        # What the write-behind flusher does while this instance is held
+        Ambulance.objects.filter(pk=self.unit.pk).update(current_latitude=8.5, current_longitude=-13.25)
+
+    def assert_newer_fix_kept(self):
+        self.assertEqual(
+            Ambulance.objects.values_list('current_latitude', 'current_longitude').get(pk=self.unit.pk),
+            (8.5, -13.25),
+        )
+
+    def test_assignment_helpers(self):
+        self.flush_newer_fix()
+        self.unit.assign_to_emergency(self.call)
+        self.assert_newer_fix_kept()
+        self.unit.complete_assignment()
+        self.assert_newer_fix_kept()
+        self.assertEqual(Ambulance.objects.get(pk=self.unit.pk).status, 'AVAILABLE')
+
+    def test_patch_without_position(self):
+        self.flush_newer_fix()
+        response = self.client.patch(f'/dispatch/api/ambulances/{self.unit.pk}/', {'status': 'MAINTENANCE'},
+                                     format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assert_newer_fix_kept()
+        self.assertEqual(Ambulance.objects.get(pk=self.unit.pk).status, 'MAINTENANCE')
+
+    def test_patch_with_position_is_recorded_as_a_fix(self):
+        response = self.client.patch(f'/dispatch/api/ambulances/{self.unit.pk}/',
+                                     {'current_latitude': 8.5, 'current_longitude': -13.25}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assert_newer_fix_kept()
+        self.assertIsNotNone(Ambulance.objects.get(pk=self.unit.pk).last_location_update)
+
+
+class TrackEncodingTests(SimpleTestCase):
+    """Simplification and polyline encoding of stored pings"""
+
+    def test_polyline_round_trip(self):
+        lat_e6 = np.array([8480000, 8480123, 8479001, -1000000])
+        lng_e6 = np.array([-13230000, -13230456, -13229999, 179999999])
+        self.assertEqual(decode_polyline(encode_polyline(lat_e6, lng_e6)),
+                         [(lat / 1e6, lng / 1e6) for lat, lng in zip(lat_e6.tolist(), lng_e6.tolist())])
+
+    def test_straight_run_keeps_its_ends_and_the_corner(self):
+        # East for 10 points, then north for 10; ~11 m between points
+        lat_e6 = np.array([8480000] * 10 + [8480000 + i * 100 for i in range(1, 11)])
+        lng_e6 = np.array([-13230000 + i * 100 for i in range(10)] + [-13229100] * 10)
+        kept = np.flatnonzero(simplify_track(lat_e6, lng_e6, tolerance_m=5))
+        self.assertEqual(kept.tolist(), [0, 9, 19])
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0)
+class AmbulanceTrackTests(TestCase):
+    """Track playback over the API"""
+
+    def setUp(self):
+        self.unit = Ambulance.objects.create(unit_number='AMB-902')
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('dispatcher', role='dispatcher'))
+        self.url = f'/dispatch/api/ambulances/{self.unit.pk}/track/'
+        # Write-behind store whose flusher never runs on its own
+        self.store = FleetPositionStore(flush_interval=60)
+        for patcher in (mock.patch.object(fleet_store, '_store', self.store),
+                        mock.patch.object(FleetPositionStore, '_ensure_flusher')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.t0 = timezone.now() - timedelta(minutes=30)
+
+    def ping(self, seconds, lat, lng):
+        return (self.unit.pk, lat, lng, self.t0 + timedelta(seconds=seconds))
+
+    def test_out_of_range_date(self):
+        response = self.client.get(self.url, {'start': '2024-02-30T00:00:00'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.data)
+
+    def test_unflushed_pings_are_merged_without_a_flush(self):
+        self.store.add_history([self.ping(0, 8.48, -13.23), self.ping(10, 8.49, -13.23)])
+        self.store.flush()
+        self.store.add_history([self.ping(20, 8.49, -13.22), self.ping(30, 8.50, -13.22)])
+        # Another unit's pending pings stay out of this track
+        self.store.add_history([(0, 8.0, -13.0, self.t0 + timedelta(seconds=25))])
+        with mock.patch.object(FleetPositionStore, 'flush') as flush:
+            response = self.client.get(self.url, {'tolerance_m': 0})
+        flush.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['raw_points'], response.data['points']), (4, 4))
+        self.assertEqual(decode_polyline(response.data['polyline'])[-1], (8.5, -13.22))
+        self.assertEqual(response.data['offsets'], [0, 10, 20, 30])
+        self.assertEqual(LocationPing.objects.filter(ambulance=self.unit).count(), 2)
+
+    def test_access(self):
+        self.assertEqual(self.client.get('/dispatch/api/ambulances/999999/track/').status_code, 404)
+        self.client.force_authenticate(User.objects.create_user('medic', role='paramedic'))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+
+class PruneLocationHistoryTests(TestCase):
+    """Expiry and thinning of the ping history"""
+
+    def setUp(self):
+        self.unit = Ambulance.objects.create(unit_number='AMB-950')
+        self.now_ms = LocationPing.to_timestamp_ms(timezone.now())
+        self.day_ms = 24 * 3600 * 1000
+
+    def create_pings(self, start_ms, count, step_ms):
+        LocationPing.objects.bulk_create(
+            [LocationPing(ambulance=self.unit, timestamp_ms=start_ms + i * step_ms, lat_e6=8480000, lng_e6=-13230000)
+             for i in range(count)],
+            batch_size=1000,
+        )
+
+    def test_thins_more_than_a_delete_chunk(self):
+        from dispatch.management.commands.prune_location_history import DELETE_CHUNK
+
+        # Three pings per minute, 20 days ago, over more than two chunks of surplus
+        minutes = DELETE_CHUNK + 10
+        start_ms = (self.now_ms - 20 * self.day_ms) // 60000 * 60000
+        self.create_pings(start_ms, minutes * 3, 20000)
+        # Inside the full-resolution window and past retention
+        self.create_pings(self.now_ms - self.day_ms, 30, 1000)
+        self.create_pings(self.now_ms - 100 * self.day_ms, 5, 1000)
+
+        out = StringIO()
+        call_command('prune_location_history', '--dry-run', stdout=out)
+        self.assertIn(f'Would delete 5 expired pings and {minutes * 2} pings thinned', out.getvalue())
+        self.assertEqual(LocationPing.objects.count(), minutes * 3 + 35)
+
+        call_command('prune_location_history', stdout=StringIO())
+        thinned = LocationPing.objects.filter(timestamp_ms__lt=self.now_ms - 7 * self.day_ms)
+        self.assertEqual(thinned.count(), minutes)
+        self.assertEqual(len({ms // 60000 for ms in thinned.values_list('timestamp_ms', flat=True)}), minutes)
+        self.assertEqual(LocationPing.objects.count(), minutes + 30)
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0)
+class AmbulanceEventTests(TestCase):
+    """Edits through the ambulance API reach dashboards and the dispatcher snapshot"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('dispatcher', role='dispatcher'))
+
+    def test_create_update_delete_are_announced(self):
+        response = self.client.post('/dispatch/api/ambulances/', {'unit_number': 'AMB-903'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        url = f"/dispatch/api/ambulances/{response.data['id']}/"
+        self.assertEqual(self.client.patch(url, {'max_patients': 2}, format='json').status_code, 200)
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertEqual(list(OutboxEvent.objects.values_list('event', flat=True)),
+                         ['UNIT_CREATED', 'UNIT_UPDATED', 'UNIT_REMOVED'])
+
+    def test_removal_leaves_the_snapshot(self):
+        unit = Ambulance.objects.create(unit_number='AMB-904')
+        data = dict(AmbulanceSerializer(unit).data)
+        snapshot = DispatcherSnapshot()
+        snapshot.refresh(lambda: {'ambulances': [data]})
+        for seq, event in enumerate(['UNIT_UPDATED', 'UNIT_REMOVED'], start=1):
+            (_, message), *_ = build_group_messages('dispatchers', 'ambulance_update', event, data,
+                                                    entity_kind='ambulance')
+            snapshot.apply(seq, message)
+        lists, _, _ = snapshot.contents()
+        self.assertEqual(lists['ambulances'], [])
@@ -11,8 +11,15 @@ urlpatterns = [
     path('api/ambulances/', views.AmbulanceListCreateView.as_view(), name='ambulance_list'),
     path('api/ambulances/<int:pk>/', views.AmbulanceDetailView.as_view(), name='ambulance_detail'),
     path('api/ambulances/<int:pk>/location/', views.update_ambulance_location, name='update_ambulance_location'),
+    path('api/ambulances/<int:pk>/track/', views.ambulance_track, name='ambulance_track'),
+    path('api/ambulances/locations/batch/', views.update_ambulance_locations_batch, name='update_ambulance_locations_batch'),
     path('api/hospitals/<int:pk>/capacity/', views.update_hospital_capacity, name='update_hospital_capacity'),
     path('api/dispatch/', views.dispatch_ambulance, name='dispatch_ambulance'),
+    path('api/recommend/', views.recommend_ambulances, name='recommend_ambulances'),
+    path('api/distance-matrix/', views.distance_matrix, name='distance_matrix'),
+    path('api/batch-dispatch/', views.batch_dispatch, name='batch_dispatch'),
+    path('api/eta-cache/stats/', views.eta_cache_stats, name='eta_cache_stats'),
     path('api/hospitals/', views.HospitalListCreateView.as_view(), name='hospital_list'),
+    path('api/hospitals/recommend/', views.recommend_hospitals, name='recommend_hospitals'),
     path('api/hospitals/<int:pk>/', views.HospitalDetailView.as_view(), name='hospital_detail'),
 ]
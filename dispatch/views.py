@@ -1,23 +1,44 @@
+from datetime import timedelta
+
 from rest_framework import generics, status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
+from django.conf import settings
+from django.db import transaction
 from django.shortcuts import render
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.views.decorators.http import require_POST
 from .models import Ambulance, Hospital
 from .serializers import (
     AmbulanceSerializer,
     AmbulanceLocationUpdateSerializer,
+    LocationBatchSerializer,
     HospitalSerializer,
     DispatchSerializer,
+    BatchDispatchSerializer,
+)
+from .spatial import get_fleet_index
+from .distance_matrix import build_distance_matrix
+from .assignment import plan_batch_assignment, apply_assignment_plan
+from .locations import apply_location_batch
+from .fleet_store import get_fleet_store
+from .tracks import build_track
+from .routing import estimate_travel_times_from, estimate_travel_times_to
+from .eta_cache import get_eta_cache
+from core.outbox import (
+    enqueue_ambulance_notification,
+    enqueue_emergency_notification,
+    enqueue_hospital_notification,
 )
-from core.utils import send_ambulance_notification, send_emergency_notification, send_hospital_notification
+from core.utils import send_location_notification
 
 
 class AmbulanceListCreateView(generics.ListCreateAPIView):
     """List all ambulances and allow dispatchers to create new units."""
 
-    queryset = Ambulance.objects.all()
+    queryset = Ambulance.objects.with_related()
     serializer_class = AmbulanceSerializer
     permission_classes = [IsAuthenticated]
 
@@ -27,11 +48,16 @@ class AmbulanceListCreateView(generics.ListCreateAPIView):
 
         return super().create(request, *args, **kwargs)
 
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            ambulance = serializer.save()
+            enqueue_ambulance_notification(event='UNIT_CREATED', ambulance_data=AmbulanceSerializer(ambulance).data)
+
 
 class AmbulanceDetailView(generics.RetrieveUpdateDestroyAPIView):
     """Retrieve, update, or delete an ambulance. Delete restricted to dispatchers."""
 
-    queryset = Ambulance.objects.all()
+    queryset = Ambulance.objects.with_related()
     serializer_class = AmbulanceSerializer
     permission_classes = [IsAuthenticated]
 
@@ -46,6 +72,18 @@ class AmbulanceDetailView(generics.RetrieveUpdateDestroyAPIView):
 
         return super().destroy(request, *args, **kwargs)
 
+    # Dashboards and the dispatcher snapshot only learn about edits through these events
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            ambulance = serializer.save()
+            enqueue_ambulance_notification(event='UNIT_UPDATED', ambulance_data=AmbulanceSerializer(ambulance).data)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            ambulance_data = AmbulanceSerializer(instance).data
+            instance.delete()
+            enqueue_ambulance_notification(event='UNIT_REMOVED', ambulance_data=ambulance_data)
+
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -64,20 +102,117 @@ def update_ambulance_location(request, pk):
     serializer = AmbulanceLocationUpdateSerializer(ambulance, data=request.data, partial=True)
     
     if serializer.is_valid():
-        ambulance = serializer.save()
+        lat = serializer.validated_data.get('current_latitude', ambulance.current_latitude)
+        lng = serializer.validated_data.get('current_longitude', ambulance.current_longitude)
+        if lat is None or lng is None:
+            return Response({'error': 'Both coordinates are required'}, status=status.HTTP_400_BAD_REQUEST)
+        ambulance.update_location(lat, lng)
         
-        # Send real-time notification using optimized utility function
-        ambulance_data = AmbulanceSerializer(ambulance).data
-        send_ambulance_notification(
-            event='LOCATION_UPDATE',
-            ambulance_data=ambulance_data
-        )
+        # Coalesced with other units' positions into the next LOCATION_BATCH tick
+        send_location_notification([[
+            ambulance.id, float(ambulance.current_latitude), float(ambulance.current_longitude),
+            ambulance.last_location_update.isoformat(),
+        ]])
         
         return Response(AmbulanceSerializer(ambulance).data)
     
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def update_ambulance_locations_batch(request):
+    """
+    API endpoint for ingesting many GPS fixes in one request.
+
+    Accepts ``{"ambulance_id"?, "points": [{"latitude", "longitude", "recorded_at"?, "ambulance_id"?}]}``.
+    Paramedics may only post for their assigned unit; dispatchers can relay
+    the whole fleet. Moved units go out with the next LOCATION_BATCH tick.
+    """
+    serializer = LocationBatchSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    points = serializer.validated_data['points']
+    result = apply_location_batch(points, user=request.user)
+    if result.forbidden and not result.updated:
+        return Response({'error': 'Not authorized to update these ambulances'}, status=status.HTTP_403_FORBIDDEN)
+    
+    if result.updated:
+        send_location_notification(result.updated)
+    
+    return Response(result.as_dict(received=len(points)))
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def ambulance_track(request, pk):
+    """
+    Simplified route of a unit for a time window (dispatchers only).
+    
+    Query params: ``start``/``end`` (ISO 8601, default the last hour) and
+    ``tolerance_m`` (Douglas-Peucker tolerance, default 10 m).
+    """
+    if not getattr(request.user, 'is_dispatcher', False):
+        return Response({'error': 'Only dispatchers can view unit tracks'}, status=status.HTTP_403_FORBIDDEN)
+    if not Ambulance.objects.filter(pk=pk).exists():
+        return Response({'error': 'Ambulance not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    try:
+        end = parse_datetime(request.GET['end']) if request.GET.get('end') else timezone.now()
+        start = parse_datetime(request.GET['start']) if request.GET.get('start') else end - timedelta(hours=1)
+    except ValueError:
+        # Well formed but out of range, e.g. 2024-02-30
+        start = end = None
+    if start is None or end is None:
+        return Response({'error': 'start and end must be ISO 8601 timestamps'}, status=status.HTTP_400_BAD_REQUEST)
+    start, end = (timezone.make_aware(t) if timezone.is_naive(t) else t for t in (start, end))
+    if start >= end:
+        return Response({'error': 'start must be before end'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        tolerance_m = max(0.0, float(request.GET.get('tolerance_m', 10)))
+    except ValueError:
+        return Response({'error': 'tolerance_m must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    return Response(build_track(
+        pk, start, end, tolerance_m,
+        max_points=getattr(settings, 'LOCATION_TRACK_MAX_POINTS', 200000),
+    ))
+
+
+def _broadcast_dispatch(emergency_call, ambulance):
+    """
+    Queue notifications for dispatchers and the assigned paramedic that a unit
+    was dispatched; call inside the transaction that dispatched it.
+    """
+    from emergencies.serializers import EmergencyCallSerializer
+    
+    # Notify dispatchers about ambulance dispatch
+    ambulance_data = AmbulanceSerializer(ambulance).data
+    enqueue_ambulance_notification(
+        event='UNIT_DISPATCHED',
+        ambulance_data=ambulance_data
+    )
+    
+    # Notify dispatchers about emergency status update
+    emergency_data = EmergencyCallSerializer(emergency_call).data
+    enqueue_emergency_notification(
+        event='STATUS_UPDATE',
+        emergency_data=emergency_data,
+        paramedic_id=None  # Only send to dispatchers
+    )
+    
+    # Notify assigned paramedic about dispatch (UNIT_DISPATCHED event)
+    if emergency_call.assigned_paramedic_id:
+        enqueue_emergency_notification(
+            event='UNIT_DISPATCHED',
+            emergency_data=emergency_data,
+            paramedic_id=emergency_call.assigned_paramedic_id
+        )
+    
+    return emergency_data, ambulance_data
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def dispatch_ambulance(request):
@@ -104,47 +239,25 @@ def dispatch_ambulance(request):
             from core.models import User
             paramedic = User.objects.get(id=paramedic_id)
         
-        # Assign ambulance to emergency
-        ambulance.assign_to_emergency(emergency_call, paramedic)
-        
-        # Update emergency call
-        emergency_call.assigned_ambulance = ambulance
-        emergency_call.assigned_paramedic = paramedic
-        emergency_call.dispatcher = request.user
-        if hospital_id:
-            from .models import Hospital
-            try:
-                dest = Hospital.objects.get(id=hospital_id)
-                emergency_call.hospital_destination = dest.name
-            except Hospital.DoesNotExist:
-                pass
-        emergency_call.update_status('DISPATCHED')
-        
-        # Send real-time notifications using optimized utility functions
-        from emergencies.serializers import EmergencyCallSerializer
-        
-        # Notify dispatchers about ambulance dispatch
-        ambulance_data = AmbulanceSerializer(ambulance).data
-        send_ambulance_notification(
-            event='UNIT_DISPATCHED',
-            ambulance_data=ambulance_data
-        )
-        
-        # Notify dispatchers about emergency status update
-        emergency_data = EmergencyCallSerializer(emergency_call).data
-        send_emergency_notification(
-            event='STATUS_UPDATE',
-            emergency_data=emergency_data,
-            paramedic_id=None  # Only send to dispatchers
-        )
-        
-        # Notify assigned paramedic about dispatch (UNIT_DISPATCHED event)
-        if emergency_call.assigned_paramedic_id:
-            send_emergency_notification(
-                event='UNIT_DISPATCHED',
-                emergency_data=emergency_data,
-                paramedic_id=emergency_call.assigned_paramedic_id
-            )
+        with transaction.atomic():
+            # Assign ambulance to emergency
+            ambulance.assign_to_emergency(emergency_call, paramedic)
+            
+            # Update emergency call
+            emergency_call.assigned_ambulance = ambulance
+            emergency_call.assigned_paramedic = paramedic
+            emergency_call.dispatcher = request.user
+            if hospital_id:
+                from .models import Hospital
+                try:
+                    dest = Hospital.objects.get(id=hospital_id)
+                    emergency_call.hospital_destination = dest.name
+                except Hospital.DoesNotExist:
+                    pass
+            emergency_call.update_status('DISPATCHED')
+            
+            # Queue real-time notifications; they are relayed once this commits
+            emergency_data, ambulance_data = _broadcast_dispatch(emergency_call, ambulance)
         
         return Response({
             'message': 'Ambulance dispatched successfully',
@@ -155,6 +268,182 @@ def dispatch_ambulance(request):
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def recommend_ambulances(request):
+    """API endpoint ranking available ambulances by distance from an emergency call"""
+    
+    if not request.user.is_dispatcher:
+        return Response({'error': 'Only dispatchers can request recommendations'}, status=status.HTTP_403_FORBIDDEN)
+    
+    from emergencies.models import EmergencyCall
+    try:
+        emergency_call = EmergencyCall.objects.get(pk=request.GET.get('emergency_call_id'))
+    except (EmergencyCall.DoesNotExist, ValueError, TypeError):
+        return Response({'error': 'Emergency call not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    if emergency_call.latitude is None or emergency_call.longitude is None:
+        return Response({'error': 'Emergency call has no coordinates'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 5)), 50))
+    except ValueError:
+        limit = 5
+    
+    scene = (float(emergency_call.latitude), float(emergency_call.longitude))
+    index = get_fleet_index()
+    # Shortlist by straight-line distance, then rank the shortlist by road ETA
+    candidates = index.nearest(*scene, k=min(limit * 3, 100))
+    ambulances = Ambulance.objects.with_related().in_bulk([pk for pk, _ in candidates])
+    store = get_fleet_store()
+    
+    shortlist = []
+    for pk, distance_km in candidates:
+        ambulance = ambulances.get(pk)
+        # The index is per-process; drop units another worker has since dispatched
+        if ambulance is None or not ambulance.is_available:
+            index.remove(pk)
+            continue
+        shortlist.append((store.overlay(ambulance), distance_km))
+    
+    etas = estimate_travel_times_to(scene, [ambulance.current_location for ambulance, _ in shortlist])
+    ranked = sorted(zip(shortlist, etas), key=lambda item: item[1][0])[:limit]
+    results = [
+        {
+            'ambulance': AmbulanceSerializer(ambulance).data,
+            'distance_km': round(distance_km, 3),
+            'eta_seconds': round(seconds),
+            'eta_source': source,
+        }
+        for (ambulance, distance_km), (seconds, source) in ranked
+    ]
+    
+    return Response({
+        'emergency_call_id': emergency_call.id,
+        'results': results,
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def distance_matrix(request):
+    """API endpoint returning distances between pending calls and available units"""
+    
+    if not request.user.is_dispatcher:
+        return Response({'error': 'Only dispatchers can view the distance matrix'}, status=status.HTTP_403_FORBIDDEN)
+    
+    matrix = build_distance_matrix()
+    response = {
+        'calls': matrix.call_ids,
+        'ambulances': matrix.ambulance_ids,
+    }
+    
+    # ?nearest=k returns only the k closest units per call instead of the full matrix
+    nearest = request.GET.get('nearest')
+    if nearest:
+        try:
+            k = max(1, int(nearest))
+        except ValueError:
+            return Response({'error': 'nearest must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        idx, dist = matrix.nearest(k)
+        response['nearest'] = {
+            call_id: [
+                {'ambulance_id': matrix.ambulance_ids[j], 'distance_km': round(float(d), 3)}
+                for j, d in zip(row_idx, row_dist)
+            ]
+            for call_id, row_idx, row_dist in zip(matrix.call_ids, idx, dist)
+        }
+    else:
+        response['distances_km'] = matrix.distances_km.round(3).tolist()
+    
+    return Response(response)
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def batch_dispatch(request):
+    """
+    GET: propose a global assignment of available units to all pending calls.
+    POST: apply the given (or a freshly computed) plan in one transaction.
+    """
+    
+    if not request.user.is_dispatcher:
+        return Response({'error': 'Only dispatchers can dispatch ambulances'}, status=status.HTTP_403_FORBIDDEN)
+    
+    if request.method == 'GET':
+        return Response(plan_batch_assignment().as_dict())
+    
+    serializer = BatchDispatchSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    assignments = serializer.validated_data.get('assignments')
+    if assignments is None:
+        pairs = [(p.emergency_call_id, p.ambulance_id) for p in plan_batch_assignment().assignments]
+    else:
+        pairs = [(a['emergency_call_id'], a['ambulance_id']) for a in assignments]
+    
+    dispatched = []
+    with transaction.atomic():
+        applied, skipped = apply_assignment_plan(pairs, request.user)
+        for emergency_call, ambulance in applied:
+            _broadcast_dispatch(emergency_call, ambulance)
+            dispatched.append({'emergency_call_id': emergency_call.id, 'ambulance_id': ambulance.id})
+    
+    return Response({
+        'message': f'{len(applied)} ambulances dispatched',
+        'dispatched': dispatched,
+        'skipped': [{'emergency_call_id': c, 'ambulance_id': a} for c, a in skipped],
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def recommend_hospitals(request):
+    """API endpoint ranking hospitals with capacity by travel time from an emergency scene"""
+    
+    from emergencies.models import EmergencyCall
+    try:
+        emergency_call = EmergencyCall.objects.get(pk=request.GET.get('emergency_call_id'))
+    except (EmergencyCall.DoesNotExist, ValueError, TypeError):
+        return Response({'error': 'Emergency call not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    if emergency_call.latitude is None or emergency_call.longitude is None:
+        return Response({'error': 'Emergency call has no coordinates'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 5)), 50))
+    except ValueError:
+        limit = 5
+    
+    scene = (float(emergency_call.latitude), float(emergency_call.longitude))
+    hospitals = list(Hospital.objects.exclude(emergency_capacity='FULL'))
+    etas = estimate_travel_times_from(scene, [hospital.location for hospital in hospitals])
+    ranked = sorted(zip(hospitals, etas), key=lambda item: item[1][0])[:limit]
+    
+    return Response({
+        'emergency_call_id': emergency_call.id,
+        'results': [
+            {
+                'hospital': HospitalSerializer(hospital).data,
+                'eta_seconds': round(seconds),
+                'eta_source': source,
+            }
+            for hospital, (seconds, source) in ranked
+        ],
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def eta_cache_stats(request):
+    """Hit/miss metrics of the travel-time cache (staff/admin only)"""
+    user = request.user
+    if not (getattr(user, 'is_staff', False) or getattr(user, 'is_admin', False)):
+        return Response({"error": "Only admin/staff can view cache metrics"}, status=status.HTTP_403_FORBIDDEN)
+    return Response(get_eta_cache().stats())
+
+
 class HospitalListCreateView(generics.ListCreateAPIView):
     """List hospitals and allow staff/admin to create new hospitals."""
 
@@ -226,14 +515,15 @@ def update_hospital_capacity(request, pk):
 
     serializer = HospitalSerializer(hospital, data=data, partial=True)
     if serializer.is_valid():
-        hospital = serializer.save()
-        
-        # Broadcast update to dispatchers using optimized utility function
-        hospital_data = HospitalSerializer(hospital).data
-        send_hospital_notification(
-            event='CAPACITY_UPDATE',
-            hospital_data=hospital_data
-        )
+        with transaction.atomic():
+            hospital = serializer.save()
+            
+            # Queue the broadcast to dispatchers with the capacity change
+            hospital_data = HospitalSerializer(hospital).data
+            enqueue_hospital_notification(
+                event='CAPACITY_UPDATE',
+                hospital_data=hospital_data
+            )
         
         return Response(hospital_data)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -1,13 +1,47 @@
-import json
+import asyncio
 import logging
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 
+from core.sectors import (
+    SectorError,
+    entity_position,
+    sector_group,
+    sector_of,
+    sectors_for_bbox,
+    sectors_for_prefixes,
+)
+from core.frames import EncodedFramesMixin, decode_frame, encode_json_frame
+from core.presence import announce as announce_presence, get_presence_registry
+from core.replay import frame_in_area, get_replay_hub
+from core.snapshot import ACTIVE_EMERGENCY_STATUSES, get_dispatcher_snapshot, initial_data_chunks
+from core.utils import with_version
+
 logger = logging.getLogger(__name__)
 
 
-class DispatcherConsumer(AsyncWebsocketConsumer):
+def load_dispatcher_state():
+    """Active calls, fleet and hospitals as sent in ``initial_data``, from the database"""
+    from dispatch.models import Ambulance, Hospital
+    from dispatch.serializers import AmbulanceSerializer, HospitalSerializer
+    from .models import EmergencyCall
+    from .serializers import EmergencyCallSerializer
+    
+    emergencies = EmergencyCall.objects.with_related().filter(
+        status__in=ACTIVE_EMERGENCY_STATUSES
+    ).order_by('-received_at')
+    return {
+        'emergencies': [with_version(e) for e in EmergencyCallSerializer(emergencies, many=True).data],
+        'ambulances': [with_version(a) for a in AmbulanceSerializer(Ambulance.objects.with_related(), many=True).data],
+        'hospitals': HospitalSerializer(Hospital.objects.all(), many=True).data,
+    }
+
+
+class DispatcherConsumer(EncodedFramesMixin, AsyncWebsocketConsumer):
     """WebSocket consumer for dispatcher dashboard real-time updates"""
     
     async def connect(self):
@@ -23,117 +57,249 @@ class DispatcherConsumer(AsyncWebsocketConsumer):
             await self.close(code=4001)  # Custom close code for unauthorized
             return
         
-        self.group_name = 'dispatchers'
-        
-        # Join dispatcher group
-        await self.channel_layer.group_add(
-            self.group_name,
-            self.channel_name
-        )
+        self.sectors = None
+        self.group_names = []
+        # Seqs already sent by a resume; their live copies are skipped
+        self.replayed = set()
         
+        await get_replay_hub().ensure_recorder(self.channel_layer)
         await self.accept()
         
-        # Send initial data
-        await self.send_initial_data()
+        # Optional area from the query string (?sectors=ec1,ec2 or ?bbox=s,w,n,e); whole city otherwise
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        area = {key: params[key][0].split(',') for key in ('sectors', 'bbox') if params.get(key)}
+        # ?initial=chunked streams initial data in prioritized chunks
+        self.chunked = (params.get('initial') or [''])[0] == 'chunked'
+        try:
+            sectors = self.resolve_sectors(area)
+        except SectorError as e:
+            await self.send_frame({'type': 'error', 'message': str(e)})
+            sectors = None
+        await self.subscribe(sectors)
+        
+        # ?resume=<epoch>:<seq> replays what a reconnecting client missed; otherwise send initial data
+        epoch, _, seq = (params.get('resume') or [''])[0].partition(':')
+        if not await self.resume(epoch, seq):
+            await self.send_initial_data()
     
     async def disconnect(self, close_code):
-        """Leave dispatcher group"""
+        """Leave dispatcher groups"""
         logger.info(f"WebSocket disconnecting - Close code: {close_code}")
-        if hasattr(self, 'group_name'):
-            await self.channel_layer.group_discard(
-                self.group_name,
-                self.channel_name
-            )
+        if hasattr(self, 'group_names'):
+            await self.subscribe(None, join=False)
+    
+    def resolve_sectors(self, area):
+        """Sector cells for ``{'sectors': [...]}`` or ``{'bbox': [s, w, n, e]}``; None for the whole city"""
+        if area.get('sectors'):
+            return sectors_for_prefixes(area['sectors'])
+        if area.get('bbox'):
+            try:
+                south, west, north, east = (float(v) for v in area['bbox'])
+            except (TypeError, ValueError):
+                raise SectorError("bbox must be four numbers: south,west,north,east")
+            return sectors_for_bbox(south, west, north, east)
+        return None
     
-    async def receive(self, text_data):
+    async def subscribe(self, sectors, join=True):
+        """Switch this socket's groups to the given sectors (None = the full ``dispatchers`` feed)"""
+        await asyncio.gather(*(
+            self.channel_layer.group_discard(name, self.channel_name) for name in self.group_names
+        ))
+        self.sectors = set(sectors) if sectors is not None else None
+        self.group_names = []
+        if join:
+            self.group_names = [sector_group(s) for s in sectors] if sectors is not None else ['dispatchers']
+            await asyncio.gather(*(
+                self.channel_layer.group_add(name, self.channel_name) for name in self.group_names
+            ))
+    
+    async def receive(self, text_data=None, bytes_data=None):
         """Receive message from WebSocket"""
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = decode_frame(text_data, bytes_data)
             message_type = text_data_json.get('type')
             
             if message_type == 'ping':
-                await self.send(text_data=json.dumps({'type': 'pong'}))
+                await self.send_frame({'type': 'pong'})
             elif message_type == 'get_initial_data':
+                await self.send_initial_data(text_data_json.get('chunked'))
+            elif message_type == 'subscribe':
+                try:
+                    sectors = self.resolve_sectors(text_data_json)
+                except SectorError as e:
+                    await self.send_frame({'type': 'error', 'message': str(e)})
+                    return
+                await self.subscribe(sectors)
+                await self.send_frame({'type': 'subscribed', 'sectors': sectors})
                 await self.send_initial_data()
+            elif message_type == 'resume':
+                if not await self.resume(text_data_json.get('epoch'), text_data_json.get('seq')):
+                    await self.send_initial_data()
+            elif message_type == 'get_snapshot':
+                await self.send_snapshot(text_data_json.get('kind'), text_data_json.get('id'))
                 
-        except json.JSONDecodeError:
+        except ValueError:
             pass
     
     async def emergency_update(self, event):
-        """Handle emergency call updates"""
-        await self.send(text_data=json.dumps({
-            'type': 'emergency_update',
-            'event': event['event'],
-            'data': event['data']
-        }))
+        """Handle emergency call updates (full ``data`` or a ``delta`` frame)"""
+        await self.send_stream_event(event)
     
     async def ambulance_update(self, event):
-        """Handle ambulance updates"""
-        await self.send(text_data=json.dumps({
-            'type': 'ambulance_update',
-            'event': event['event'],
-            'data': event['data']
-        }))
-    
-    async def send_initial_data(self):
-        """Send initial data to the dispatcher"""
+        """Handle ambulance updates (full ``data`` or a ``delta`` frame)"""
+        await self.send_stream_event(event)
+    
+    async def hospital_update(self, event):
+        """Handle hospital capacity updates"""
+        await self.send_stream_event(event)
+    
+    async def presence_update(self, event):
+        """Handle paramedic devices coming online or going offline"""
+        await self.send_stream_event(event)
+    
+    async def send_stream_event(self, event):
+        """Send a dispatcher event stamped with its stream ``seq``/``epoch``"""
+        hub = get_replay_hub()
+        seq = hub.record(event)
+        if seq in self.replayed:
+            self.replayed.discard(seq)
+            return
+        await self.forward_frame(event, {'seq': seq, 'epoch': hub.epoch})
+    
+    async def resume(self, epoch, seq):
+        """Replay the events after ``seq``; False when a full snapshot is needed instead"""
+        hub = get_replay_hub()
+        try:
+            missed = hub.since(epoch, int(seq)) if epoch else None
+        except (TypeError, ValueError):
+            missed = None
+        if missed is None:
+            return False
+        if self.send_queue is not None and len(missed) >= self.send_queue.max_size:
+            # More than the send queue holds; a snapshot is cheaper than overflowing it
+            return False
+        self.replayed.clear()
+        replayed = 0
+        for event_seq, message in missed:
+            part = frame_in_area(message, self.sectors)
+            if part is not None:
+                await self.forward_frame(part, {'seq': event_seq, 'epoch': hub.epoch})
+                self.replayed.add(event_seq)
+                replayed += 1
+        await self.send_frame({
+            'type': 'resumed',
+            'epoch': hub.epoch,
+            'seq': missed[-1][0] if missed else int(seq),
+            'replayed': replayed,
+        })
+        return True
+    
+    async def send_snapshot(self, kind, entity_id):
+        """Send the full current representation of one entity, e.g. after a missed delta"""
+        try:
+            data = await self.get_snapshot(kind, int(entity_id))
+        except (TypeError, ValueError):
+            data = None
+        if data is None:
+            await self.send_frame({
+                'type': 'error',
+                'message': f'No {kind} with id {entity_id}'
+            })
+            return
+        await self.send_frame({'type': 'snapshot', 'kind': kind, 'data': data})
+    
+    async def send_initial_data(self, chunked=None):
+        """
+        Send initial data to the dispatcher, from the materialized snapshot when
+        it is enabled; streamed in prioritized chunks if the socket asked for it
+        """
+        chunked = self.chunked if chunked is None else bool(chunked)
+        hub = get_replay_hub()
         try:
-            # Get active emergencies
-            emergencies = await self.get_active_emergencies()
+            contents = None
+            if getattr(settings, 'REALTIME_SNAPSHOT_CACHE', True):
+                snapshot = get_dispatcher_snapshot()
+                if snapshot.is_current() or await database_sync_to_async(snapshot.refresh)(load_dispatcher_state):
+                    if self.sectors is None:
+                        frames = snapshot.render(self.encoding, hub.epoch, chunked)
+                        if frames is not None:
+                            for text_data, bytes_data in frames:
+                                await self.send_encoded(text_data, bytes_data)
+                            return
+                    contents = snapshot.contents()
             
-            # Get ambulance fleet
-            ambulances = await self.get_ambulance_fleet()
+            if contents is not None:
+                state, seq, version = contents
+            else:
+                # Stream position the queried state is at; a later resume starts here
+                seq, version = hub.seq, None
+                state = await database_sync_to_async(load_dispatcher_state)()
+            emergencies, ambulances, hospitals = state['emergencies'], state['ambulances'], state['hospitals']
             
-            # Get hospitals
-            hospitals = await self.get_hospitals()
+            if self.sectors is not None:
+                emergencies, ambulances, hospitals = (
+                    self.in_area(emergencies), self.in_area(ambulances), self.in_area(hospitals)
+                )
             
-            await self.send(text_data=json.dumps({
+            fields = {'epoch': hub.epoch, 'seq': seq}
+            if version is not None:
+                fields['version'] = version
+            if chunked:
+                lists = {'emergencies': emergencies, 'ambulances': ambulances, 'hospitals': hospitals}
+                for text in initial_data_chunks(lists, fields):
+                    text_data, bytes_data = encode_json_frame(text, self.encoding)
+                    await self.send_encoded(text_data, bytes_data)
+                return
+            await self.send_frame({
                 'type': 'initial_data',
+                **fields,
                 'data': {
                     'emergencies': emergencies,
                     'ambulances': ambulances,
                     'hospitals': hospitals
                 }
-            }))
+            })
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'error',
                 'message': str(e)
-            }))
+            })
     
-    @database_sync_to_async
-    def get_active_emergencies(self):
-        """Get active emergency calls"""
-        from .models import EmergencyCall
-        from .serializers import EmergencyCallSerializer
-        
-        emergencies = EmergencyCall.objects.filter(
-            status__in=['RECEIVED', 'DISPATCHED', 'EN_ROUTE', 'ON_SCENE', 'TRANSPORTING']
-        ).order_by('-received_at')
-        
-        return EmergencyCallSerializer(emergencies, many=True).data
+    def in_area(self, items):
+        """Entities located in this socket's sectors"""
+        located = ((item, entity_position(item)) for item in items)
+        return [item for item, position in located if position and sector_of(*position) in self.sectors]
     
     @database_sync_to_async
-    def get_ambulance_fleet(self):
-        """Get ambulance fleet data"""
+    def get_snapshot(self, kind, entity_id):
+        """Get one versioned emergency or ambulance, or None"""
         from dispatch.models import Ambulance
         from dispatch.serializers import AmbulanceSerializer
+        from .models import EmergencyCall
+        from .serializers import EmergencyCallSerializer
         
-        ambulances = Ambulance.objects.all()
-        return AmbulanceSerializer(ambulances, many=True).data
-    
-    @database_sync_to_async
-    def get_hospitals(self):
-        """Get hospital data"""
-        from dispatch.models import Hospital
-        from dispatch.serializers import HospitalSerializer
-        
-        hospitals = Hospital.objects.all()
-        return HospitalSerializer(hospitals, many=True).data
+        sources = {
+            'emergency': (EmergencyCall, EmergencyCallSerializer),
+            'ambulance': (Ambulance, AmbulanceSerializer),
+        }
+        if kind not in sources:
+            return None
+        model, serializer_class = sources[kind]
+        instance = model.objects.filter(pk=entity_id).first()
+        return with_version(serializer_class(instance).data) if instance else None
 
 
-class ParamedicConsumer(AsyncWebsocketConsumer):
-    """WebSocket consumer for paramedic field interface updates"""
+class ParamedicConsumer(EncodedFramesMixin, AsyncWebsocketConsumer):
+    """
+    WebSocket consumer for paramedic field interface updates.
+
+    Besides keepalive pings the field app streams GPS fixes as
+    ``{"type": "location", "latitude", "longitude", "recorded_at"?}`` frames.
+    Each fix goes into the write-behind fleet position store and is
+    broadcast to dispatchers straight from the event loop, so a fast GPS
+    feed doesn't cost a thread-pool query per frame. The unit assignment is
+    re-checked every ``PARAMEDIC_WS_ASSIGNMENT_CHECK_INTERVAL`` seconds.
+    """
     async def connect(self):
         user = self.scope.get("user", AnonymousUser())
         
@@ -144,27 +310,81 @@ class ParamedicConsumer(AsyncWebsocketConsumer):
             logger.warning(f"Paramedic WebSocket connection rejected - User: {user}, Is Authenticated: {user != AnonymousUser()}, Is Paramedic: {getattr(user, 'is_paramedic', False)}")
             await self.close(code=4001)  # Custom close code for unauthorized
             return
+        self.user = user
         self.group_name = f"paramedic_{user.id}"
+        self.ambulance_id = await self.get_assigned_ambulance_id()
+        self.last_assignment_check = time.monotonic()
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
+        registry = get_presence_registry()
+        await registry.ensure_sweeper()
+        if await registry.connect(user.id, self.channel_name):
+            await announce_presence(user.id, True)
 
     async def disconnect(self, close_code):
         logger.info(f"Paramedic WebSocket disconnecting - Close code: {close_code}")
         if hasattr(self, 'group_name'):
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            if await get_presence_registry().disconnect(self.user.id, self.channel_name):
+                await announce_presence(self.user.id, False)
 
-    async def receive(self, text_data):
-        # Paramedic client can ping to keepalive
+    async def receive(self, text_data=None, bytes_data=None):
+        # Paramedic client can ping to keepalive; every frame counts as a heartbeat
         try:
-            data = json.loads(text_data)
+            data = decode_frame(text_data, bytes_data)
+            if await get_presence_registry().heartbeat(self.user.id, self.channel_name):
+                # The sweeper expired this still-open connection and reported it offline
+                await announce_presence(self.user.id, True)
             if data.get('type') == 'ping':
-                await self.send(text_data=json.dumps({'type': 'pong'}))
+                await self.send_frame({'type': 'pong'})
+            elif data.get('type') == 'location':
+                await self.receive_location(data)
         except Exception:
             pass
 
+    async def receive_location(self, data):
+        """Validate, store and broadcast one GPS fix"""
+        from core.utils import asend_location_notification
+        from dispatch.fleet_store import get_fleet_store
+        from dispatch.locations import parse_location_point
+        
+        # Echoed as sent so the client can drop exactly the rejected fix from its queue
+        rejected = {'type': 'location_error', 'recorded_at': data.get('recorded_at')}
+        check_interval = getattr(settings, 'PARAMEDIC_WS_ASSIGNMENT_CHECK_INTERVAL', 10)
+        if self.ambulance_id is None or time.monotonic() - self.last_assignment_check >= check_interval:
+            # Assignment may have happened after the socket opened
+            self.ambulance_id = await self.get_assigned_ambulance_id()
+            self.last_assignment_check = time.monotonic()
+            if self.ambulance_id is None:
+                await self.send_frame({**rejected, 'error': 'No assigned ambulance'})
+                return
+        try:
+            _, lat, lng, recorded_at = parse_location_point(data, self.ambulance_id)
+        except ValueError as e:
+            await self.send_frame({**rejected, 'error': str(e)})
+            return
+        
+        recorded = recorded_at.isoformat()
+        store = get_fleet_store()
+        store.add_history([(self.ambulance_id, lat, lng, recorded_at)])
+        # Out-of-order fixes only go into the history; they don't move the unit
+        moved = store.record(self.ambulance_id, lat, lng, recorded_at)
+        if moved:
+            await asend_location_notification([[self.ambulance_id, lat, lng, recorded]])
+        
+        if store.write_through:
+            await database_sync_to_async(store.flush)()
+        ack = {'type': 'location_ack', 'recorded_at': recorded}
+        if not moved:
+            ack['stale'] = True
+        await self.send_frame(ack)
+
+    async def get_assigned_ambulance_id(self):
+        from dispatch.models import Ambulance
+        
+        return await Ambulance.objects.filter(
+            assigned_paramedic_id=self.user.id
+        ).values_list('id', flat=True).afirst()
+
     async def emergency_update(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'emergency_update',
-            'event': event['event'],
-            'data': event['data']
-        }))
\ No newline at end of file
+        await self.forward_frame(event)
\ No newline at end of file
@@ -0,0 +1,210 @@
+"""
+Offline forward/reverse geocoding for the public emergency form.
+
+A gazetteer of named places (CSV with ``name,latitude,longitude[,kind]``
+rows, built with the ``import_gazetteer`` management command) is loaded from
+``GAZETTEER_PATH``. Reverse lookups use the same grid index as the fleet
+(``dispatch.spatial.GridIndex``) and address autocomplete walks a prefix trie,
+so callers get an address without any outside geocoding service.
+"""
+import csv
+import logging
+import re
+import threading
+import unicodedata
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from django.conf import settings
+
+from dispatch.spatial import GridIndex
+
+logger = logging.getLogger(__name__)
+
+# Lower sorts first in autocomplete results
+KIND_RANK = {'place': 0, 'hospital': 1, 'amenity': 2, 'street': 3}
+
+# Trie depth cap; longer queries filter every key that continues past the capped node
+MAX_PREFIX_DEPTH = 12
+
+
+class Place(NamedTuple):
+    name: str
+    latitude: float
+    longitude: float
+    kind: str
+
+
+def normalize(text: str) -> str:
+    """Lower-case, strip accents and collapse punctuation/whitespace."""
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    return re.sub(r'[^a-z0-9]+', ' ', text).strip()
+
+
+class _TrieNode:
+    __slots__ = ('children', 'top', 'deeper')
+
+    def __init__(self):
+        self.children: Dict[str, '_TrieNode'] = {}
+        self.top: List[int] = []
+        # Only at the depth cap: every entry whose key goes on past it
+        self.deeper: List[int] = []
+
+
+class PrefixTrie:
+    """
+    Character trie where every node keeps the best ``keep`` entries below it,
+    so a prefix query is a walk down ``len(prefix)`` nodes with no subtree scan.
+    Prefixes longer than ``MAX_PREFIX_DEPTH`` get every entry continuing past
+    the capped node instead, for the caller to filter and rank.
+    """
+
+    def __init__(self, keep: int = 20):
+        self.keep = keep
+        self.root = _TrieNode()
+
+    def insert(self, key: str, entry: int, rank) -> None:
+        node = self.root
+        for ch in key[:MAX_PREFIX_DEPTH]:
+            node = node.children.setdefault(ch, _TrieNode())
+            if entry not in node.top:
+                node.top.append(entry)
+                if len(node.top) > self.keep:
+                    node.top.sort(key=rank)
+                    node.top.pop()
+        if len(key) > MAX_PREFIX_DEPTH:
+            node.deeper.append(entry)
+
+    def search(self, prefix: str) -> List[int]:
+        node = self.root
+        for ch in prefix[:MAX_PREFIX_DEPTH]:
+            node = node.children.get(ch)
+            if node is None:
+                return []
+        if len(prefix) > MAX_PREFIX_DEPTH:
+            # An entry is listed once per word start that reaches this node
+            return list(dict.fromkeys(node.deeper))
+        return list(node.top)
+
+
+class Gazetteer:
+    def __init__(self, places: List[Place], cell_size_deg: float = 0.01):
+        self.places = places
+        self.keys = [normalize(p.name) for p in places]
+        self.index = GridIndex(cell_size_deg)
+        self.trie = PrefixTrie()
+
+        for i, place in enumerate(places):
+            self.index.insert(i, place.latitude, place.longitude)
+            key = self.keys[i]
+            # Index the full name and every word start, so "king" finds "Old King Street"
+            for match in re.finditer(r'\S+', key):
+                self.trie.insert(key[match.start():], i, self._rank)
+        # Sort the kept entries once at the end for stable result order
+        stack = [self.trie.root]
+        while stack:
+            node = stack.pop()
+            node.top.sort(key=self._rank)
+            stack.extend(node.children.values())
+
+    def _rank(self, i: int):
+        p = self.places[i]
+        return (KIND_RANK.get(p.kind, len(KIND_RANK)), len(p.name), p.name)
+
+    def __len__(self):
+        return len(self.places)
+
+    @classmethod
+    def load(cls, path) -> 'Gazetteer':
+        places = []
+        with open(path, newline='', encoding='utf-8') as fh:
+            for row in csv.DictReader(fh):
+                try:
+                    places.append(Place(
+                        name=row['name'].strip(),
+                        latitude=float(row['latitude']),
+                        longitude=float(row['longitude']),
+                        kind=(row.get('kind') or 'place').strip(),
+                    ))
+                except (KeyError, ValueError):
+                    continue
+        return cls([p for p in places if p.name])
+
+    def reverse(self, lat: float, lng: float, max_distance_km: float = 1.0) -> Optional[dict]:
+        hits = self.index.nearest(lat, lng, k=1, max_distance_km=max_distance_km)
+        if not hits:
+            return None
+        i, distance_km = hits[0]
+        place = self.places[i]
+        return {
+            'display_name': place.name if distance_km < 0.05 else f'Near {place.name}',
+            'name': place.name,
+            'kind': place.kind,
+            'latitude': place.latitude,
+            'longitude': place.longitude,
+            'distance_km': round(distance_km, 3),
+        }
+
+    def search(self, query: str, limit: int = 10) -> List[dict]:
+        key = normalize(query)
+        if not key:
+            return []
+        matches = self.trie.search(key)
+        if len(key) > MAX_PREFIX_DEPTH:
+            matches = sorted(
+                (i for i in matches if self.keys[i].startswith(key) or f' {key}' in self.keys[i]),
+                key=self._rank,
+            )
+        return [
+            {'name': p.name, 'kind': p.kind, 'latitude': p.latitude, 'longitude': p.longitude}
+            for p in (self.places[i] for i in matches[:limit])
+        ]
+
+
+_gazetteer: Optional[Gazetteer] = None
+_gazetteer_loaded = False
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer() -> Optional[Gazetteer]:
+    """Process-wide gazetteer, or None when no gazetteer file is installed."""
+    global _gazetteer, _gazetteer_loaded
+    if not _gazetteer_loaded:
+        with _gazetteer_lock:
+            if not _gazetteer_loaded:
+                path = Path(getattr(settings, 'GAZETTEER_PATH', ''))
+                if path.is_file():
+                    try:
+                        _gazetteer = Gazetteer.load(path)
+                        logger.info(f"Gazetteer loaded from {path} ({len(_gazetteer)} places)")
+                    except Exception as e:
+                        logger.warning(f"Failed to load gazetteer {path}: {e}", exc_info=True)
+                else:
+                    logger.info("No gazetteer installed; geocoding endpoints will return no results")
+                _gazetteer_loaded = True
+    return _gazetteer
+
+
+# Hot results: GPS fixes from the same street and repeated keystrokes hit these
+@lru_cache(maxsize=4096)
+def _reverse_cached(lat_q: float, lng_q: float):
+    gazetteer = get_gazetteer()
+    return gazetteer.reverse(lat_q, lng_q) if gazetteer else None
+
+
+@lru_cache(maxsize=4096)
+def _search_cached(key: str, limit: int):
+    gazetteer = get_gazetteer()
+    return tuple(gazetteer.search(key, limit)) if gazetteer else ()
+
+
+def reverse_geocode(lat: float, lng: float) -> Optional[dict]:
+    """Nearest named place to a coordinate (cached on ~10 m rounding)."""
+    return _reverse_cached(round(float(lat), 4), round(float(lng), 4))
+
+
+def search_places(query: str, limit: int = 10) -> List[dict]:
+    """Autocomplete named places by prefix."""
+    return list(_search_cached(normalize(query), limit))
@@ -0,0 +1,82 @@
+import csv
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from emergencies.geocoding import normalize
+
+
+def classify(tags):
+    """Gazetteer kind for a tagged OSM element, or None to skip it."""
+    if tags.get('amenity') in ('hospital', 'clinic'):
+        return 'hospital'
+    if 'place' in tags:
+        return 'place'
+    if any(k in tags for k in ('amenity', 'shop', 'tourism', 'leisure', 'office', 'building')):
+        return 'amenity'
+    if 'highway' in tags:
+        return 'street'
+    return None
+
+
+class Command(BaseCommand):
+    help = 'Build the offline geocoding gazetteer (GAZETTEER_PATH) from an OpenStreetMap .osm XML extract'
+
+    def add_arguments(self, parser):
+        parser.add_argument('osm_file', help='Path to an .osm XML extract of the service area')
+        parser.add_argument('--output', help='Destination CSV (defaults to settings.GAZETTEER_PATH)')
+        parser.add_argument('--include-hospitals', action='store_true',
+                            help='Also add Hospital records from the database')
+
+    def handle(self, *args, **options):
+        source = Path(options['osm_file'])
+        if not source.is_file():
+            raise CommandError(f'{source} does not exist')
+        output = Path(options['output'] or settings.GAZETTEER_PATH)
+
+        coords, rows, seen = {}, [], set()
+
+        def add(name, lat, lng, kind):
+            # Streets are split into many ways; keep one entry per name per ~1 km
+            key = (normalize(name), round(lat, 2), round(lng, 2))
+            if key not in seen:
+                seen.add(key)
+                rows.append((name, f'{lat:.6f}', f'{lng:.6f}', kind))
+
+        for _, elem in ET.iterparse(source, events=('end',)):
+            if elem.tag not in ('node', 'way'):
+                continue
+            tags = {t.get('k'): t.get('v') for t in elem.findall('tag')}
+            name = tags.get('name')
+            if elem.tag == 'node':
+                lat, lng = float(elem.get('lat')), float(elem.get('lon'))
+                coords[int(elem.get('id'))] = (lat, lng)
+                kind = classify(tags) if name else None
+                if kind and kind != 'street':
+                    add(name, lat, lng, kind)
+            else:
+                kind = classify(tags) if name else None
+                points = [coords[int(nd.get('ref'))] for nd in elem.findall('nd') if int(nd.get('ref')) in coords]
+                if kind and points:
+                    # Middle vertex for streets, centroid for areas
+                    if kind == 'street':
+                        lat, lng = points[len(points) // 2]
+                    else:
+                        lat = sum(p[0] for p in points) / len(points)
+                        lng = sum(p[1] for p in points) / len(points)
+                    add(name, lat, lng, kind)
+            elem.clear()
+
+        if options['include_hospitals']:
+            from dispatch.models import Hospital
+            for name, lat, lng in Hospital.objects.values_list('name', 'latitude', 'longitude'):
+                add(name, float(lat), float(lng), 'hospital')
+
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with open(output, 'w', newline='', encoding='utf-8') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(['name', 'latitude', 'longitude', 'kind'])
+            writer.writerows(rows)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {len(rows)} places to {output}'))
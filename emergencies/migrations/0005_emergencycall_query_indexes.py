@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emergencies', '0004_alter_emergencycall_emergency_images_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emergencycall',
+            name='assigned_paramedic',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='assigned_calls', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='emergencycall',
+            index=models.Index(fields=['status', '-received_at', '-id'], name='emergency_status_recv_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emergencycall',
+            index=models.Index(fields=['-received_at', '-id'], name='emergency_recv_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emergencycall',
+            index=models.Index(fields=['assigned_paramedic', '-received_at'], name='emergency_medic_recv_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emergencycall',
+            index=models.Index(condition=models.Q(('status__in', ['RECEIVED', 'DISPATCHED', 'EN_ROUTE', 'ON_SCENE', 'TRANSPORTING'])), fields=['-received_at'], name='emergency_open_recv_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emergencycall',
+            index=models.Index(condition=models.Q(('status__in', ['DISPATCHED', 'EN_ROUTE', 'ON_SCENE', 'TRANSPORTING'])), fields=['assigned_paramedic', '-received_at'], name='emergency_medic_open_idx'),
+        ),
+    ]
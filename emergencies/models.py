@@ -6,6 +6,12 @@ from django.conf import settings
 from core.models import User
 
 
+class EmergencyCallQuerySet(models.QuerySet):
+    def with_related(self):
+        """Join the rows ``EmergencyCallSerializer`` reads (unit, paramedic, dispatcher)"""
+        return self.select_related('assigned_ambulance', 'assigned_paramedic', 'dispatcher')
+
+
 class EmergencyCall(models.Model):
     """Model representing an emergency call from start to finish"""
     
@@ -59,7 +65,8 @@ class EmergencyCall(models.Model):
     
     # Assignment information
     assigned_ambulance = models.ForeignKey('dispatch.Ambulance', on_delete=models.SET_NULL, null=True, blank=True)
-    assigned_paramedic = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='assigned_calls')
+    # The (assigned_paramedic, received_at) index below covers lookups by paramedic; skip the separate FK index
+    assigned_paramedic = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='assigned_calls', db_index=False)
     dispatcher = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='dispatched_calls')
     
     # Timestamps
@@ -80,10 +87,30 @@ class EmergencyCall(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = EmergencyCallQuerySet.as_manager()
+    
     class Meta:
         ordering = ['-received_at']
         verbose_name = 'Emergency Call'
         verbose_name_plural = 'Emergency Calls'
+        indexes = [
+            # Status filters (pending/active/completed boards), newest first, keyset pages within a status
+            models.Index(fields=['status', '-received_at', '-id'], name='emergency_status_recv_idx'),
+            # The call list and its keyset pages on (received_at, id)
+            models.Index(fields=['-received_at', '-id'], name='emergency_recv_idx'),
+            # A paramedic's calls, newest first (my-active call, assignment history)
+            models.Index(fields=['assigned_paramedic', '-received_at'], name='emergency_medic_recv_idx'),
+            # Partial indexes over the few open calls in a table of mostly closed ones
+            # (used by backends that match them to parameterized queries, e.g. PostgreSQL)
+            models.Index(
+                fields=['-received_at'], name='emergency_open_recv_idx',
+                condition=models.Q(status__in=['RECEIVED', 'DISPATCHED', 'EN_ROUTE', 'ON_SCENE', 'TRANSPORTING']),
+            ),
+            models.Index(
+                fields=['assigned_paramedic', '-received_at'], name='emergency_medic_open_idx',
+                condition=models.Q(status__in=['DISPATCHED', 'EN_ROUTE', 'ON_SCENE', 'TRANSPORTING']),
+            ),
+        ]
     
     def __str__(self):
         return f"Call {self.call_id} - {self.emergency_type} ({self.status})"
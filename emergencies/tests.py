@@ -1,3 +1,576 @@
-from django.test import TestCase
+import asyncio
+import re
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.db import connection
+from django.db.models import Q
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from rest_framework.test import APIClient
+
+from core.frames import decode_frame, encode_frame, message_body
+from core.models import User
+from core.presence import get_presence_registry
+from core.replay import get_replay_hub
+from core.snapshot import ACTIVE_EMERGENCY_STATUSES, DispatcherSnapshot
+from core.sectors import SectorTracker
+from core.sendqueue import CLOSE_CODE_BACKLOG, SendQueue
+from core.utils import DeltaTracker, asend_ambulance_notification, entity_version
+from dispatch import fleet_store
+from dispatch.fleet_store import FleetPositionStore
+from dispatch.models import Ambulance, Hospital, LocationPing
+from .consumers import DispatcherConsumer, ParamedicConsumer, load_dispatcher_state
+from . import geocoding
+from .geocoding import Gazetteer, Place
+from .models import EmergencyCall
+
+
+def make_board(calls=30):
+    """
+    ``calls`` emergency calls spread over every status, each with its own
+    unit, paramedic and dispatcher, so a per-row lookup shows up as N queries.
+    """
+    statuses = [choice for choice, _ in EmergencyCall.STATUS_CHOICES]
+    for i in range(calls):
+        dispatcher = User.objects.create_user(f'dispatcher{i}', role='dispatcher', first_name='D')
+        paramedic = User.objects.create_user(f'paramedic{i}', role='paramedic', first_name='P')
+        ambulance = Ambulance.objects.create(unit_number=f'AMB-{i:03d}', assigned_paramedic=paramedic)
+        call = EmergencyCall.objects.create(
+            caller_name='Caller', caller_phone='+23276123456', emergency_type='MEDICAL',
+            description='Board fixture', location_address='Freetown',
+            latitude=8.48, longitude=-13.23, status=statuses[i % len(statuses)],
+            assigned_ambulance=ambulance, assigned_paramedic=paramedic, dispatcher=dispatcher,
+        )
+        ambulance.current_emergency = call
+        ambulance.save()
+    Hospital.objects.create(name='Connaught', address='Freetown', latitude=8.49, longitude=-13.24)
+
+
+def make_gazetteer():
+    """25 market stalls sharing a long prefix that outrank one long street name"""
+    places = [Place(f'Kissy Road Market {i:02d}', 8.48 + i * 0.001, -13.22, 'place') for i in range(1, 26)]
+    places += [
+        Place('Kissy Road Motor Park Junction', 8.47, -13.21, 'street'),
+        Place('Connaught Hospital', 8.49, -13.24, 'hospital'),
+        Place('Connaught', 8.4901, -13.2401, 'place'),
+        Place('Old Connaught Street Extension', 8.50, -13.25, 'street'),
+    ]
+    return Gazetteer(places)
+
+
+class GazetteerTests(SimpleTestCase):
+    """Autocomplete and reverse lookups on the offline gazetteer"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.gazetteer = make_gazetteer()
+
+    def names(self, query, limit=10):
+        return [place['name'] for place in self.gazetteer.search(query, limit)]
+
+    def test_long_exact_name(self):
+        # Shares "kissy road m" with 25 better-ranked places
+        self.assertEqual(self.names('Kissy Road Motor Park Junction'), ['Kissy Road Motor Park Junction'])
+        self.assertEqual(self.names('kissy road motor'), ['Kissy Road Motor Park Junction'])
+        self.assertEqual(self.names('motor park junction'), ['Kissy Road Motor Park Junction'])
+        self.assertEqual(self.names('connaught street ext'), ['Old Connaught Street Extension'])
+
+    def test_prefix_shared_by_more_places_than_a_node_keeps(self):
+        self.assertEqual(self.names('kissy road m', limit=20),
+                         [f'Kissy Road Market {i:02d}' for i in range(1, 21)])
+        self.assertEqual(self.names('kissy road market 2', limit=20),
+                         [f'Kissy Road Market {i:02d}' for i in range(20, 26)])
+
+    def test_rank_order(self):
+        # Places before hospitals before streets, then shorter names first
+        self.assertEqual(self.names('connaught'),
+                         ['Connaught', 'Connaught Hospital', 'Old Connaught Street Extension'])
+        self.assertEqual(self.names('connaught', limit=1), ['Connaught'])
+        self.assertEqual(self.names('Connaught Hospital!'), ['Connaught Hospital'])
+        self.assertEqual(self.names('nowhere at all street'), [])
+
+    def test_reverse(self):
+        self.assertEqual(self.gazetteer.reverse(8.4901, -13.2401)['display_name'], 'Connaught')
+        self.assertEqual(self.gazetteer.reverse(8.4920, -13.2401)['display_name'], 'Near Connaught')
+        self.assertIsNone(self.gazetteer.reverse(9.0, -12.0))
+
+
+class GeocodeViewTests(SimpleTestCase):
+    """The public geocoding endpoints answer from the installed gazetteer"""
+
+    def setUp(self):
+        for patcher in (mock.patch.object(geocoding, '_gazetteer', make_gazetteer()),
+                        mock.patch.object(geocoding, '_gazetteer_loaded', True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for cached in (geocoding._reverse_cached, geocoding._search_cached):
+            cached.cache_clear()
+            self.addCleanup(cached.cache_clear)
+        self.client = APIClient()
+
+    def test_search(self):
+        response = self.client.get('/api/geocode/search/', {'q': 'Kissy Road Motor Park Junction'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([place['name'] for place in response.data], ['Kissy Road Motor Park Junction'])
+        self.assertEqual(len(self.client.get('/api/geocode/search/', {'q': 'kissy', 'limit': 50}).data), 20)
+        self.assertEqual(self.client.get('/api/geocode/search/', {'q': 'k'}).data, [])
+
+    def test_reverse(self):
+        response = self.client.get('/api/geocode/reverse/', {'lat': 8.4901, 'lng': -13.2401})
+        self.assertEqual(response.data['name'], 'Connaught')
+        self.assertEqual(self.client.get('/api/geocode/reverse/', {'lat': 9.0, 'lng': -12.0}).status_code, 404)
+        self.assertEqual(self.client.get('/api/geocode/reverse/', {'lat': 91, 'lng': 0}).status_code, 400)
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0)
+class EmergencyListQueryBudgetTests(TestCase):
+    """List endpoints run a fixed number of queries however many calls they return"""
+
+    @classmethod
+    def setUpTestData(cls):
+        make_board()
+        cls.dispatcher = User.objects.get(username='dispatcher0')
+        cls.paramedic = User.objects.get(username='paramedic1')  # holds a DISPATCHED call
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_emergency_list(self):
+        self.client.force_authenticate(self.dispatcher)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/emergencies/', {'page_size': 100})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 30)
+        self.assertTrue(all(call['assigned_ambulance_unit'] for call in response.data['results']))
+
+    def test_active_emergencies(self):
+        self.client.force_authenticate(self.dispatcher)
+        for status_filter in ('active', 'pending', 'completed', 'all'):
+            with self.subTest(status=status_filter), self.assertNumQueries(1):
+                response = self.client.get('/api/emergencies/active/', {'status': status_filter})
+                self.assertEqual(response.status_code, 200)
+
+    def test_my_active_call(self):
+        self.client.force_authenticate(self.paramedic)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/emergencies/my-active/')
+        self.assertEqual(response.data['assigned_paramedic_name'], 'P')
+
+    def test_dispatcher_initial_data(self):
+        # One query each for the calls, the fleet and the hospitals
+        with self.assertNumQueries(3):
+            state = load_dispatcher_state()
+        active = EmergencyCall.objects.filter(status__in=ACTIVE_EMERGENCY_STATUSES).count()
+        self.assertEqual(len(state['emergencies']), active)
+        self.assertEqual(len(state['ambulances']), 30)
+        self.assertTrue(all(a['current_emergency_id'] for a in state['ambulances']))
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0)
+class EmergencyCursorPaginationTests(TestCase):
+    """Keyset pages over (received_at, id), newest first"""
+
+    @classmethod
+    def setUpTestData(cls):
+        make_board()
+        # Ties on received_at must be broken by id, not skipped or repeated
+        first = EmergencyCall.objects.order_by('id').first()
+        EmergencyCall.objects.filter(id__lte=first.id + 9).update(received_at=first.received_at)
+        cls.dispatcher = User.objects.get(username='dispatcher0')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.dispatcher)
+
+    def walk(self, url, params):
+        ids, url, pages = [], url, 0
+        while url:
+            with self.assertNumQueries(1):
+                response = self.client.get(url, params if pages == 0 else None)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), params['page_size'])
+            ids += [call['id'] for call in response.data['results']]
+            url, pages = response.data['next'], pages + 1
+        return ids, pages
+
+    def test_pages_cover_every_call_once_in_order(self):
+        ids, pages = self.walk('/api/emergencies/', {'page_size': 7})
+        expected = list(EmergencyCall.objects.order_by('-received_at', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, 5)
+
+    def test_completed_calls_are_paginated(self):
+        ids, _ = self.walk('/api/emergencies/active/', {'status': 'completed', 'page_size': 3})
+        expected = list(EmergencyCall.objects.filter(status__in=['AT_HOSPITAL', 'CLOSED'])
+                        .order_by('-received_at', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_active_calls_are_not_paginated(self):
+        response = self.client.get('/api/emergencies/active/', {'status': 'pending'})
+        self.assertIsInstance(response.data, list)
+
+    def test_page_size_is_capped(self):
+        with self.settings(EMERGENCY_LIST_MAX_PAGE_SIZE=10):
+            response = self.client.get('/api/emergencies/', {'page_size': 1000})
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_invalid_cursor(self):
+        for cursor in ('garbage', 'bm90LWEtZGF0ZXwx'):
+            with self.subTest(cursor=cursor):
+                response = self.client.get('/api/emergencies/', {'cursor': cursor})
+                self.assertEqual(response.status_code, 404)
+
+
+def assert_index_scan(test, queryset, table, ordered=False):
+    """
+    ``queryset``'s plan reads ``table`` through an index rather than a full
+    table scan; ``ordered`` also rules out sorting the rows afterwards.
+    """
+    plan = queryset.explain()
+    if connection.vendor == 'sqlite':
+        lines = [line.split(' ', 3)[-1] for line in plan.splitlines()]
+        test.assertTrue(any(re.match(rf'(SEARCH|SCAN) {table} USING (COVERING )?INDEX ', line) for line in lines), plan)
+        test.assertNotIn(f'SCAN {table}', lines, plan)
+        if ordered:
+            test.assertFalse(any('TEMP B-TREE FOR ORDER BY' in line for line in lines), plan)
+    else:
+        test.assertNotIn(f'Seq Scan on {table}', plan)
+        test.assertIn('Index', plan)
+        if ordered:
+            test.assertNotRegex(plan, r'\bSort\b')
+
+
+@skipUnless(connection.vendor in ('sqlite', 'postgresql'), 'EXPLAIN output is checked for SQLite and PostgreSQL')
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0)
+class EmergencyIndexPlanTests(TestCase):
+    """The hot call queries are index scans on a table of mostly closed calls"""
+
+    TABLE = EmergencyCall._meta.db_table
+    CALLS = 20000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.paramedics = User.objects.bulk_create([User(username=f'medic{i}', role='paramedic') for i in range(200)])
+        open_statuses = ACTIVE_EMERGENCY_STATUSES
+        EmergencyCall.objects.bulk_create([
+            EmergencyCall(
+                call_id=f'CALL-{i:08d}', caller_name='Caller', caller_phone='+23276123456',
+                emergency_type='MEDICAL', description='Synthetic', location_address='Freetown',
+                # 2% of calls are still open, as on a board after months of service
+                status=open_statuses[i % len(open_statuses)] if i % 50 == 0 else ('AT_HOSPITAL', 'CLOSED')[i % 2],
+                assigned_paramedic=cls.paramedics[i % len(cls.paramedics)],
+            )
+            for i in range(cls.CALLS)
+        ], batch_size=2000)
+        # auto_now_add stamps every row alike: spread them over time, 100 calls a minute
+        first = EmergencyCall.objects.order_by('id').values_list('id', flat=True)[0]
+        now = timezone.now()
+        for minute in range(cls.CALLS // 100):
+            EmergencyCall.objects.filter(id__gte=first + minute * 100, id__lt=first + (minute + 1) * 100).update(
+                received_at=now - timedelta(minutes=cls.CALLS // 100 - minute)
+            )
+        cls.deep = EmergencyCall.objects.order_by('-received_at', '-id')[cls.CALLS // 2]
+
+    def keyset_after(self, queryset, call):
+        return queryset.filter(received_at__lte=call.received_at).filter(
+            Q(received_at__lt=call.received_at) | Q(received_at=call.received_at, id__lt=call.id)
+        ).order_by('-received_at', '-id')
+
+    def test_dispatcher_board(self):
+        # load_dispatcher_state and active_emergencies?status=active
+        calls = EmergencyCall.objects.filter(status__in=ACTIVE_EMERGENCY_STATUSES).order_by('-received_at')
+        assert_index_scan(self, calls, self.TABLE)
+        calls = EmergencyCall.objects.filter(status__in=['DISPATCHED', 'EN_ROUTE', 'ON_SCENE', 'TRANSPORTING'])
+        assert_index_scan(self, calls.order_by('-received_at'), self.TABLE)
+
+    def test_pending_calls(self):
+        calls = EmergencyCall.objects.filter(status='RECEIVED').order_by('-received_at')
+        assert_index_scan(self, calls, self.TABLE, ordered=True)
+
+    def test_call_list_pages(self):
+        page = EmergencyCall.objects.order_by('-received_at', '-id')[:51]
+        assert_index_scan(self, page, self.TABLE, ordered=True)
+        assert_index_scan(self, self.keyset_after(EmergencyCall.objects.all(), self.deep)[:51], self.TABLE, ordered=True)
+
+    def test_completed_pages(self):
+        completed = EmergencyCall.objects.filter(status__in=['AT_HOSPITAL', 'CLOSED'])
+        assert_index_scan(self, completed.order_by('-received_at', '-id')[:51], self.TABLE)
+        assert_index_scan(self, self.keyset_after(completed, self.deep)[:51], self.TABLE)
+
+    def test_paramedic_calls(self):
+        paramedic = self.paramedics[0]
+        # my_active_call / paramedic_interface
+        active = EmergencyCall.objects.filter(
+            assigned_paramedic=paramedic, status__in=['DISPATCHED', 'EN_ROUTE', 'ON_SCENE', 'TRANSPORTING']
+        ).order_by('-received_at')[:1]
+        assert_index_scan(self, active, self.TABLE)
+        # my_assignments
+        history = EmergencyCall.objects.filter(assigned_paramedic=paramedic).order_by('-received_at')[:10]
+        assert_index_scan(self, history, self.TABLE, ordered=True)
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0,
+                   CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ParamedicLocationSocketTests(TestCase):
+    """GPS fixes sent over the paramedic socket"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.paramedic = User.objects.create_user('medic', role='paramedic')
+        cls.unit = Ambulance.objects.create(unit_number='AMB-100', assigned_paramedic=cls.paramedic)
+
+    async def test_rejected_fix_is_echoed(self):
+        socket = WebsocketCommunicator(ParamedicConsumer.as_asgi(), '/ws/paramedic/')
+        socket.scope['user'] = self.paramedic
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        try:
+            await socket.send_json_to({'type': 'location', 'latitude': -100, 'longitude': 36.9,
+                                       'recorded_at': '2024-01-01T10:00:00+03:00'})
+            reply = await socket.receive_json_from()
+            self.assertEqual(reply['type'], 'location_error')
+            # As sent, so the client can find the fix in its queue
+            self.assertEqual(reply['recorded_at'], '2024-01-01T10:00:00+03:00')
+        finally:
+            await socket.disconnect()
+
+    async def test_fix_moves_the_unit_and_reaches_dispatchers(self):
+        store = FleetPositionStore(flush_interval=0)
+        layer = get_channel_layer()
+        dispatcher_channel = await layer.new_channel()
+        await layer.group_add('dispatchers', dispatcher_channel)
+        socket = WebsocketCommunicator(ParamedicConsumer.as_asgi(), '/ws/paramedic/')
+        socket.scope['user'] = self.paramedic
+        with mock.patch.object(fleet_store, '_store', store):
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+            try:
+                await socket.send_json_to({'type': 'location', 'latitude': 8.481, 'longitude': -13.231,
+                                           'recorded_at': '2024-01-01T10:00:05Z'})
+                self.assertEqual(await socket.receive_json_from(),
+                                 {'type': 'location_ack', 'recorded_at': '2024-01-01T10:00:05+00:00'})
+                frame = message_body(await layer.receive(dispatcher_channel))
+                if frame['type'] == 'presence_update':
+                    frame = message_body(await layer.receive(dispatcher_channel))
+                self.assertEqual(frame['event'], 'LOCATION_BATCH')
+                self.assertEqual(frame['data']['locations'],
+                                 [[self.unit.pk, 8.481, -13.231, '2024-01-01T10:00:05+00:00']])
+                # An older fix is kept for the track but doesn't move the unit
+                await socket.send_json_to({'type': 'location', 'latitude': 8.47, 'longitude': -13.22,
+                                           'recorded_at': '2024-01-01T10:00:01Z'})
+                self.assertTrue((await socket.receive_json_from())['stale'])
+            finally:
+                await socket.disconnect()
+        self.assertEqual(store._positions[self.unit.pk][:2], (8.481, -13.231))
+        self.assertEqual(await LocationPing.objects.filter(ambulance_id=self.unit.pk).acount(), 2)
+
+    async def test_fix_without_an_assigned_unit(self):
+        socket = WebsocketCommunicator(ParamedicConsumer.as_asgi(), '/ws/paramedic/')
+        socket.scope['user'] = await User.objects.acreate(username='spare', role='paramedic')
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        try:
+            await socket.send_json_to({'type': 'location', 'latitude': 8.48, 'longitude': -13.23})
+            reply = await socket.receive_json_from()
+            self.assertEqual((reply['type'], reply['error']), ('location_error', 'No assigned ambulance'))
+        finally:
+            await socket.disconnect()
+
+    async def test_ping_after_expiry_comes_back_online(self):
+        socket = WebsocketCommunicator(ParamedicConsumer.as_asgi(), '/ws/paramedic/')
+        socket.scope['user'] = self.paramedic
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        try:
+            # The sweeper expires the connection while the socket stays open
+            registry = get_presence_registry()
+            for channel_name in registry._connections[self.paramedic.id]:
+                registry._connections[self.paramedic.id][channel_name] = 0
+            self.assertEqual(await registry.sweep(), [self.paramedic.id])
+            with mock.patch('emergencies.consumers.announce_presence') as announce:
+                await socket.send_json_to({'type': 'ping'})
+                self.assertEqual(await socket.receive_json_from(), {'type': 'pong'})
+                await socket.send_json_to({'type': 'ping'})
+                await socket.receive_json_from()
+            announce.assert_called_once_with(self.paramedic.id, True)
+        finally:
+            await socket.disconnect()
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0,
+                   REALTIME_SNAPSHOT_CACHE=False,
+                   CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class DispatcherSocketTests(TestCase):
+    """The dispatcher dashboard socket"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.dispatcher = User.objects.create_user('dispatcher', role='dispatcher')
+        cls.unit = Ambulance.objects.create(unit_number='AMB-300',
+                                           current_latitude=Decimal('8.48'), current_longitude=Decimal('-13.23'))
+        cls.far_unit = Ambulance.objects.create(unit_number='AMB-301',
+                                               current_latitude=Decimal('8.60'), current_longitude=Decimal('-13.23'))
+
+    async def connect(self, path='/ws/dispatchers/', initial_data=True):
+        socket = WebsocketCommunicator(DispatcherConsumer.as_asgi(), path)
+        socket.scope['user'] = self.dispatcher
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        if initial_data:
+            self.initial_data = await socket.receive_json_from()
+            self.assertEqual(self.initial_data['type'], 'initial_data')
+        return socket
+
+    def unit_data(self, unit, minute=0):
+        return {'id': unit.pk, 'unit_number': unit.unit_number, 'current_latitude': str(unit.current_latitude),
+                'current_longitude': str(unit.current_longitude), 'updated_at': f'2026-10-18T10:{minute:02d}:00+00:00'}
+
+    async def test_snapshot_of_one_entity(self):
+        socket = await self.connect()
+        try:
+            await socket.send_json_to({'type': 'get_snapshot', 'kind': 'ambulance', 'id': self.unit.pk})
+            frame = await socket.receive_json_from()
+            self.assertEqual((frame['type'], frame['kind'], frame['data']['unit_number']),
+                             ('snapshot', 'ambulance', 'AMB-300'))
+            self.assertEqual(frame['data']['v'], entity_version(frame['data']))
+            for kind, entity_id in (('ambulance', 999999), ('hospital', self.unit.pk), ('ambulance', 'x')):
+                await socket.send_json_to({'type': 'get_snapshot', 'kind': kind, 'id': entity_id})
+                self.assertEqual((await socket.receive_json_from())['type'], 'error')
+        finally:
+            await socket.disconnect()
+
+    async def test_sector_subscription(self):
+        with mock.patch('core.sectors._tracker', SectorTracker()), \
+                mock.patch('core.utils.get_delta_tracker', return_value=DeltaTracker()):
+            socket = await self.connect('/ws/dispatchers/?sectors=e9w84')
+            try:
+                self.assertEqual([a['unit_number'] for a in self.initial_data['data']['ambulances']], ['AMB-300'])
+                await asend_ambulance_notification('UPDATED', self.unit_data(self.far_unit))
+                await asend_ambulance_notification('UPDATED', self.unit_data(self.unit))
+                frame = await socket.receive_json_from()
+                self.assertEqual(frame['data']['unit_number'], 'AMB-300')
+                self.assertTrue(await socket.receive_nothing())
+
+                # Widen the area; initial data follows for it
+                await socket.send_json_to({'type': 'subscribe', 'bbox': [8.47, -13.24, 8.61, -13.22]})
+                frame = await socket.receive_json_from()
+                self.assertEqual(frame['type'], 'subscribed')
+                self.assertIn('e9w8f', frame['sectors'])
+                frame = await socket.receive_json_from()
+                self.assertEqual(len(frame['data']['ambulances']), 2)
+                await asend_ambulance_notification('UPDATED', self.unit_data(self.far_unit, minute=1))
+                self.assertEqual((await socket.receive_json_from())['delta']['id'], self.far_unit.pk)
+            finally:
+                await socket.disconnect()
+
+    async def test_invalid_area_falls_back_to_the_whole_city(self):
+        socket = await self.connect('/ws/dispatchers/?bbox=north,west', initial_data=False)
+        try:
+            self.assertEqual((await socket.receive_json_from())['type'], 'error')
+            frame = await socket.receive_json_from()
+            self.assertEqual((frame['type'], len(frame['data']['ambulances'])), ('initial_data', 2))
+            await socket.send_json_to({'type': 'subscribe', 'sectors': ['e9']})
+            self.assertIn('Area too large', (await socket.receive_json_from())['message'])
+        finally:
+            await socket.disconnect()
+
+    async def test_resume_replays_missed_events(self):
+        hub = get_replay_hub()
+        with mock.patch('core.utils.get_delta_tracker', return_value=DeltaTracker()):
+            socket = await self.connect()
+            epoch, seq = self.initial_data['epoch'], self.initial_data['seq']
+            await asend_ambulance_notification('UPDATED', self.unit_data(self.unit))
+            frame = await socket.receive_json_from()
+            self.assertEqual((frame['epoch'], frame['seq']), (epoch, seq + 1))
+            await socket.disconnect()
+
+            # Missed while disconnected; the recorder still numbers them
+            await asend_ambulance_notification('UPDATED', self.unit_data(self.unit, minute=1))
+            await asend_ambulance_notification('UPDATED', self.unit_data(self.far_unit))
+            for _ in range(100):
+                if hub.seq >= seq + 3:
+                    break
+                await asyncio.sleep(0.01)
+
+            socket = await self.connect(f'/ws/dispatchers/?resume={epoch}:{seq + 1}', initial_data=False)
+            try:
+                replayed = [await socket.receive_json_from() for _ in range(3)]
+                self.assertEqual([f.get('seq') for f in replayed[:2]], [seq + 2, seq + 3])
+                self.assertEqual(replayed[0]['delta']['changes'], {'updated_at': '2026-10-18T10:01:00+00:00'})
+                self.assertEqual(replayed[2], {'type': 'resumed', 'epoch': epoch, 'seq': seq + 3, 'replayed': 2})
+                # Nothing to catch up on
+                await socket.send_json_to({'type': 'resume', 'epoch': epoch, 'seq': seq + 3})
+                self.assertEqual((await socket.receive_json_from())['replayed'], 0)
+            finally:
+                await socket.disconnect()
+
+    async def test_resume_from_another_process_gets_initial_data(self):
+        socket = await self.connect('/ws/dispatchers/?resume=elsewhere:12', initial_data=False)
+        try:
+            self.assertEqual((await socket.receive_json_from())['type'], 'initial_data')
+            await socket.send_json_to({'type': 'resume', 'epoch': get_replay_hub().epoch, 'seq': 'x'})
+            self.assertEqual((await socket.receive_json_from())['type'], 'initial_data')
+        finally:
+            await socket.disconnect()
+
+    async def test_negotiated_binary_frames(self):
+        socket = WebsocketCommunicator(DispatcherConsumer.as_asgi(), '/ws/dispatchers/',
+                                       subprotocols=['ambulance.json+deflate'])
+        socket.scope['user'] = self.dispatcher
+        connected, subprotocol = await socket.connect()
+        self.assertEqual((connected, subprotocol), (True, 'ambulance.json+deflate'))
+        try:
+            frame = decode_frame(bytes_data=await socket.receive_from())
+            self.assertEqual((frame['type'], len(frame['data']['ambulances'])), ('initial_data', 2))
+            # Clients may answer in any encoding
+            await socket.send_to(bytes_data=encode_frame({'type': 'ping'}, 'json+deflate')[1])
+            self.assertEqual(decode_frame(bytes_data=await socket.receive_from()), {'type': 'pong'})
+        finally:
+            await socket.disconnect()
+
+    @override_settings(REALTIME_SNAPSHOT_CACHE=True)
+    async def test_initial_data_from_the_snapshot(self):
+        with mock.patch('core.snapshot._snapshot', DispatcherSnapshot()), \
+                mock.patch('emergencies.consumers.load_dispatcher_state', wraps=load_dispatcher_state) as load:
+            first = await self.connect()
+            second = await self.connect()
+            try:
+                self.assertEqual(load.call_count, 1)
+                self.assertEqual(self.initial_data['version'], 1)
+                self.assertEqual(len(self.initial_data['data']['ambulances']), 2)
+            finally:
+                await first.disconnect()
+                await second.disconnect()
+
+    async def test_chunked_initial_data(self):
+        with override_settings(REALTIME_INITIAL_CHUNK_ITEMS=1):
+            socket = await self.connect('/ws/dispatchers/?initial=chunked', initial_data=False)
+            try:
+                frames = [await socket.receive_json_from() for _ in range(4)]
+                self.assertEqual([f['type'] for f in frames],
+                                 ['initial_data_start', 'initial_data_chunk', 'initial_data_chunk', 'initial_data_end'])
+                self.assertEqual(frames[0]['counts'], {'emergencies': 0, 'ambulances': 2, 'hospitals': 0})
+                # Asked for again, in one frame
+                await socket.send_json_to({'type': 'get_initial_data', 'chunked': False})
+                self.assertEqual((await socket.receive_json_from())['type'], 'initial_data')
+            finally:
+                await socket.disconnect()
+
+    @override_settings(REALTIME_SEND_QUEUE_SIZE=1)
+    async def test_client_too_far_behind_is_disconnected(self):
+        async def stalled(queue):
+            await asyncio.Event().wait()
+
+        with mock.patch.object(SendQueue, '_write_forever', stalled):
+            socket = await self.connect(initial_data=False)
+            try:
+                # initial_data fills the queue; the reply can't be queued behind it
+                await socket.send_json_to({'type': 'ping'})
+                self.assertEqual(await socket.receive_output(), {'type': 'websocket.close', 'code': CLOSE_CODE_BACKLOG})
+            finally:
+                await socket.disconnect()
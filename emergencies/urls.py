@@ -19,4 +19,6 @@ urlpatterns = [
     path('api/emergencies/active/', views.active_emergencies, name='active_emergencies'),
     path('api/emergencies/my-active/', views.my_active_call, name='my_active_call'),
     path('api/emergencies/upload-image/', views.upload_emergency_image, name='upload_emergency_image'),
+    path('api/geocode/reverse/', views.reverse_geocode_view, name='reverse_geocode'),
+    path('api/geocode/search/', views.geocode_search, name='geocode_search'),
 ]
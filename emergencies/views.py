@@ -1,28 +1,32 @@
 from rest_framework import generics, status
 from rest_framework.throttling import AnonRateThrottle
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from django.shortcuts import render
 from django.core.files.storage import default_storage
 from django.conf import settings
+from django.db import transaction
 import logging
 import os
 import uuid
 from .models import EmergencyCall
+from .pagination import EmergencyCallCursorPagination
 from .serializers import EmergencyCallSerializer, EmergencyCallCreateSerializer, EmergencyCallStatusUpdateSerializer
-from core.utils import send_emergency_notification
+from .geocoding import reverse_geocode, search_places
+from core.outbox import enqueue_emergency_notification
 
 
 logger = logging.getLogger(__name__)
 
 
 class EmergencyCallListCreateView(generics.ListCreateAPIView):
-    """API view for listing and creating emergency calls"""
+    """API view for listing (cursor-paginated, newest first) and creating emergency calls"""
     
-    queryset = EmergencyCall.objects.all()
+    queryset = EmergencyCall.objects.with_related()
     permission_classes = [AllowAny]  # Public API for emergency calls
     throttle_classes = [AnonRateThrottle]
+    pagination_class = EmergencyCallCursorPagination
     
     def get_serializer_class(self):
         if self.request.method == 'POST':
@@ -81,14 +85,15 @@ class EmergencyCallListCreateView(generics.ListCreateAPIView):
             files = request.FILES.getlist('images', [])
             serializer = self.get_serializer(data=data)
             serializer.is_valid(raise_exception=True)
-            emergency_call = serializer.save()
-            
-            # Process uploaded files
-            for file in files:
-                emergency_call.add_emergency_image(file)
+            with transaction.atomic():
+                emergency_call = serializer.save()
                 
-            # Send notification after all files are processed
-            self.send_notification('NEW_EMERGENCY', emergency_call)
+                # Process uploaded files
+                for file in files:
+                    emergency_call.add_emergency_image(file)
+                    
+                # Send notification after all files are processed
+                self.send_notification('NEW_EMERGENCY', emergency_call)
             
             # Return FULL representation including call_id
             headers = self.get_success_headers({})
@@ -106,22 +111,23 @@ class EmergencyCallListCreateView(generics.ListCreateAPIView):
     
     def perform_create(self, serializer, uploaded_files=None):
         """Create a new emergency call and handle file uploads"""
-        emergency_call = serializer.save()
-        
-        # Process any uploaded files
-        if uploaded_files:
-            for file in uploaded_files:
-                emergency_call.add_emergency_image(file)
-        
-        # Send real-time notification
-        self.send_notification('NEW_EMERGENCY', emergency_call)
+        with transaction.atomic():
+            emergency_call = serializer.save()
+            
+            # Process any uploaded files
+            if uploaded_files:
+                for file in uploaded_files:
+                    emergency_call.add_emergency_image(file)
+            
+            # Send real-time notification
+            self.send_notification('NEW_EMERGENCY', emergency_call)
 
         return emergency_call
     
     def send_notification(self, event_type, emergency_call):
-        """Send WebSocket notification using optimized utility function"""
+        """Queue a WebSocket notification in the current transaction's outbox"""
         emergency_data = EmergencyCallSerializer(emergency_call).data
-        send_emergency_notification(
+        enqueue_emergency_notification(
             event=event_type,
             emergency_data=emergency_data,
             paramedic_id=emergency_call.assigned_paramedic_id
@@ -131,22 +137,23 @@ class EmergencyCallListCreateView(generics.ListCreateAPIView):
 class EmergencyCallDetailView(generics.RetrieveUpdateAPIView):
     """API view for retrieving and updating emergency calls"""
     
-    queryset = EmergencyCall.objects.all()
+    queryset = EmergencyCall.objects.with_related()
     serializer_class = EmergencyCallSerializer
     permission_classes = [IsAuthenticated]
     
     def perform_update(self, serializer):
         """Update emergency call and send notification"""
         old_status = self.get_object().status
-        emergency_call = serializer.save()
-        
-        if old_status != emergency_call.status:
-            self.send_notification('STATUS_UPDATE', emergency_call)
+        with transaction.atomic():
+            emergency_call = serializer.save()
+            
+            if old_status != emergency_call.status:
+                self.send_notification('STATUS_UPDATE', emergency_call)
     
     def send_notification(self, event_type, emergency_call):
-        """Send WebSocket notification using optimized utility function"""
+        """Queue a WebSocket notification in the current transaction's outbox"""
         emergency_data = EmergencyCallSerializer(emergency_call).data
-        send_emergency_notification(
+        enqueue_emergency_notification(
             event=event_type,
             emergency_data=emergency_data,
             paramedic_id=emergency_call.assigned_paramedic_id
@@ -171,17 +178,18 @@ def update_emergency_status(request, pk):
     
     if serializer.is_valid():
         old_status = emergency_call.status
-        emergency_call = serializer.save()
-        
-        # Send real-time notification using optimized utility function
-        emergency_data = EmergencyCallSerializer(emergency_call).data
-        send_emergency_notification(
-            event='STATUS_UPDATE',
-            emergency_data=emergency_data,
-            paramedic_id=emergency_call.assigned_paramedic_id
-        )
+        with transaction.atomic():
+            emergency_call = serializer.save()
+            
+            # Queue the real-time notification with the status change
+            emergency_data = EmergencyCallSerializer(emergency_call).data
+            enqueue_emergency_notification(
+                event='STATUS_UPDATE',
+                emergency_data=emergency_data,
+                paramedic_id=emergency_call.assigned_paramedic_id
+            )
         
-        return Response(EmergencyCallSerializer(emergency_call).data)
+        return Response(emergency_data)
     
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -193,22 +201,27 @@ def active_emergencies(request):
     
     status_filter = request.GET.get('status', 'active')
     
+    queryset = EmergencyCall.objects.with_related()
     if status_filter == 'active':
-        queryset = EmergencyCall.objects.filter(status__in=['DISPATCHED', 'EN_ROUTE', 'ON_SCENE', 'TRANSPORTING'])
+        queryset = queryset.filter(status__in=['DISPATCHED', 'EN_ROUTE', 'ON_SCENE', 'TRANSPORTING'])
     elif status_filter == 'pending':
-        queryset = EmergencyCall.objects.filter(status='RECEIVED')
+        queryset = queryset.filter(status='RECEIVED')
     elif status_filter == 'completed':
-        queryset = EmergencyCall.objects.filter(status__in=['AT_HOSPITAL', 'CLOSED'])
-    else:
-        queryset = EmergencyCall.objects.all()
+        queryset = queryset.filter(status__in=['AT_HOSPITAL', 'CLOSED'])
     
-    serializer = EmergencyCallSerializer(queryset, many=True)
-    return Response(serializer.data)
+    if status_filter in ('active', 'pending'):
+        serializer = EmergencyCallSerializer(queryset, many=True)
+        return Response(serializer.data)
+    
+    # Completed calls (and all calls) grow without bound: serve them a page at a time
+    paginator = EmergencyCallCursorPagination()
+    page = paginator.paginate_queryset(queryset, request)
+    return paginator.get_paginated_response(EmergencyCallSerializer(page, many=True).data)
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def my_active_call(request):
     """Return the active call for the authenticated paramedic (if any)."""
-    active_call = EmergencyCall.objects.filter(
+    active_call = EmergencyCall.objects.with_related().filter(
         assigned_paramedic=request.user,
         status__in=['DISPATCHED', 'EN_ROUTE', 'ON_SCENE', 'TRANSPORTING']
     ).order_by('-received_at').first()
@@ -217,6 +230,45 @@ def my_active_call(request):
     return Response(EmergencyCallSerializer(active_call).data)
 
 
+class GeocodeRateThrottle(AnonRateThrottle):
+    """Address lookups fire per keystroke, so they get their own, larger budget"""
+    scope = 'geocode'
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@throttle_classes([GeocodeRateThrottle])
+def reverse_geocode_view(request):
+    """Nearest named place to ?lat=&lng= from the offline gazetteer"""
+    try:
+        lat = float(request.GET['lat'])
+        lng = float(request.GET['lng'])
+    except (KeyError, ValueError):
+        return Response({'error': 'lat and lng query parameters are required'}, status=status.HTTP_400_BAD_REQUEST)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return Response({'error': 'Coordinates out of range'}, status=status.HTTP_400_BAD_REQUEST)
+
+    place = reverse_geocode(lat, lng)
+    if place is None:
+        return Response({'error': 'No known place near this location'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(place)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@throttle_classes([GeocodeRateThrottle])
+def geocode_search(request):
+    """Address autocomplete for ?q= from the offline gazetteer"""
+    query = request.GET.get('q', '').strip()
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 8)), 20))
+    except ValueError:
+        limit = 8
+    if len(query) < 2:
+        return Response([])
+    return Response(search_places(query, limit))
+
+
 def landing_page(request):
     """Landing page for emergency call requests"""
     return render(request, 'emergencies/landing.html')
@@ -237,7 +289,7 @@ def paramedic_interface(request):
         return render(request, 'core/login_required.html')
     
     # Get the paramedic's active call
-    active_call = EmergencyCall.objects.filter(
+    active_call = EmergencyCall.objects.with_related().filter(
         assigned_paramedic=request.user,
         status__in=['DISPATCHED', 'EN_ROUTE', 'ON_SCENE', 'TRANSPORTING']
     ).first()
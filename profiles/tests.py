@@ -1,3 +1,30 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from core.models import User
+from emergencies.models import EmergencyCall
+
+
+@override_settings(FLEET_POSITION_FLUSH_INTERVAL=0, OUTBOX_RELAY_INTERVAL=0, LOCATION_BROADCAST_INTERVAL=0)
+class MyAssignmentsQueryBudgetTests(TestCase):
+    """A page of assignments costs a count and one joined select"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.paramedic = User.objects.create_user('medic', role='paramedic', first_name='M')
+        for i in range(15):
+            dispatcher = User.objects.create_user(f'dispatcher{i}', role='dispatcher', first_name='D')
+            EmergencyCall.objects.create(
+                caller_name='Caller', caller_phone='+23276123456', emergency_type='MEDICAL',
+                description='Assignment fixture', location_address='Freetown',
+                status='CLOSED', assigned_paramedic=cls.paramedic, dispatcher=dispatcher,
+            )
+
+    def test_my_assignments(self):
+        client = APIClient()
+        client.force_authenticate(self.paramedic)
+        with self.assertNumQueries(2):
+            response = client.get('/profiles/api/my-assignments/', {'limit': 10})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertTrue(all(call['dispatcher_name'] == 'D' for call in response.data['results']))
@@ -20,7 +20,7 @@ def my_assignments(request):
     except ValueError:
         limit, offset = 10, 0
 
-    qs = EmergencyCall.objects.filter(assigned_paramedic=request.user).order_by('-received_at')
+    qs = EmergencyCall.objects.with_related().filter(assigned_paramedic=request.user).order_by('-received_at')
     total = qs.count()
     items = qs[offset:offset+limit]
     data = EmergencyCallSerializer(items, many=True).data
@@ -284,3 +284,48 @@ async function submitNewEmergency() {
 	}
 }
 
+
+// WebSocket frame encodings (see core/frames.py). Offer the most compact one
+// this browser can decode; servers without support just answer with JSON.
+function realtimeSubprotocols() {
+	const offers = [];
+	const inflate = typeof DecompressionStream !== 'undefined';
+	if (typeof MessagePack !== 'undefined') {
+		if (inflate) offers.push('ambulance.msgpack+deflate');
+		offers.push('ambulance.msgpack');
+	}
+	if (inflate) offers.push('ambulance.json+deflate');
+	offers.push('ambulance.json');
+	return offers;
+}
+
+const FRAME_DEFLATE = 0x01;
+const FRAME_MSGPACK = 0x02;
+
+async function decodeFrame(data) {
+	if (typeof data === 'string') return JSON.parse(data);
+	const bytes = new Uint8Array(data);
+	const flags = bytes[0];
+	let body = bytes.subarray(1);
+	if (flags & FRAME_DEFLATE) {
+		const stream = new Blob([body]).stream().pipeThrough(new DecompressionStream('deflate'));
+		body = new Uint8Array(await new Response(stream).arrayBuffer());
+	}
+	if (flags & FRAME_MSGPACK) return MessagePack.decode(body);
+	return JSON.parse(new TextDecoder().decode(body));
+}
+
+// Open a WebSocket that decodes every frame and hands messages to onMessage
+// in arrival order (decompression is async, so frames are chained)
+function openRealtimeSocket(url, onMessage) {
+	const socket = new WebSocket(url, realtimeSubprotocols());
+	socket.binaryType = 'arraybuffer';
+	let pending = Promise.resolve();
+	socket.onmessage = (e) => {
+		pending = pending
+			.then(() => decodeFrame(e.data))
+			.then(onMessage)
+			.catch(err => console.error('WebSocket frame error:', err));
+	};
+	return socket;
+}